@@ -1,17 +1,54 @@
 from django.contrib import admin
 
-from chat.models import Chat, Message
+from chat.models import Chat, Message, Attachment, ReadMarker, InboxSummary, StoredBlob, ChatDeletionJob
 
 # Register your models here.
 
 @admin.register(Chat)
 class ChatAdmin(admin.ModelAdmin):
-    list_display = ('id', 'is_group', 'created_at')
+    list_display = ('id', 'is_group', 'created_at', 'deleted_at')
     search_fields = ('name',)
     list_filter = ('is_group',)
 
+    def get_queryset(self, request):
+        return Chat.all_objects.all()
+
 
 @admin.register(Message)
 class MessageAdmin(admin.ModelAdmin):
     list_display = ('id', 'chat', 'author', 'created_at')
     list_filter = ('chat', 'author')
+
+
+@admin.register(Attachment)
+class AttachmentAdmin(admin.ModelAdmin):
+    list_display = ('id', 'chat', 'uploaded_by', 'name', 'content_type', 'size', 'renditions', 'created_at')
+    list_filter = ('content_type', 'renditions')
+
+
+
+@admin.register(ReadMarker)
+class ReadMarkerAdmin(admin.ModelAdmin):
+    list_display = ('id', 'chat', 'user', 'last_read_message_id', 'updated_at')
+    list_filter = ('chat',)
+
+
+@admin.register(InboxSummary)
+class InboxSummaryAdmin(admin.ModelAdmin):
+    list_display = ('id', 'chat', 'user', 'unread_count', 'last_message_at')
+    list_filter = ('chat',)
+
+
+@admin.register(StoredBlob)
+class StoredBlobAdmin(admin.ModelAdmin):
+    list_display = ('digest', 'name', 'size', 'references', 'updated_at')
+    search_fields = ('digest', 'name')
+
+
+@admin.register(ChatDeletionJob)
+class ChatDeletionJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'chat_id', 'status', 'messages_deleted', 'attachments_deleted', 'files_deleted',
+                    'created_at', 'finished_at')
+    list_filter = ('status',)
+    readonly_fields = ('chat_id', 'messages_deleted', 'attachments_deleted', 'files_deleted',
+                       'created_at', 'updated_at', 'finished_at')
@@ -6,4 +6,5 @@ class ChatConfig(AppConfig):
     name = 'chat'
 
     def ready(self):
+        import chat.checks
         import chat.signals
\ No newline at end of file
@@ -0,0 +1,27 @@
+from django.core.checks import Tags, Warning, register
+from django.db import connections
+from chat.search import FTS_TABLE, missing_triggers
+
+
+@register(Tags.database)
+def check_search_triggers(app_configs, databases=None, **kwargs):
+    """
+    Warn when the message search index of a SQLite database lost the
+    triggers keeping it in sync. A database that is not migrated yet has
+    no index and is skipped.
+    """
+    errors = []
+    for alias in databases or []:
+        connection = connections[alias]
+        if connection.vendor != "sqlite":
+            continue
+        missing = missing_triggers(connection)
+        if missing:
+            errors.append(Warning(
+                f"The {FTS_TABLE} index is missing the triggers {', '.join(missing)}, new messages are not indexed.",
+                hint="Migrate chat back to 0018_chat_soft_delete and forward again, "
+                     "the message_search_triggers migration recreates them and rebuilds the index.",
+                obj=FTS_TABLE,
+                id="chat.W001",
+            ))
+    return errors
@@ -1,14 +1,22 @@
-import base64
-import json
-import uuid
-from channels.db import database_sync_to_async, aclose_old_connections
+import asyncio
+from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
-from django.core.files.base import ContentFile
-from chat.models import Chat, Message
+from chat.events import chat_message_event, inbox_message_event
+from chat.history import get_history_page, serialize_message, serialize_attachment
+from chat.inbox import inbox_group, preview
+from chat.layers import group_send_many
+from chat.membership import get_membership
+from chat.models import Attachment, Message
+from chat.notifications import get_dispatcher, notification_group
+from chat.presence import get_presence, get_broadcaster, SITE
+from chat.protocol import WireProtocolMixin
+from chat.ratelimit import get_rate_limiter, connection_limit, user_limit
+from chat.receipts import get_receipt_buffer, get_read_receipts
+from chat.writer import write_message
 from user.models import User
 
 
-class ChatConsumer(AsyncWebsocketConsumer):
+class ChatConsumer(WireProtocolMixin, AsyncWebsocketConsumer):
     """
     ChatConsumer handles WebSocket connections and messages.
     """
@@ -21,247 +29,232 @@ class ChatConsumer(AsyncWebsocketConsumer):
         self.conv_group_name = f"chat_{self.conversation}"  # Create a group
         self.user = self.scope['user']  # Get user object
 
-        self.chat = await self.get_chat_instance()
+        # Only members of an existing chat may join it
+        self.membership = await get_membership(self.conversation)
+        if self.user.is_anonymous or self.membership is None or self.user.id not in self.membership:
+            await self.close()
+            return
+
+        self.rate_limiter = get_rate_limiter()
 
-        if not await self.is_user_online():
-            # If the user is not online, add him to the list of online users
-            await self.add_user_online()
+        # Register this connection, several tabs of one user count once
+        self.presence = get_presence()
+        version = await self.presence.join(self.conversation, self.user.username, self.channel_name)
+        if version:
+            # Others learn about the join from a coalesced delta
+            get_broadcaster().publish(self.conversation, [[version, 'join', self.user.username]])
+        self.heartbeat_task = asyncio.create_task(self.heartbeat())
 
         # Add user to the group
         await self.channel_layer.group_add(self.conv_group_name, self.channel_name)
         await self.accept()
 
-        online_users = await self.get_online_users()
-        event = {
-            'type': 'online_users_handler',
-            'online_users': online_users,
-            'chat_name': self.chat.name if self.chat.is_group else "Private Chat"
-        }
-        # Send online users to the group
-        await self.channel_layer.group_send(self.conv_group_name, event)
-
-        # Get previous messages
-        messages = await self.get_previous_messages(self.conversation)
-        await self.send(text_data=json.dumps({
-            'type': 'previous_messages',
-            'messages': messages
-        }))
+        # Only this connection gets the full list of online users
+        await self.send_presence_snapshot()
+
+        # The page renders the newest messages and the cursor, only read state is missing
+        receipts = await database_sync_to_async(get_read_receipts)(self.conversation)
+        await self.send_payload({
+            'type': 'read_receipts',
+            'receipts': receipts,
+        })
 
     async def disconnect(self, close_code):
         """
         Called when the WebSocket closes for any reason.
         """
-        if await self.is_user_online():
-            # If the user is online, remove him from the list of online users
-            await self.remove_user_online()
-            online_users = await self.get_online_users()
-            event = {
-                'type': 'online_users_handler',
-                'online_users': online_users,
-                'chat_name': self.chat.name if self.chat.is_group else "Private Chat"
-            }
-            # Send online users to the group
-            await self.channel_layer.group_send(self.conv_group_name, event)
+        if hasattr(self, "heartbeat_task"):
+            self.heartbeat_task.cancel()
+
+        if hasattr(self, "presence"):
+            version = await self.presence.leave(self.conversation, self.user.username, self.channel_name)
+            if version:
+                # The last connection of the user is gone
+                get_broadcaster().publish(self.conversation, [[version, 'leave', self.user.username]])
+
+        if hasattr(self, "rate_limiter"):
+            await self.rate_limiter.reset(connection_limit(self.channel_name)[0])
 
         # Remove user from the group
         await self.channel_layer.group_discard(self.conv_group_name, self.channel_name)
 
-    async def receive(self, text_data):
+    async def receive_payload(self, data):
         """
         Called when the consumer receives data.
-        :param text_data: Received data
-        """
-        text_data_json = json.loads(text_data)
-        message = text_data_json["message"]
+        :param data: Received data, decoded from JSON or msgpack
+        """
+        # Every frame costs a token from this connection's and this user's buckets
+        retry_after = await self.rate_limiter.hit([
+            connection_limit(self.channel_name), user_limit(self.user.id)
+        ])
+        if retry_after:
+            # The client sends a dropped message again under the same ref
+            await self.send_payload({'type': 'throttled', 'retry_after': retry_after, 'ref': data.get("ref")})
+            return
+
+        # The chat may have been deleted or the user removed since the socket connected
+        membership = await get_membership(self.conversation)
+        if membership is None or self.user.id not in membership:
+            await self.close()
+            return
+        self.membership = membership
+
+        if data.get("type") == "read":
+            # Read state is written in debounced batches and broadcast as receipts
+            get_receipt_buffer().mark_read(
+                self.conversation, self.user.id, self.user.username, data.get("message_id")
+            )
+            return
+
+        if data.get("type") == "presence_sync":
+            # The client missed a presence version and asks for a full snapshot
+            await self.send_presence_snapshot()
+            return
+
+        if data.get("type") == "history":
+            # The client asks for the page older than the given cursor
+            messages, next_cursor = await self.get_previous_messages(
+                self.conversation, before=data.get("before")
+            )
+            await self.send_payload({
+                'type': 'history',
+                'messages': messages,
+                'next_cursor': next_cursor,
+            })
+            return
+
+        message = data.get("message", "")
         user = self.scope['user']
 
-        file = text_data_json.get("file", None)
+        # Files are uploaded over HTTP beforehand, the frame only carries the attachment id
+        attachment_id = data.get("attachment", None)
+        try:
+            attachment_id = None if attachment_id is None else int(attachment_id)
+        except (TypeError, ValueError):
+            return
+        if not isinstance(message, str):
+            # Malformed frames are dropped like undecodable ones
+            return
 
         # Save message to a database
-        await self.save_message(user, conversation=self.conversation, file=file, message=message)
-
-        if message.strip() != '':
-            recipients = await self.get_chat_members(self.conversation)
-
-            recipients.remove(user)
-
-            if len(recipients) > 1:
-                await self.channel_layer.group_send(
-                    self.conv_group_name,
-                    {
-                        'type': 'chat_message',
-                        'message': message,
-                        'username': user.username,
-                        'file': file,
-                    }
-                )
-                for recipient in recipients:
-                    await self.channel_layer.group_send(
-                        f"user_{recipient.id}_notifications",
-                        {
-                            'type': 'notify',
-                            'message': f"New Message!",
-                            'recipient': recipient.username,
-                            'sender': self.chat.name
-                        }
-                    )
-            else:
-                await self.channel_layer.group_send(
-                    self.conv_group_name,
-                    {
-                        'type': 'chat_message',
-                        'message': message,
-                        'username': user.username,
-                        'file': file,
-                    }
-                )
-                await self.channel_layer.group_send(
-                    f"user_{recipients[0].id}_notifications",
-                    {
-                        'type': 'notify',
-                        'message': f"New Message!",
-                        'recipient': recipients[0].username,
-                        'sender': self.user.username
-                    }
-                )
+        saved = await self.save_message(
+            user, conversation=self.conversation, message=message, attachment_id=attachment_id
+        )
+
+        if saved is not None:
+            attachment = serialize_attachment(saved.attachment) if saved.attachment else None
+
+            # The frame is serialized once here instead of once per group member
+            await self.channel_layer.group_send(
+                self.conv_group_name, chat_message_event(saved.id, message, user.username, attachment)
+            )
+
+            # Every member's inbox, the author's other tabs included, gets the new last message
+            await group_send_many(
+                self.channel_layer,
+                [inbox_group(member_id) for member_id in self.membership.members],
+                inbox_message_event(
+                    self.membership.chat_id,
+                    saved.id,
+                    user.username,
+                    preview(saved),
+                    saved.created_at.isoformat(),
+                ),
+            )
+
+            # Other members are notified in coalesced batches
+            get_dispatcher().notify(self.membership, user.id, user.username)
 
     async def chat_message(self, event):
         """
         Called when a message is received from a room group.
-        :param event: Received event
+        :param event: Received event with a pre-serialized frame
         """
-        message = event["message"]
-        username = event['username']
-        file = event["file"]
-
         # Send a message to WebSocket
-        await self.send(text_data=json.dumps({
-            'message': message,
-            'username': username,
-            'file': file,
-        }))
+        await self.send_frame(event)
 
-    @database_sync_to_async
-    def save_message(self, user, conversation, message, file):
+    async def save_message(self, user, conversation, message, attachment_id):
         """
-        Save message to a database
+        Save message to a database, through the write-behind writer when it
+        is enabled, in which case it is inserted with a batch of messages.
         :param user: User object
         :param conversation: chat id
         :param message: message text
-        :param file: file
-        :return: None
+        :param attachment_id: id of a file uploaded through the attachments endpoint
+        :return: Stored message, or None if there was nothing to save or the writer dropped it
         """
-        aclose_old_connections()
-
-        mime_type_map = {
-            'application/pdf': 'pdf',
-            'application/msword': 'doc',
-            'application/vnd.openxmlformats-officedocument.wordprocessingml.document': 'docx',
-            'text/plain': 'txt',
-            'application/zip': 'zip',
-        }
+        attachment = await self.get_attachment(user, conversation, attachment_id) if attachment_id else None
 
-        if file:
-            frmt, file_str = file.split(';base64,')
-            ext = frmt.split('/')[-1]
+        if message.strip() == '' and attachment is None:
+            return None
 
-            mime_tp = frmt.split(':')[1]
-
-            if ext not in ['png', 'jpg', 'jpeg', 'gif', 'svg', 'webp']:
-                ext = mime_type_map.get(mime_tp, 'txt')
-
-            file_name = f"{uuid.uuid4()}.{ext}"
-            file_content = ContentFile(base64.b64decode(file_str), name=file_name)
-        else:
-            file_content = None
-        if message.strip() != '':
-            chat, created = Chat.objects.get_or_create(id=conversation)
-            Message.objects.create(chat=chat, author=user, file=file_content, text=message, read=False)
+        return await write_message(Message(
+            chat_id=conversation,
+            author=user,
+            attachment=attachment,
+            file=attachment.file.name if attachment else None,
+            text=message,
+        ))
 
     @database_sync_to_async
-    def get_previous_messages(self, conversation):
+    def get_attachment(self, user, conversation, attachment_id):
         """
-        Get previous messages from a database
-        :param conversation: chat id
-        :return: list of messages
+        Get an attachment the user uploaded to this chat.
+        :return: Attachment or None
         """
-        aclose_old_connections()
-        try:
-            chat = Chat.objects.get(id=conversation)
-            return [{'username': message.author.username,
-                     'text': message.text,
-                     'file': message.file.url if message.file else None,
-                     'created_at': message.created_at.strftime("%Y-%m-%d %H:%M:%S")}
-                    for message in chat.messages.all()]
-        except Chat.DoesNotExist:
-            return []
+        return Attachment.objects.filter(
+            id=attachment_id, chat_id=conversation, uploaded_by=user
+        ).first()
 
     @database_sync_to_async
-    def get_chat_members(self, conversation):
+    def get_previous_messages(self, conversation, before=None):
         """
-        Retrieve members of the chat.
+        Get a page of previous messages from a database
+        :param conversation: chat id
+        :param before: cursor of the oldest message the client has
+        :return: Tuple of (list of messages, cursor of the next page)
         """
-        aclose_old_connections()
-        chat = Chat.objects.get(id=conversation)
-        return [member for member in chat.members.all()]
+        page, next_cursor = get_history_page(conversation, before=before)
+        return [serialize_message(message) for message in page], next_cursor
 
-    async def online_users_handler(self, event):
+    async def read_receipts(self, event):
         """
-        Called when the number of online users changes.
+        Called when members of the chat have read up to a message.
         """
-        online_users = event.get('online_users', None)
         # Send a message to WebSocket
-        await self.send(text_data=json.dumps({
-            'type': 'online_users',
-            'online_users': online_users,
-            'chat_name': self.chat.name if self.chat.is_group else "Private Chat"
-        }))
-
-    @database_sync_to_async
-    def is_user_online(self):
-        """
-        Check if the user is online.
-        :return: Boolean.
-        """
-        aclose_old_connections()
-        return self.user in self.chat.users_online.all()
+        await self.send_frame(event)
 
-    @database_sync_to_async
-    def add_user_online(self):
-        """
-        Add the user to chat's users_online field.
+    async def presence_delta(self, event):
         """
-        aclose_old_connections()
-        self.chat.users_online.add(self.user)
-
-    @database_sync_to_async
-    def remove_user_online(self):
+        Called when users of the chat come online or go offline.
         """
-        Remove the user from chat's users_online field.
-        """
-        aclose_old_connections()
-        self.chat.users_online.remove(self.user)
+        # Send a message to WebSocket
+        await self.send_frame(event)
 
-    @database_sync_to_async
-    def get_online_users(self):
+    async def send_presence_snapshot(self):
         """
-        Get a list of online users.
-        :return: List of online users.
+        Send the online users of the chat and their version to this connection.
         """
-        aclose_old_connections()
-        return [user.username for user in self.chat.users_online.all()]
+        online_users, version, expired = await self.presence.snapshot(self.conversation)
+        get_broadcaster().publish(self.conversation, expired)
+        await self.send_payload({
+            'type': 'online_users',
+            'online_users': online_users,
+            'version': version,
+            'chat_name': self.membership.display_name,
+        })
 
-    @database_sync_to_async
-    def get_chat_instance(self):
+    async def heartbeat(self):
         """
-        Get chat instance.
-        :return: Chat instance.
+        Keep the presence of this connection alive while the socket is open.
         """
-        aclose_old_connections()
-        return Chat.objects.get(id=self.conversation)
+        interval = self.presence.ttl / 3
+        while True:
+            await asyncio.sleep(interval)
+            await self.presence.heartbeat(self.conversation, self.user.username, self.channel_name)
 
 
-class NotificationConsumer(AsyncWebsocketConsumer):
+class NotificationConsumer(WireProtocolMixin, AsyncWebsocketConsumer):
     """
     NotificationConsumer handles WebSocket connections and messages.
     """
@@ -277,7 +270,12 @@ class NotificationConsumer(AsyncWebsocketConsumer):
             await self.close()
             return
 
-        self.user_group_name = f"user_{self.user.id}_notifications"
+        self.user_group_name = notification_group(self.user.id)
+
+        # Every page keeps this socket open, so it marks the user as online for email digests
+        self.presence = get_presence()
+        await self.presence.join(SITE, self.user.username, self.channel_name)
+        self.heartbeat_task = asyncio.create_task(self.heartbeat())
 
         # Add user to the group
         await self.channel_layer.group_add(self.user_group_name, self.channel_name)
@@ -287,26 +285,83 @@ class NotificationConsumer(AsyncWebsocketConsumer):
         """
         Called when the WebSocket closes for any reason.
         """
-        await self.channel_layer.group_discard(self.user_group_name, self.channel_name)
+        if hasattr(self, "heartbeat_task"):
+            self.heartbeat_task.cancel()
+
+        if hasattr(self, "presence"):
+            await self.presence.leave(SITE, self.user.username, self.channel_name)
+
+        if hasattr(self, "user_group_name"):
+            await self.channel_layer.group_discard(self.user_group_name, self.channel_name)
+
+    async def heartbeat(self):
+        """
+        Keep the site presence of this connection alive while the socket is open.
+        """
+        interval = self.presence.ttl / 3
+        while True:
+            await asyncio.sleep(interval)
+            await self.presence.heartbeat(SITE, self.user.username, self.channel_name)
 
     async def notify(self, event):
         """
         Called when a message is received from a room group.
         """
         message = event.get("message", "")
-        recipient = event.get("recipient", "")
+        recipient = event.get("recipient") or self.user.username
         sender = event.get("sender", "")
 
         if sender != "":
             # Send a message to WebSocket
-            await self.send(text_data=json.dumps({
+            await self.send_payload({
                 'message': message,
                 'recipient': recipient,
-                'sender': sender
-            }))
+                'sender': sender,
+                'chat_id': event.get("chat_id"),
+                'chat': event.get("chat"),
+                'count': event.get("count"),
+            })
+
+
+class InboxConsumer(WireProtocolMixin, AsyncWebsocketConsumer):
+    """
+    InboxConsumer keeps the chat list of a user up to date.
+    """
+
+    async def connect(self):
+        """
+        Called when the websocket is handshaking as part of the connection process.
+        """
+        self.user = self.scope['user']
+
+        if self.user.is_anonymous:
+            # If the user is not authenticated, close the connection
+            await self.close()
+            return
+
+        self.user_group_name = inbox_group(self.user.id)
+
+        # Add user to the group
+        await self.channel_layer.group_add(self.user_group_name, self.channel_name)
+        await self.accept()
+
+    async def disconnect(self, close_code):
+        """
+        Called when the WebSocket closes for any reason.
+        """
+        if hasattr(self, "user_group_name"):
+            await self.channel_layer.group_discard(self.user_group_name, self.channel_name)
+
+    async def inbox_update(self, event):
+        """
+        Called when one of the user's chats changes.
+        :param event: Received event with a pre-serialized frame
+        """
+        # Send a message to WebSocket
+        await self.send_frame(event)
 
 
-class FriendRequestsConsumer(AsyncWebsocketConsumer):
+class FriendRequestsConsumer(WireProtocolMixin, AsyncWebsocketConsumer):
     """
     FriendRequestsConsumer handles WebSocket connections and messages.
     """
@@ -331,14 +386,13 @@ class FriendRequestsConsumer(AsyncWebsocketConsumer):
         """
         await self.channel_layer.group_discard(self.user_group_name, self.channel_name)
 
-    async def receive(self, text_data=None):
-        text_data_json = json.loads(text_data)
-        recipient = text_data_json.get("recipient", None)
+    async def receive_payload(self, data):
+        recipient = data.get("recipient", None)
 
         recipient = await self.get_user(recipient)
 
         await self.channel_layer.group_send(
-            f"user_{recipient.id}_notifications",
+            notification_group(recipient.id),
             {
                 'type': 'notify',
                 'message': f"New Friend Request",
@@ -0,0 +1,72 @@
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from chat.inbox import membership_changed
+from chat.membership import invalidate_membership
+from chat.models import Chat, ChatDeletionJob, Message, Attachment, chat_storage
+
+
+def delete_chat(chat):
+    """
+    Hide a chat right away and create the job purging its history.
+    Members see the chat leave their inbox once the deletion commits.
+    :param chat: Chat instance
+    :return: ChatDeletionJob
+    """
+    with transaction.atomic():
+        Chat.all_objects.filter(pk=chat.pk).update(deleted_at=timezone.now())
+        job, _ = ChatDeletionJob.objects.get_or_create(chat_id=chat.pk)
+        membership_changed(chat.pk, removed=chat.members.values_list("id", flat=True))
+    invalidate_membership(chat.pk)
+    return job
+
+
+def _delete_batch(job, queryset, counter):
+    """
+    Delete one batch of rows and record it in the job, in one transaction.
+    :return: Number of rows deleted, 0 once nothing is left.
+    """
+    with transaction.atomic():
+        rows = list(queryset.order_by("id")[:settings.CHAT_DELETION_BATCH_SIZE])
+        if not rows:
+            return 0
+        names = [row.file.name for row in rows]
+        names += [row.thumbnail.name for row in rows if isinstance(row, Attachment)]
+        # Files are released by the post_delete signal
+        queryset.filter(id__in=[row.id for row in rows]).delete()
+        files_deleted = chat_storage().delete_unreferenced(names)
+        ChatDeletionJob.objects.filter(pk=job.pk).update(**{
+            counter: F(counter) + len(rows),
+            "files_deleted": F("files_deleted") + files_deleted,
+            "updated_at": timezone.now(),
+        })
+    return len(rows)
+
+
+def purge_chat(job):
+    """
+    Delete the messages, attachments and files of a deleted chat in bounded
+    batches, then the chat itself. Every batch is committed with the job
+    progress, so a crashed purge continues with the next batch.
+    :param job: ChatDeletionJob
+    """
+    ChatDeletionJob.objects.filter(pk=job.pk).update(status=ChatDeletionJob.Status.RUNNING, updated_at=timezone.now())
+    while _delete_batch(job, Message.objects.filter(chat_id=job.chat_id), "messages_deleted"):
+        pass
+    while _delete_batch(job, Attachment.objects.filter(chat_id=job.chat_id), "attachments_deleted"):
+        pass
+    with transaction.atomic():
+        Chat.all_objects.filter(pk=job.chat_id).delete()
+        ChatDeletionJob.objects.filter(pk=job.pk).update(
+            status=ChatDeletionJob.Status.DONE, finished_at=timezone.now(), updated_at=timezone.now()
+        )
+
+
+def stalled_jobs():
+    """
+    Unfinished jobs without progress for CHAT_DELETION_RESUME_AFTER seconds.
+    """
+    stalled = timezone.now() - timedelta(seconds=settings.CHAT_DELETION_RESUME_AFTER)
+    return ChatDeletionJob.objects.exclude(status=ChatDeletionJob.Status.DONE).filter(updated_at__lt=stalled)
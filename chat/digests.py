@@ -0,0 +1,87 @@
+from datetime import timedelta
+from itertools import groupby
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db.models import F
+from django.template.loader import render_to_string
+from django.utils import timezone
+from chat.models import InboxSummary
+from chat.presence import get_presence, SITE
+
+
+def online_usernames():
+    """
+    Get the usernames of users with an open notification socket.
+    """
+    users, _, _ = async_to_sync(get_presence().snapshot)(SITE)
+    return set(users)
+
+
+def pending_summaries():
+    """
+    Summaries with unread activity that no digest has covered yet and that
+    has been waiting for at least CHAT_DIGEST_DELAY seconds, grouped by user.
+    """
+    settled = timezone.now() - timedelta(seconds=settings.CHAT_DIGEST_DELAY)
+    return InboxSummary.objects.filter(
+        unread_count__gt=0,
+        last_message_id__gt=F('digested_message_id'),
+        last_message_at__lte=settled,
+        user__is_active=True,
+        chat__deleted_at__isnull=True,
+    ).select_related('user', 'chat').order_by('user_id', '-last_message_at')
+
+
+def build_digest(user, summaries):
+    """
+    Build the digest email of one user.
+    :param user: User object
+    :param summaries: list of the user's pending summaries
+    :return: EmailMessage
+    """
+    body = render_to_string('chat/digest-email.html', {
+        'user': user,
+        'summaries': summaries,
+        'unread_count': sum(summary.unread_count for summary in summaries),
+        'domain': settings.CHAT_DIGEST_DOMAIN,
+    })
+    email = EmailMessage('Unread messages', body, to=[user.email])
+    email.content_subtype = 'html'
+    return email
+
+
+def send_digests(batch_size=100):
+    """
+    Email every offline user a digest of their unread chats.
+    Emails are sent in batches over a single SMTP connection and the
+    covered summaries are marked right after each batch.
+    :return: Number of digests sent.
+    """
+    online = online_usernames()
+    sent = 0
+    emails = []
+    covered = []
+    with get_connection() as connection:
+        for _, summaries in groupby(pending_summaries().iterator(), key=lambda summary: summary.user_id):
+            summaries = list(summaries)
+            user = summaries[0].user
+            if user.username in online:
+                continue
+            emails.append(build_digest(user, summaries))
+            covered += summaries
+            if len(emails) >= batch_size:
+                sent += _send_batch(connection, emails, covered)
+                emails, covered = [], []
+        sent += _send_batch(connection, emails, covered)
+    return sent
+
+
+def _send_batch(connection, emails, covered):
+    if not emails:
+        return 0
+    sent = connection.send_messages(emails)
+    for summary in covered:
+        summary.digested_message_id = summary.last_message_id
+    InboxSummary.objects.bulk_update(covered, ['digested_message_id'])
+    return sent
@@ -0,0 +1,80 @@
+from chat.protocol import encode_frame
+
+
+def chat_message_event(message_id, message, username, attachment):
+    """
+    Build a chat_message group event.
+    The frame is serialized once here and forwarded unchanged by every
+    consumer in the group.
+    :param message_id: message id
+    :param message: message text
+    :param username: author's username
+    :param attachment: serialized attachment or None
+    :return: Event dictionary
+    """
+    return encode_frame('chat_message', {
+        'id': message_id,
+        'message': message,
+        'username': username,
+        'file': attachment['url'] if attachment else None,
+        'attachment': attachment,
+    })
+
+
+def presence_delta_event(changes):
+    """
+    Build a presence_delta group event.
+    :param changes: list of [version, "join" | "leave", username], oldest first
+    :return: Event dictionary
+    """
+    return encode_frame('presence_delta', {
+        'type': 'presence_delta',
+        'changes': changes,
+    })
+
+
+def read_receipts_event(receipts):
+    """
+    Build a read_receipts group event.
+    :param receipts: dictionary of username to the id of the last read message
+    :return: Event dictionary
+    """
+    return encode_frame('read_receipts', {
+        'type': 'read_receipts',
+        'receipts': receipts,
+    })
+
+
+def inbox_message_event(chat_id, message_id, username, preview, created_at):
+    """
+    Build an inbox_update event for a new last message of a chat.
+    :param chat_id: chat id
+    :param message_id: message id
+    :param username: author's username
+    :param preview: short text of the message
+    :param created_at: ISO formatted creation time
+    :return: Event dictionary
+    """
+    return encode_frame('inbox_update', {
+        'type': 'inbox_message',
+        'chat_id': chat_id,
+        'message_id': message_id,
+        'username': username,
+        'preview': preview,
+        'created_at': created_at,
+    })
+
+
+def inbox_chat_event(chat_id, action):
+    """
+    Build an inbox_update event for a chat the user joined, left or
+    whose members changed.
+    :param chat_id: chat id
+    :param action: "added", "removed" or "changed"
+    :return: Event dictionary
+    """
+    return encode_frame('inbox_update', {
+        'type': 'inbox_chat',
+        'chat_id': chat_id,
+        'action': action,
+    })
@@ -1,5 +1,8 @@
+import uuid
 from django import forms
-from chat.models import Chat
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from chat.models import Chat, Attachment
 from user.models import User
 
 
@@ -18,4 +21,46 @@ class ChatCreationForm(forms.ModelForm):
 class ChatDeletionForm(forms.ModelForm):
     class Meta:
         model = Chat
-        fields = []
\ No newline at end of file
+        fields = []
+
+
+class AttachmentForm(forms.ModelForm):
+    IMAGE_EXTENSIONS = ['png', 'jpg', 'jpeg', 'gif', 'svg', 'webp']
+    MIME_TYPE_MAP = {
+        'application/pdf': 'pdf',
+        'application/msword': 'doc',
+        'application/vnd.openxmlformats-officedocument.wordprocessingml.document': 'docx',
+        'text/plain': 'txt',
+        'application/zip': 'zip',
+    }
+
+    class Meta:
+        model = Attachment
+        fields = ["file"]
+
+    def clean_file(self):
+        file = self.cleaned_data.get("file")
+        if file.size > settings.CHAT_ATTACHMENT_MAX_SIZE:
+            raise ValidationError("File is too large")
+        return file
+
+    def save(self, commit=True):
+        """
+        Store the upload under a name with a safe extension, keeping the
+        original name and type as metadata. The chat storage replaces the
+        name with the digest of the content.
+        """
+        attachment = super().save(commit=False)
+        file = self.cleaned_data["file"]
+        content_type = file.content_type or 'application/octet-stream'
+        ext = content_type.split('/')[-1]
+        if ext not in self.IMAGE_EXTENSIONS:
+            ext = self.MIME_TYPE_MAP.get(content_type, 'txt')
+
+        attachment.name = file.name
+        attachment.content_type = content_type
+        attachment.size = file.size
+        attachment.file.name = f"{uuid.uuid4()}.{ext}"
+        if commit:
+            attachment.save()
+        return attachment
@@ -0,0 +1,132 @@
+from datetime import datetime
+from django.conf import settings
+from django.core.cache import cache
+from django.core.cache.utils import make_template_fragment_key
+from django.db.models import Q
+from django.utils.functional import cached_property
+from chat.models import Message, InboxSummary
+
+
+def encode_cursor(message):
+    """
+    Encode the position of a message as an opaque cursor.
+    :param message: Message instance
+    :return: Cursor string
+    """
+    return f"{message.created_at.isoformat()}|{message.id}"
+
+
+def decode_cursor(cursor):
+    """
+    Decode a cursor produced by encode_cursor.
+    :param cursor: Cursor string
+    :return: Tuple of (created_at, id) or None if the cursor is invalid.
+    """
+    try:
+        created_at, message_id = cursor.rsplit("|", 1)
+        return datetime.fromisoformat(created_at), int(message_id)
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+def serialize_attachment(attachment):
+    """
+    Convert an attachment into a JSON friendly dictionary.
+    :param attachment: Attachment instance
+    :return: Dictionary
+    """
+    ready = attachment.renditions == attachment.Renditions.READY
+    return {
+        'id': attachment.id,
+        'url': attachment.file.url,
+        'name': attachment.name,
+        'content_type': attachment.content_type,
+        'size': attachment.size,
+        'width': attachment.width,
+        'height': attachment.height,
+        'thumbnail': attachment.thumbnail.url if ready else None,
+        'placeholder': attachment.placeholder if ready else None,
+    }
+
+
+def serialize_message(message):
+    """
+    Convert a message into a JSON friendly dictionary.
+    :param message: Message instance with the author and attachment loaded
+    :return: Dictionary
+    """
+    return {
+        'id': message.id,
+        'username': message.author.username,
+        'text': message.text,
+        'file': message.file.url if message.file else None,
+        'attachment': serialize_attachment(message.attachment) if message.attachment else None,
+        'created_at': message.created_at.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+
+
+def get_history_page(chat_id, before=None, limit=None):
+    """
+    Get a page of messages older than the cursor, oldest first.
+    Pages are taken from the (chat, created_at, id) index, so the
+    cost does not depend on the size of the chat.
+    :param chat_id: chat id
+    :param before: cursor of the oldest message the client already has
+    :param limit: page size
+    :return: Tuple of (list of messages, cursor of the next page or None)
+    """
+    limit = limit or settings.CHAT_HISTORY_PAGE_SIZE
+    queryset = Message.objects.filter(chat_id=chat_id)
+
+    position = decode_cursor(before) if before else None
+    if position is not None:
+        created_at, message_id = position
+        queryset = queryset.filter(
+            Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=message_id)
+        )
+
+    page = list(
+        queryset.select_related("author", "attachment").order_by("-created_at", "-id")[:limit + 1]
+    )
+    has_more = len(page) > limit
+    page = page[:limit]
+    page.reverse()
+
+    next_cursor = encode_cursor(page[0]) if has_more else None
+    return page, next_cursor
+
+
+class HistoryPage:
+    """
+    Newest page of a chat, loaded only when a template renders it, so a
+    cached message list costs no query at all.
+    """
+
+    def __init__(self, chat_id):
+        self.chat_id = chat_id
+
+    @cached_property
+    def _page(self):
+        return get_history_page(self.chat_id)
+
+    @property
+    def messages(self):
+        return self._page[0]
+
+    @property
+    def next_cursor(self):
+        return self._page[1]
+
+
+def expire_message_pages(chat_id):
+    """
+    Drop the cached message lists of a chat. They are keyed by each member's
+    view of the last message, see conversation.html.
+    :param chat_id: chat id
+    """
+    cache.delete_many([
+        make_template_fragment_key("chat_messages", [chat_id, last_message_id, user_id])
+        for user_id, last_message_id in InboxSummary.objects.filter(chat_id=chat_id).values_list(
+            "user_id", "last_message_id"
+        )
+    ])
@@ -0,0 +1,156 @@
+import operator
+from collections import Counter, defaultdict
+from functools import reduce
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Q, Value, When
+from django.utils.text import Truncator
+from chat.events import inbox_chat_event
+from chat.layers import group_send_many
+from chat.models import Chat, InboxSummary, Message, ReadMarker
+
+PREVIEW_LENGTH = 100
+
+
+def preview(message):
+    """
+    Short text shown for a message in the inbox.
+    """
+    if message.text:
+        return Truncator(message.text).chars(PREVIEW_LENGTH)
+    if message.attachment_id or message.file:
+        return "Attachment"
+    return ""
+
+
+def snapshot(message):
+    """
+    Last message fields of a summary.
+    :param message: Message or None
+    """
+    if message is None:
+        return {'last_message_id': None, 'last_message_preview': "", 'last_message_at': None}
+    return {
+        'last_message_id': message.id,
+        'last_message_preview': preview(message),
+        'last_message_at': message.created_at,
+    }
+
+
+def record_messages(messages):
+    """
+    Update the summaries of every member for newly stored messages.
+    Must run in the transaction that inserts the messages. Costs one
+    update per chat, however many messages or members it has.
+    :param messages: list of saved messages, oldest first
+    """
+    by_chat = defaultdict(list)
+    for message in messages:
+        by_chat[message.chat_id].append(message)
+
+    for chat_id, chat_messages in by_chat.items():
+        total = len(chat_messages)
+        # Members do not get unread messages for what they wrote themselves
+        authored = Counter(message.author_id for message in chat_messages)
+        unread = Case(
+            *[When(user_id=author_id, then=Value(total - count)) for author_id, count in authored.items()],
+            default=Value(total),
+            output_field=IntegerField(),
+        )
+        InboxSummary.objects.filter(chat_id=chat_id).update(
+            unread_count=F('unread_count') + unread,
+            **snapshot(chat_messages[-1]),
+        )
+
+
+def record_reads(markers, latest):
+    """
+    Recount unread messages of members whose read markers moved.
+    Must run in the transaction that stores the markers. Members who read
+    up to the newest message are reset in a single update.
+    :param markers: list of ReadMarker
+    :param latest: dictionary of chat id to the id of its newest message
+    """
+    caught_up = []
+    for marker in markers:
+        if marker.last_read_message_id >= latest.get(marker.chat_id, 0):
+            caught_up.append(Q(chat_id=marker.chat_id, user_id=marker.user_id))
+            continue
+        unread = Message.objects.filter(
+            chat_id=marker.chat_id, id__gt=marker.last_read_message_id
+        ).exclude(author_id=marker.user_id).count()
+        InboxSummary.objects.filter(chat_id=marker.chat_id, user_id=marker.user_id).update(unread_count=unread)
+    if caught_up:
+        InboxSummary.objects.filter(reduce(operator.or_, caught_up)).update(unread_count=0)
+
+
+def build_summaries(chat_id, user_ids):
+    """
+    Compute summaries of a chat from scratch.
+    :param chat_id: chat id
+    :param user_ids: ids of the members to build summaries for
+    :return: list of unsaved InboxSummary
+    """
+    last_message = Message.objects.filter(chat_id=chat_id).order_by('-id').first()
+    markers = dict(
+        ReadMarker.objects.filter(chat_id=chat_id, user_id__in=user_ids)
+        .values_list('user_id', 'last_read_message_id')
+    )
+
+    summaries = []
+    for user_id in user_ids:
+        last_read = markers.get(user_id, 0)
+        unread = 0
+        if last_message is not None and last_message.id > last_read:
+            unread = Message.objects.filter(
+                chat_id=chat_id, id__gt=last_read
+            ).exclude(author_id=user_id).count()
+        summaries.append(InboxSummary(
+            chat_id=chat_id,
+            user_id=user_id,
+            unread_count=unread,
+            # Email digests only cover activity from now on
+            digested_message_id=last_message.id if last_message else 0,
+            **snapshot(last_message),
+        ))
+    return summaries
+
+
+def add_summaries(chat_id, user_ids):
+    """
+    Create summaries for members that joined a chat.
+    """
+    InboxSummary.objects.bulk_create(build_summaries(chat_id, user_ids), ignore_conflicts=True)
+
+
+def inbox_group(user_id):
+    return f"user_{user_id}_inbox"
+
+
+def send_inbox_event(user_ids, event):
+    """
+    Send an event to the inboxes of users once the current transaction
+    commits, so clients never fetch state that is not visible yet.
+    :param user_ids: iterable of user ids
+    :param event: event dictionary
+    """
+    groups = [inbox_group(user_id) for user_id in user_ids]
+    if not groups:
+        return
+    transaction.on_commit(lambda: async_to_sync(group_send_many)(get_channel_layer(), groups, event))
+
+
+def membership_changed(chat_id, added=(), removed=()):
+    """
+    Tell members about a chat they joined or left, and everyone else in
+    the chat that its members changed.
+    :param chat_id: chat id
+    :param added: ids of users that joined
+    :param removed: ids of users that left
+    """
+    added, removed = set(added), set(removed)
+    members = set(Chat.members.through.objects.filter(chat_id=chat_id).values_list("user_id", flat=True))
+    send_inbox_event(added, inbox_chat_event(chat_id, "added"))
+    send_inbox_event(removed, inbox_chat_event(chat_id, "removed"))
+    send_inbox_event(members - added - removed, inbox_chat_event(chat_id, "changed"))
@@ -0,0 +1,111 @@
+import asyncio
+import collections
+import logging
+import time
+from channels.layers import InMemoryChannelLayer
+
+try:
+    from channels_redis.core import RedisChannelLayer
+except ImportError:  # channels_redis is optional for single-node setups
+    RedisChannelLayer = None
+
+logger = logging.getLogger(__name__)
+
+
+# Same script channels_redis uses for group_send, it appends the message to
+# every channel that still has capacity.
+GROUP_SEND_LUA = """
+    local over_capacity = 0
+    local current_time = ARGV[#ARGV - 1]
+    local expiry = ARGV[#ARGV]
+    for i=1,#KEYS do
+        if redis.call('ZCOUNT', KEYS[i], '-inf', '+inf') < tonumber(ARGV[i + #KEYS]) then
+            redis.call('ZADD', KEYS[i], current_time, ARGV[i])
+            redis.call('EXPIRE', KEYS[i], expiry)
+        else
+            over_capacity = over_capacity + 1
+        end
+    end
+    return over_capacity
+"""
+
+
+def is_redis_layer(channel_layer):
+    """
+    Check whether the channel layer keeps its state in Redis.
+    """
+    return RedisChannelLayer is not None and isinstance(channel_layer, RedisChannelLayer)
+
+
+async def group_send_many(channel_layer, groups, message):
+    """
+    Send one message to many groups.
+    With Redis, the members of every group are read in one pipeline per
+    shard and the message is written to all of their channels in one more,
+    so the cost does not grow with the number of groups.
+    :param channel_layer: channel layer
+    :param groups: iterable of group names
+    :param message: event dictionary
+    :return: None
+    """
+    groups = list(groups)
+    if not groups:
+        return
+
+    if is_redis_layer(channel_layer):
+        await _redis_group_send_many(channel_layer, groups, message)
+    elif isinstance(channel_layer, InMemoryChannelLayer):
+        # Local sends never leave the process, a plain loop is the cheapest option
+        for group in groups:
+            await channel_layer.group_send(group, message)
+    else:
+        await asyncio.gather(*(channel_layer.group_send(group, message) for group in groups))
+
+
+async def _redis_group_send_many(channel_layer, groups, message):
+    for group in groups:
+        assert channel_layer.valid_group_name(group), "Group name not valid"
+
+    # Read the members of every group, one pipeline per shard
+    shard_groups = collections.defaultdict(list)
+    for group in groups:
+        shard_groups[channel_layer.consistent_hash(group)].append(group)
+
+    channel_names = []
+    for index, shard in shard_groups.items():
+        pipe = channel_layer.connection(index).pipeline(transaction=False)
+        for group in shard:
+            key = channel_layer._group_key(group)
+            pipe.zremrangebyscore(key, min=0, max=int(time.time()) - channel_layer.group_expiry)
+            pipe.zrange(key, 0, -1)
+        results = await pipe.execute()
+        for members in results[1::2]:
+            channel_names.extend(member.decode("utf8") for member in members)
+
+    if not channel_names:
+        return
+
+    (
+        connection_to_channel_keys,
+        channel_keys_to_message,
+        channel_keys_to_capacity,
+    ) = channel_layer._map_channel_keys_to_connection(channel_names, message)
+
+    # Deliver to every channel, one pipeline per shard
+    for index, channel_redis_keys in connection_to_channel_keys.items():
+        now = time.time()
+        pipe = channel_layer.connection(index).pipeline(transaction=False)
+        for key in channel_redis_keys:
+            pipe.zremrangebyscore(key, min=0, max=int(now) - int(channel_layer.expiry))
+        args = [channel_keys_to_message[key] for key in channel_redis_keys]
+        args += [channel_keys_to_capacity[key] for key in channel_redis_keys]
+        args += [now, channel_layer.expiry]
+        pipe.eval(GROUP_SEND_LUA, len(channel_redis_keys), *channel_redis_keys, *args)
+        results = await pipe.execute()
+        if results[-1] > 0:
+            logger.info(
+                "%s of %s channels over capacity in %s groups",
+                results[-1],
+                len(channel_names),
+                len(groups),
+            )
@@ -0,0 +1,82 @@
+import asyncio
+import json
+import time
+from django.core.management.base import BaseCommand
+from chat.consumers import ChatConsumer
+from chat.events import chat_message_event
+
+
+class BenchConsumer(ChatConsumer):
+    """
+    ChatConsumer that drops outgoing frames instead of writing to a socket.
+    """
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        pass
+
+    async def legacy_chat_message(self, event):
+        """
+        The handler as it was before frames were serialized once.
+        """
+        await self.send(text_data=json.dumps({
+            'message': event["message"],
+            'username': event["username"],
+            'file': event["file"],
+            'attachment': event["attachment"],
+        }))
+
+
+class Command(BaseCommand):
+    help = "Measure the CPU cost of delivering one chat message to groups of growing size."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", type=int, nargs="+", default=[10, 50, 100, 500, 1000])
+        parser.add_argument("--messages", type=int, default=200)
+
+    def handle(self, *args, **options):
+        attachment = {
+            'id': 1,
+            'url': '/media/chat_files/example.png',
+            'name': 'example.png',
+            'content_type': 'image/png',
+            'size': 1024,
+        }
+        text = "Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * 4
+        legacy_event = {
+            'type': 'chat_message',
+            'message': text,
+            'username': 'bench',
+            'file': attachment['url'],
+            'attachment': attachment,
+        }
+
+        self.stdout.write(f"{'members':>8} {'per-member (us)':>16} {'serialize-once (us)':>20} {'speedup':>8}")
+        for size in options["sizes"]:
+            consumers = [BenchConsumer() for _ in range(size)]
+            legacy = self.measure(options["messages"], lambda: self.per_member(consumers, legacy_event))
+            current = self.measure(options["messages"], lambda: self.serialize_once(consumers, text, attachment))
+            self.stdout.write(f"{size:>8} {legacy:>16.1f} {current:>20.1f} {legacy / current:>7.1f}x")
+
+    @staticmethod
+    async def per_member(consumers, event):
+        for consumer in consumers:
+            await consumer.legacy_chat_message(event)
+
+    @staticmethod
+    async def serialize_once(consumers, text, attachment):
+        event = chat_message_event(None, text, 'bench', attachment)
+        for consumer in consumers:
+            await consumer.chat_message(event)
+
+    @staticmethod
+    def measure(messages, deliver):
+        """
+        CPU time in microseconds spent delivering one message to the whole group.
+        """
+        async def run():
+            for _ in range(messages):
+                await deliver()
+
+        start = time.process_time()
+        asyncio.run(run())
+        return (time.process_time() - start) / messages * 1_000_000
@@ -0,0 +1,74 @@
+import asyncio
+import time
+import uuid
+from functools import partial
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from chat.models import Chat, Message
+from chat.writer import MessageWriter, store_messages
+from user.models import User
+
+
+class Command(BaseCommand):
+    help = "Compare sustained message inserts per second with and without the write-behind writer."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--senders", type=int, default=50)
+        parser.add_argument("--messages", type=int, default=40, help="Messages per sender")
+
+    def handle(self, *args, **options):
+        suffix = uuid.uuid4().hex[:8]
+        user = User.objects.create_user(
+            username=f"bench_{suffix}",
+            first_name="Bench",
+            last_name="User",
+            email=f"bench_{suffix}@example.com",
+            password=None,
+        )
+        chat = Chat.objects.create(name="Benchmark")
+        chat.members.add(user)
+
+        try:
+            total = options["senders"] * options["messages"]
+            direct = asyncio.run(self.run(chat, user, options, self.direct))
+            writer = MessageWriter(
+                batch_size=settings.CHAT_WRITE_BEHIND_BATCH_SIZE,
+                interval=settings.CHAT_WRITE_BEHIND_INTERVAL_MS / 1000,
+                max_pending=settings.CHAT_WRITE_BEHIND_MAX_PENDING,
+                retries=settings.CHAT_WRITE_BEHIND_RETRIES,
+                retry_delay=settings.CHAT_WRITE_BEHIND_RETRY_DELAY_MS / 1000,
+            )
+            buffered = asyncio.run(self.run(chat, user, options, partial(self.buffered, writer), writer.close))
+
+            self.stdout.write(f"{total} messages from {options['senders']} concurrent senders")
+            self.stdout.write(f"direct inserts: {total / direct:>10.0f} msg/s")
+            self.stdout.write(f"write-behind:   {total / buffered:>10.0f} msg/s")
+            self.stdout.write(f"stored rows:    {Message.objects.filter(chat=chat).count():>10}")
+        finally:
+            chat.delete()
+            user.delete()
+
+    @staticmethod
+    async def direct(message):
+        await database_sync_to_async(store_messages)([message])
+
+    @staticmethod
+    async def buffered(writer, message):
+        # Senders wait for the batch holding their message, as consumers do
+        await (await writer.put(message))
+
+    @staticmethod
+    async def run(chat, user, options, write, close=None):
+        """
+        Wall time in seconds until every message is stored.
+        """
+        async def sender(number):
+            for i in range(options["messages"]):
+                await write(Message(chat=chat, author=user, text=f"{number}:{i}"))
+
+        start = time.perf_counter()
+        await asyncio.gather(*(sender(number) for number in range(options["senders"])))
+        if close is not None:
+            await close()
+        return time.perf_counter() - start
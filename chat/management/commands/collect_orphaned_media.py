@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from chat.orphans import collect_orphaned_media
+
+
+class Command(BaseCommand):
+    help = "Delete chat files and avatars that nothing refers to anymore."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true", help="Only report what would be deleted.")
+        parser.add_argument("--grace", type=int, help="Keep files younger than this many seconds.")
+
+    def handle(self, *args, **options):
+        report = collect_orphaned_media(dry_run=options["dry_run"], grace=options["grace"])
+        prefix = "Would delete: " if options["dry_run"] else "Deleted: "
+        self.stdout.write(self.style.SUCCESS(prefix + str(report)))
@@ -0,0 +1,94 @@
+import os
+import shutil
+from collections import Counter
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from chat.models import Attachment, Message, StoredBlob, chat_storage
+from chat.storage import blob_name, hash_file
+
+# Every file field that holds a chat storage name
+FILE_FIELDS = [(Attachment, "file"), (Attachment, "thumbnail"), (Message, "file")]
+
+
+def referenced_names():
+    """
+    Count the rows referring to each stored name.
+    """
+    counts = Counter()
+    for model, field in FILE_FIELDS:
+        counts.update(
+            model.objects.exclude(**{f"{field}__isnull": True}).exclude(**{field: ""})
+            .values_list(field, flat=True).iterator()
+        )
+    return counts
+
+
+class Command(BaseCommand):
+    help = "Move chat files to content addressed names, storing each distinct content once, and recount references."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true", help="Only report what would be deduplicated.")
+
+    def handle(self, *args, **options):
+        dry_run = options["dry_run"]
+        storage = chat_storage()
+        blobs = dict(StoredBlob.objects.values_list("digest", "name"))
+        stored = set(blobs.values())
+        moved = missing = reclaimed = 0
+
+        for name in sorted(referenced_names()):
+            if name in stored:
+                continue
+            if not storage.exists(name):
+                missing += 1
+                continue
+            with storage.open(name, "rb") as file:
+                digest = hash_file(file)
+            size = storage.size(name)
+            if digest in blobs:
+                reclaimed += size
+            moved += 1
+            if dry_run:
+                blobs.setdefault(digest, name)
+                continue
+            self.move(storage, name, digest, size, blobs)
+
+        if not dry_run:
+            self.recount()
+        verb = "Would move" if dry_run else "Moved"
+        self.stdout.write(self.style.SUCCESS(
+            f"{verb} {moved} files to content addressed names, reclaiming {reclaimed} bytes; {missing} files are missing"
+        ))
+
+    def move(self, storage, name, digest, size, blobs):
+        """
+        Point every row using name at the blob of its content. The old file
+        is removed only once the rows are updated.
+        """
+        target = blobs.get(digest)
+        if target is None:
+            target = blob_name(name, digest)
+            if not storage.exists(target):
+                path = storage.path(target)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                try:
+                    os.link(storage.path(name), path)
+                except OSError:
+                    shutil.copyfile(storage.path(name), path)
+            StoredBlob.objects.get_or_create(digest=digest, defaults={"name": target, "size": size})
+            blobs[digest] = target
+
+        with transaction.atomic():
+            for model, field in FILE_FIELDS:
+                model.objects.filter(**{field: name}).update(**{field: target})
+        storage.delete(name)
+
+    def recount(self):
+        """
+        Set the reference count of every blob from the rows using it.
+        """
+        counts = referenced_names()
+        blobs = list(StoredBlob.objects.all())
+        for blob in blobs:
+            blob.references = counts.get(blob.name, 0)
+        StoredBlob.objects.bulk_update(blobs, ["references"], batch_size=500)
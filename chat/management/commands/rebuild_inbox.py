@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from chat.inbox import build_summaries
+from chat.models import Chat, InboxSummary
+
+
+class Command(BaseCommand):
+    help = "Rebuild the inbox summaries of every chat member from messages and read markers."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        members = Chat.members.through.objects.order_by("chat_id").values_list("chat_id", "user_id")
+
+        with transaction.atomic():
+            InboxSummary.objects.all().delete()
+
+            by_chat = {}
+            for chat_id, user_id in members.iterator():
+                by_chat.setdefault(chat_id, []).append(user_id)
+
+            summaries = []
+            total = 0
+            for chat_id, user_ids in by_chat.items():
+                summaries += build_summaries(chat_id, user_ids)
+                if len(summaries) >= batch_size:
+                    InboxSummary.objects.bulk_create(summaries)
+                    total += len(summaries)
+                    summaries = []
+            InboxSummary.objects.bulk_create(summaries)
+            total += len(summaries)
+
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {total} inbox summaries of {len(by_chat)} chats"))
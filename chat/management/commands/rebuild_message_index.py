@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+from chat.search import SimpleSearchBackend, SQLiteSearchBackend
+
+
+class Command(BaseCommand):
+    help = "Rebuild the full-text search index of messages."
+
+    def handle(self, *args, **options):
+        # Not get_search_backend, it skips an index missing its triggers
+        backend = SQLiteSearchBackend() if connection.vendor == "sqlite" else SimpleSearchBackend()
+        backend.rebuild()
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt the message index with {type(backend).__name__}"))
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from chat.models import Attachment
+from chat.renditions import needs_renditions
+from chat.tasks import render_attachment
+
+
+class Command(BaseCommand):
+    help = "Queue thumbnails of image attachments uploaded before renditions existed."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--retry", action="store_true", help="Also retry attachments that failed before.")
+
+    def handle(self, *args, **options):
+        states = [Attachment.Renditions.NONE]
+        if options["retry"]:
+            states.append(Attachment.Renditions.FAILED)
+        queued = 0
+        for attachment in Attachment.objects.filter(content_type__startswith="image/", renditions__in=states).iterator():
+            if not needs_renditions(attachment):
+                continue
+            Attachment.objects.filter(id=attachment.id).update(renditions=Attachment.Renditions.PENDING)
+            render_attachment.delay(attachment.id)
+            queued += 1
+        self.stdout.write(self.style.SUCCESS(f"Queued {queued} attachments"))
@@ -0,0 +1,211 @@
+import hashlib
+import mimetypes
+import os
+import posixpath
+import re
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import content_disposition_header, http_date
+from versatileimagefield.settings import VERSATILEIMAGEFIELD_FILTERED_DIRNAME, VERSATILEIMAGEFIELD_SIZED_DIRNAME
+from chat.models import Attachment, Message
+
+CHAT_FILES = "chat_files/"
+PUBLIC_PREFIXES = ("user/images/",)
+
+# Uploads are shown inline only when browsers cannot run scripts from them
+INLINE_TYPES = {"image/png", "image/jpeg", "image/gif", "image/webp"}
+
+# Names given by the content addressed storage end with the sha256 of the file
+DIGEST_NAME = re.compile(r"^[0-9a-f]{64}$")
+RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+CHUNK_SIZE = 64 * 1024
+
+
+def access_key(user_id, name):
+    return f"media:access:{user_id}:{hashlib.sha256(name.encode()).hexdigest()}"
+
+
+def source_names(name):
+    """
+    Get the names of the files a versatileimagefield rendition may have
+    been made of: sized renditions live under __sized__/ with the size key
+    after a "-", filtered ones in a __filtered__ directory with the filter
+    key between "__". Keys contain the separators too, so every split is a
+    candidate. A name that is not a rendition is its own source.
+    :param name: storage name of the file
+    :return: Set of names
+    """
+    names = {name}
+    sized = VERSATILEIMAGEFIELD_SIZED_DIRNAME + "/"
+    if name.startswith(sized):
+        directory, filename = posixpath.split(name[len(sized):])
+        stem, extension = posixpath.splitext(filename)
+        parts = stem.split("-")
+        names = {posixpath.join(directory, "-".join(parts[:i]) + extension) for i in range(1, len(parts))}
+    sources = set()
+    for candidate in names:
+        directory, filename = posixpath.split(candidate)
+        if posixpath.basename(directory) != VERSATILEIMAGEFIELD_FILTERED_DIRNAME:
+            sources.add(candidate)
+            continue
+        stem, extension = posixpath.splitext(filename)
+        parts = stem.split("__")
+        sources |= {
+            posixpath.join(posixpath.dirname(directory), "__".join(parts[:i]) + extension)
+            for i in range(1, len(parts) - 1)
+        }
+    return sources
+
+
+def can_access(user, name):
+    """
+    Check whether a user may download a media file or a rendition of it.
+    Chat files are only served to members of a chat using them, granted
+    access is cached for MEDIA_ACCESS_CACHE_TTL seconds. Profile images
+    are served to every signed in user.
+    :param user: User object
+    :param name: storage name of the file
+    :return: True if the user may download the file
+    """
+    if posixpath.normpath(name) != name:
+        return False
+    sources = source_names(name)
+    if any(source.startswith(PUBLIC_PREFIXES) for source in sources):
+        return True
+    sources = [source for source in sources if source.startswith(CHAT_FILES)]
+    if not sources:
+        return False
+    key = access_key(user.id, name)
+    if cache.get(key):
+        return True
+    in_chats = Q(chat__members=user, chat__deleted_at__isnull=True)
+    allowed = (
+        Attachment.objects.filter(Q(file__in=sources) | Q(thumbnail__in=sources), in_chats).exists()
+        or Message.objects.filter(in_chats, file__in=sources).exists()
+    )
+    if allowed:
+        cache.set(key, True, settings.MEDIA_ACCESS_CACHE_TTL)
+    return allowed
+
+
+def is_content_addressed(name):
+    return DIGEST_NAME.match(os.path.splitext(os.path.basename(name))[0]) is not None
+
+
+def file_etag(name, stat):
+    """
+    Strong ETag of a file: its digest when the name holds one, otherwise
+    its modification time and size.
+    """
+    if is_content_addressed(name):
+        return f'"{os.path.splitext(os.path.basename(name))[0]}"'
+    return f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+
+
+def parse_range(header, size):
+    """
+    Parse a single byte range of a Range header.
+    :param header: value of the Range header
+    :param size: size of the file
+    :return: Tuple of (first, last) byte, both included, None to send the
+    whole file, or False if the range cannot be satisfied.
+    """
+    match = RANGE.match(header.strip()) if header else None
+    if match is None:
+        # Missing, malformed or multiple ranges get the whole file
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # Suffix range, the last N bytes
+        length = int(last)
+        if length == 0:
+            return False
+        return max(size - length, 0), size - 1
+    first = int(first)
+    last = min(int(last), size - 1) if last else size - 1
+    if first >= size or first > last:
+        return False
+    return first, last
+
+
+def read_range(path, first, length):
+    with open(path, "rb") as file:
+        file.seek(first)
+        while length > 0:
+            chunk = file.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def serve_file(request, name, path):
+    """
+    Build the response of a media file, honouring conditional and range
+    requests. With MEDIA_SENDFILE set the front proxy sends the bytes.
+    Files come from other users and are served from the site's origin, so
+    they are sandboxed and anything but raster images is downloaded.
+    :param request: HttpRequest
+    :param name: storage name of the file
+    :param path: file system path of the file
+    :return: HttpResponse
+    """
+    stat = os.stat(path)
+    etag = file_etag(name, stat)
+    response = get_conditional_response(request, etag=etag, last_modified=int(stat.st_mtime))
+    if response is None:
+        response = build_response(request, name, path, stat.st_size, etag)
+    response["ETag"] = etag
+    response["Last-Modified"] = http_date(stat.st_mtime)
+    if is_content_addressed(name):
+        response["Cache-Control"] = "private, max-age=31536000, immutable"
+    else:
+        response["Cache-Control"] = "private, no-cache"
+    response["Content-Security-Policy"] = "sandbox"
+    response["X-Content-Type-Options"] = "nosniff"
+    if mimetypes.guess_type(name)[0] not in INLINE_TYPES:
+        response["Content-Disposition"] = content_disposition_header(True, posixpath.basename(name))
+    return response
+
+
+def build_response(request, name, path, size, etag):
+    content_type, encoding = mimetypes.guess_type(name)
+    content_type = content_type or "application/octet-stream"
+
+    if settings.MEDIA_SENDFILE:
+        # The proxy handles ranges itself
+        response = HttpResponse(content_type=content_type)
+        if settings.MEDIA_SENDFILE == "x-accel-redirect":
+            response["X-Accel-Redirect"] = settings.MEDIA_SENDFILE_PREFIX + name
+        else:
+            response["X-Sendfile"] = path
+        return response
+
+    byte_range = parse_range(request.headers.get("Range"), size)
+    if_range = request.headers.get("If-Range")
+    if if_range is not None and if_range != etag:
+        byte_range = None
+
+    if byte_range is False:
+        response = HttpResponse(status=416)
+        response["Content-Range"] = f"bytes */{size}"
+        return response
+    if byte_range is None:
+        first, last, status = 0, size - 1, 200
+    else:
+        (first, last), status = byte_range, 206
+
+    response = StreamingHttpResponse(read_range(path, first, last - first + 1), status=status, content_type=content_type)
+    response["Content-Length"] = str(last - first + 1)
+    response["Accept-Ranges"] = "bytes"
+    if status == 206:
+        response["Content-Range"] = f"bytes {first}-{last}/{size}"
+    if encoding:
+        response["Content-Encoding"] = encoding
+    return response
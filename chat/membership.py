@@ -0,0 +1,95 @@
+import time
+from dataclasses import dataclass
+from channels.db import database_sync_to_async
+from django.conf import settings
+from chat.models import Chat
+
+
+@dataclass(frozen=True, slots=True)
+class ChatMembership:
+    """
+    Compact snapshot of a chat and its members.
+    """
+    chat_id: int
+    name: str
+    is_group: bool
+    members: dict  # user id -> username
+
+    @property
+    def display_name(self):
+        return self.name if self.is_group else "Private Chat"
+
+    def __contains__(self, user_id):
+        return user_id in self.members
+
+    def recipients(self, author_id):
+        """
+        Get (id, username) pairs of every member except the author.
+        """
+        return [(user_id, username) for user_id, username in self.members.items()
+                if user_id != author_id]
+
+
+# Process wide cache shared by every consumer: chat id -> (expires at, membership)
+_cache = {}
+
+
+def load_membership(chat_id):
+    """
+    Load the membership of a chat from a database.
+    :param chat_id: chat id
+    :return: ChatMembership or None if the chat does not exist.
+    """
+    chat = Chat.objects.filter(id=chat_id).values("id", "name", "is_group").first()
+    if chat is None:
+        return None
+    members = dict(
+        Chat.members.through.objects.filter(chat_id=chat_id)
+        .values_list("user_id", "user__username")
+    )
+    return ChatMembership(chat["id"], chat["name"], chat["is_group"], members)
+
+
+@database_sync_to_async
+def _load_membership(chat_id):
+    return load_membership(chat_id)
+
+
+async def get_membership(chat_id):
+    """
+    Get the membership of a chat, loading it on a cache miss.
+    The TTL only bounds staleness when members change in another process,
+    changes made in this process invalidate the entry right away.
+    :param chat_id: chat id
+    :return: ChatMembership or None if the chat does not exist.
+    """
+    try:
+        chat_id = int(chat_id)
+    except (TypeError, ValueError):
+        return None
+
+    entry = _cache.get(chat_id)
+    if entry is not None and entry[0] > time.monotonic():
+        return entry[1]
+
+    membership = await _load_membership(chat_id)
+    if membership is not None:
+        if len(_cache) >= settings.CHAT_MEMBERSHIP_CACHE_SIZE:
+            # Drop the oldest entry, dictionaries keep insertion order
+            _cache.pop(next(iter(_cache)))
+        _cache[chat_id] = (time.monotonic() + settings.CHAT_MEMBERSHIP_CACHE_TTL, membership)
+    return membership
+
+
+def invalidate_membership(chat_id):
+    """
+    Forget the cached membership of a chat.
+    """
+    _cache.pop(int(chat_id), None)
+
+
+def clear_memberships():
+    """
+    Forget every cached membership.
+    """
+    _cache.clear()
@@ -0,0 +1,17 @@
+# Generated by Django 5.1.4 on 2026-10-18 18:03
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0007_message_history_index'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='chat',
+            name='users_online',
+        ),
+    ]
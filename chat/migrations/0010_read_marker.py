@@ -0,0 +1,54 @@
+# Generated by Django 5.1.4 on 2026-10-18 18:11
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def backfill_read_markers(apps, schema_editor):
+    """
+    Message.read was never set, so there is no read state to carry over.
+    Members start with everything up to the newest message read, instead
+    of the whole history showing up as unread.
+    """
+    Message = apps.get_model('chat', 'Message')
+    ReadMarker = apps.get_model('chat', 'ReadMarker')
+    Membership = apps.get_model('chat', 'Chat').members.through
+    latest = dict(
+        Message.objects.values('chat_id').annotate(latest=Max('id')).values_list('chat_id', 'latest')
+    )
+    markers = [
+        ReadMarker(chat_id=chat_id, user_id=user_id, last_read_message_id=latest[chat_id])
+        for chat_id, user_id in Membership.objects.filter(chat_id__in=latest).values_list('chat_id', 'user_id')
+    ]
+    ReadMarker.objects.bulk_create(markers, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0009_attachment'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReadMarker',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_read_message_id', models.PositiveBigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('chat', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_markers', to='chat.chat')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_markers', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('chat', 'user'), name='unique_read_marker')],
+            },
+        ),
+        migrations.RunPython(backfill_read_markers, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='message',
+            name='read',
+        ),
+    ]
@@ -0,0 +1,60 @@
+# Generated by Django 5.1.4 on 2026-10-18 18:13
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_inbox_summaries(apps, schema_editor):
+    """
+    Same as the rebuild_inbox command, written against the historical models.
+    """
+    Chat = apps.get_model('chat', 'Chat')
+    Message = apps.get_model('chat', 'Message')
+    ReadMarker = apps.get_model('chat', 'ReadMarker')
+    InboxSummary = apps.get_model('chat', 'InboxSummary')
+    summaries = []
+    for chat in Chat.objects.prefetch_related('members'):
+        last_message = Message.objects.filter(chat=chat).order_by('-id').first()
+        markers = dict(ReadMarker.objects.filter(chat=chat).values_list('user_id', 'last_read_message_id'))
+        for member in chat.members.all():
+            last_read = markers.get(member.id, 0)
+            unread = Message.objects.filter(chat=chat, id__gt=last_read).exclude(author=member).count()
+            summaries.append(InboxSummary(
+                chat=chat,
+                user=member,
+                unread_count=unread,
+                last_message_id=last_message.id if last_message else None,
+                last_message_preview=(last_message.text or 'Attachment')[:100] if last_message else '',
+                last_message_at=last_message.created_at if last_message else None,
+            ))
+    InboxSummary.objects.bulk_create(summaries, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0010_read_marker'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InboxSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('unread_count', models.PositiveIntegerField(default=0)),
+                ('last_message_id', models.PositiveBigIntegerField(blank=True, null=True)),
+                ('last_message_preview', models.CharField(blank=True, max_length=100)),
+                ('last_message_at', models.DateTimeField(blank=True, null=True)),
+                ('chat', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='summaries', to='chat.chat')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='inbox', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name_plural': 'inbox summaries',
+                'indexes': [models.Index(fields=['user', '-last_message_at'], name='inbox_summary_user_idx')],
+                'constraints': [models.UniqueConstraint(fields=('chat', 'user'), name='unique_inbox_summary')],
+            },
+        ),
+        migrations.RunPython(backfill_inbox_summaries, migrations.RunPython.noop),
+    ]
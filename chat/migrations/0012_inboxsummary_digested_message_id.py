@@ -0,0 +1,28 @@
+# Generated by Django 5.1.4 on 2026-10-18 18:17
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def skip_existing_activity(apps, schema_editor):
+    """
+    Only activity after this migration goes into digests.
+    """
+    InboxSummary = apps.get_model('chat', 'InboxSummary')
+    InboxSummary.objects.filter(last_message_id__isnull=False).update(digested_message_id=F('last_message_id'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0011_inbox_summary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='inboxsummary',
+            name='digested_message_id',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.RunPython(skip_existing_activity, migrations.RunPython.noop),
+    ]
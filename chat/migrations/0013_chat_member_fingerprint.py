@@ -0,0 +1,45 @@
+# Generated by Django 5.1.4 on 2026-10-18 18:18
+
+from django.conf import settings
+import hashlib
+from django.db import migrations, models
+
+
+def backfill_fingerprints(apps, schema_editor):
+    """
+    Fingerprint every chat. Private chats that duplicate an older one keep
+    an empty fingerprint, so the unique constraint can be added.
+    """
+    Chat = apps.get_model('chat', 'Chat')
+    seen = set()
+    for chat in Chat.objects.prefetch_related('members').order_by('created_at', 'id'):
+        user_ids = sorted(member.id for member in chat.members.all())
+        if not user_ids:
+            continue
+        fingerprint = hashlib.sha256(",".join(map(str, user_ids)).encode()).hexdigest()
+        if not chat.is_group:
+            if fingerprint in seen:
+                continue
+            seen.add(fingerprint)
+        Chat.objects.filter(pk=chat.pk).update(member_fingerprint=fingerprint)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0012_inboxsummary_digested_message_id'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='member_fingerprint',
+            field=models.CharField(blank=True, db_index=True, max_length=64),
+        ),
+        migrations.RunPython(backfill_fingerprints, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='chat',
+            constraint=models.UniqueConstraint(condition=models.Q(('is_group', False), models.Q(('member_fingerprint', ''), _negated=True)), fields=('member_fingerprint',), name='unique_private_chat'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.1.4 on 2026-10-18 18:28
+
+import chat.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0015_attachment_renditions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StoredBlob',
+            fields=[
+                ('digest', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('size', models.PositiveBigIntegerField()),
+                ('references', models.PositiveIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='attachment',
+            name='file',
+            field=models.FileField(storage=chat.models.chat_storage, upload_to='chat_files/'),
+        ),
+        migrations.AlterField(
+            model_name='attachment',
+            name='thumbnail',
+            field=models.FileField(blank=True, null=True, storage=chat.models.chat_storage, upload_to='chat_files/thumbnails/'),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='file',
+            field=models.FileField(blank=True, null=True, storage=chat.models.chat_storage, upload_to='chat_files/'),
+        ),
+    ]
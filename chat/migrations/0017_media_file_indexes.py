@@ -0,0 +1,29 @@
+# Generated by Django 5.1.4 on 2026-10-18 18:29
+
+import chat.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0016_stored_blob'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='attachment',
+            name='file',
+            field=models.FileField(db_index=True, storage=chat.models.chat_storage, upload_to='chat_files/'),
+        ),
+        migrations.AlterField(
+            model_name='attachment',
+            name='thumbnail',
+            field=models.FileField(blank=True, db_index=True, null=True, storage=chat.models.chat_storage, upload_to='chat_files/thumbnails/'),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='file',
+            field=models.FileField(blank=True, db_index=True, null=True, storage=chat.models.chat_storage, upload_to='chat_files/'),
+        ),
+    ]
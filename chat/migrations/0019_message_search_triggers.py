@@ -0,0 +1,49 @@
+from django.db import migrations
+
+FTS_TABLE = 'chat_message_fts'
+
+# SQLite rebuilds chat_message to alter its columns, which drops the triggers
+# keeping the index in sync. Migrations rebuilding chat_message after this one
+# have to run RECREATE again.
+RECREATE = [
+    f"DROP TRIGGER IF EXISTS {FTS_TABLE}_update",
+    f"DROP TRIGGER IF EXISTS {FTS_TABLE}_delete",
+    f"DROP TRIGGER IF EXISTS {FTS_TABLE}_insert",
+    f"""
+    CREATE TRIGGER {FTS_TABLE}_insert AFTER INSERT ON chat_message BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, text) VALUES (new.id, new.text);
+    END
+    """,
+    f"""
+    CREATE TRIGGER {FTS_TABLE}_delete AFTER DELETE ON chat_message BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, text) VALUES ('delete', old.id, old.text);
+    END
+    """,
+    f"""
+    CREATE TRIGGER {FTS_TABLE}_update AFTER UPDATE OF text ON chat_message BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, text) VALUES ('delete', old.id, old.text);
+        INSERT INTO {FTS_TABLE}(rowid, text) VALUES (new.id, new.text);
+    END
+    """,
+    # Messages written while the triggers were missing
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')",
+]
+
+
+def recreate_triggers(apps, schema_editor):
+    # Other databases fall back to the simple search backend
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for statement in RECREATE:
+        schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0018_chat_soft_delete'),
+    ]
+
+    operations = [
+        migrations.RunPython(recreate_triggers, migrations.RunPython.noop),
+    ]
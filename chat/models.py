@@ -1,4 +1,64 @@
+import hashlib
+from django.core.files.storage import storages
 from django.db import models
+from django.db.models import F, FilteredRelation, Q
+
+
+def chat_storage():
+    """
+    Storage of chat files, the "chat" entry of the STORAGES setting.
+    """
+    return storages['chat']
+
+
+def member_fingerprint(user_ids):
+    """
+    Canonical fingerprint of a set of members, the same for any order.
+    :param user_ids: iterable of user ids
+    :return: Hex digest of the sorted ids
+    """
+    canonical = ",".join(str(user_id) for user_id in sorted(set(user_ids)))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+class ChatQuerySet(models.QuerySet):
+
+    def with_members(self, user_ids):
+        """
+        Chats whose members are exactly the given users, found through
+        the fingerprint index.
+        :param user_ids: iterable of user ids
+        """
+        return self.filter(member_fingerprint=member_fingerprint(user_ids))
+
+    def inbox_for(self, user):
+        """
+        Chats of a user with their inbox summary, most recent activity first.
+        Unread count and last message come from the user's summary row,
+        so the listing does not touch messages at all.
+        :param user: User object
+        :return: QuerySet of chats annotated with unread_count,
+            last_message_id, last_message_preview and last_message_at
+        """
+        return self.annotate(
+            summary=FilteredRelation('summaries', condition=Q(summaries__user=user)),
+        ).filter(summary__isnull=False).annotate(
+            unread_count=F('summary__unread_count'),
+            last_message_id=F('summary__last_message_id'),
+            last_message_preview=F('summary__last_message_preview'),
+            last_message_at=F('summary__last_message_at'),
+        ).order_by(
+            F('summary__last_message_at').desc(nulls_last=True), '-created_at'
+        ).prefetch_related('members')
+
+
+class ChatManager(models.Manager.from_queryset(ChatQuerySet)):
+    """
+    Hides chats that are deleted and waiting to be purged.
+    """
+
+    def get_queryset(self):
+        return super().get_queryset().filter(deleted_at__isnull=True)
 
 
 class Chat(models.Model):
@@ -8,11 +68,67 @@ class Chat(models.Model):
     name = models.CharField(max_length=50, null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     members = models.ManyToManyField('user.User', related_name='chats')
-    users_online = models.ManyToManyField('user.User', related_name='online_in_chat', blank=True)
     is_group = models.BooleanField(default=False)
+    member_fingerprint = models.CharField(max_length=64, blank=True, db_index=True)
+    deleted_at = models.DateTimeField(null=True, blank=True, db_index=True)
+
+    objects = ChatManager()
+    all_objects = ChatQuerySet.as_manager()
 
     class Meta:
         ordering = ['-created_at']
+        base_manager_name = 'all_objects'
+        constraints = [
+            # One private chat per pair of users, a deleted one does not count
+            models.UniqueConstraint(
+                fields=['member_fingerprint'],
+                condition=Q(is_group=False) & ~Q(member_fingerprint='') & Q(deleted_at__isnull=True),
+                name='unique_private_chat',
+            ),
+        ]
+
+    def refresh_fingerprint(self):
+        """
+        Recompute the fingerprint from the current members without sending post_save.
+        """
+        user_ids = Chat.members.through.objects.filter(chat_id=self.pk).values_list('user_id', flat=True)
+        self.member_fingerprint = member_fingerprint(user_ids) if user_ids else ''
+        Chat.objects.filter(pk=self.pk).update(member_fingerprint=self.member_fingerprint)
+
+
+class Attachment(models.Model):
+    """
+    File uploaded to a chat ahead of the message that carries it.
+    Raster images get a thumbnail and a blur placeholder in the background.
+    """
+
+    class Renditions(models.TextChoices):
+        NONE = 'none', 'None'
+        PENDING = 'pending', 'Pending'
+        READY = 'ready', 'Ready'
+        FAILED = 'failed', 'Failed'
+
+    chat = models.ForeignKey(Chat, on_delete=models.CASCADE, related_name='attachments')
+    uploaded_by = models.ForeignKey('user.User', on_delete=models.CASCADE, related_name='attachments')
+    file = models.FileField(upload_to='chat_files/', storage=chat_storage, db_index=True)
+    name = models.CharField(max_length=255)
+    content_type = models.CharField(max_length=100)
+    size = models.PositiveBigIntegerField()
+    width = models.PositiveIntegerField(null=True, blank=True)
+    height = models.PositiveIntegerField(null=True, blank=True)
+    thumbnail = models.FileField(
+        upload_to='chat_files/thumbnails/', storage=chat_storage, null=True, blank=True, db_index=True
+    )
+    placeholder = models.TextField(blank=True)
+    renditions = models.CharField(max_length=10, choices=Renditions.choices, default=Renditions.NONE)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.name
+
+    @property
+    def is_image(self):
+        return self.content_type.startswith('image/')
 
 
 class Message(models.Model):
@@ -21,13 +137,107 @@ class Message(models.Model):
     """
     chat = models.ForeignKey(Chat, on_delete=models.CASCADE, related_name='messages')
     text = models.TextField(null=True, blank=True)
-    file = models.FileField(upload_to='chat_files/', null=True, blank=True)
+    file = models.FileField(upload_to='chat_files/', storage=chat_storage, null=True, blank=True, db_index=True)
+    attachment = models.ForeignKey(
+        Attachment, on_delete=models.SET_NULL, null=True, blank=True, related_name='messages'
+    )
     author = models.ForeignKey('user.User', on_delete=models.CASCADE)
     created_at = models.DateTimeField(auto_now_add=True)
-    read = models.BooleanField(default=False)
 
     class Meta:
         ordering = ['created_at']
+        indexes = [
+            models.Index(fields=['chat', 'created_at', 'id'], name='message_chat_history_idx'),
+        ]
 
     def __str__(self):
         return self.text
+
+
+class ReadMarker(models.Model):
+    """
+    Id of the last message a member has read in a chat.
+    Every message with a greater id is unread for that member.
+    """
+    chat = models.ForeignKey(Chat, on_delete=models.CASCADE, related_name='read_markers')
+    user = models.ForeignKey('user.User', on_delete=models.CASCADE, related_name='read_markers')
+    last_read_message_id = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['chat', 'user'], name='unique_read_marker'),
+        ]
+
+    def __str__(self):
+        return f'{self.user_id} read {self.chat_id} up to {self.last_read_message_id}'
+
+    def is_unread(self, message):
+        return message.id > self.last_read_message_id
+
+
+class InboxSummary(models.Model):
+    """
+    Denormalized state of a chat as seen by one member.
+    Kept up to date together with message inserts and read markers, so the
+    inbox never has to aggregate over messages.
+    """
+    chat = models.ForeignKey(Chat, on_delete=models.CASCADE, related_name='summaries')
+    user = models.ForeignKey('user.User', on_delete=models.CASCADE, related_name='inbox')
+    unread_count = models.PositiveIntegerField(default=0)
+    last_message_id = models.PositiveBigIntegerField(null=True, blank=True)
+    last_message_preview = models.CharField(max_length=100, blank=True)
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    digested_message_id = models.PositiveBigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['chat', 'user'], name='unique_inbox_summary'),
+        ]
+        indexes = [
+            models.Index(fields=['user', '-last_message_at'], name='inbox_summary_user_idx'),
+        ]
+        verbose_name_plural = 'inbox summaries'
+
+    def __str__(self):
+        return f'{self.user_id} in {self.chat_id}: {self.unread_count} unread'
+
+
+class StoredBlob(models.Model):
+    """
+    File stored once under the digest of its content and shared by every
+    attachment and message with the same content.
+    References count the file fields that hold the name.
+    """
+    digest = models.CharField(max_length=64, primary_key=True)
+    name = models.CharField(max_length=255, unique=True)
+    size = models.PositiveBigIntegerField()
+    references = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.name
+
+
+class ChatDeletionJob(models.Model):
+    """
+    Purge of a deleted chat, run in batches by a Celery task.
+    Progress is saved with every batch, so a job resumes where it stopped.
+    """
+
+    class Status(models.TextChoices):
+        PENDING = 'pending', 'Pending'
+        RUNNING = 'running', 'Running'
+        DONE = 'done', 'Done'
+
+    chat_id = models.PositiveBigIntegerField(unique=True)
+    status = models.CharField(max_length=10, choices=Status.choices, default=Status.PENDING, db_index=True)
+    messages_deleted = models.PositiveIntegerField(default=0)
+    attachments_deleted = models.PositiveIntegerField(default=0)
+    files_deleted = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f'Deletion of chat {self.chat_id}'
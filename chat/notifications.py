@@ -0,0 +1,151 @@
+import asyncio
+import atexit
+import threading
+from collections import defaultdict
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+from chat.layers import group_send_many
+
+
+def notification_group(user_id):
+    return f"user_{user_id}_notifications"
+
+
+def notification_event(chat_id, chat_name, sender, count):
+    """
+    Build a notify event for new messages in a chat.
+    :param chat_id: chat id
+    :param chat_name: name of a group chat, None for private chats
+    :param sender: username of the author of the newest message
+    :param count: number of messages the event stands for
+    :return: Event dictionary
+    """
+    return {
+        'type': 'notify',
+        'message': "New Message!" if count == 1 else f"{count} new messages",
+        'sender': sender,
+        'chat_id': chat_id,
+        'chat': chat_name,
+        'count': count,
+    }
+
+
+class NotificationDispatcher:
+    """
+    Sends new message notifications straight from the process that stored
+    the message. Messages of a chat arriving within a short window are
+    coalesced into a single "N new messages" event per recipient, and
+    recipients with the same event are sent to in one batch.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self._pending = {}  # (recipient id, chat id) -> (count, sender, chat name)
+        self._task = None
+
+    def notify(self, membership, author_id, author_username):
+        """
+        Queue a notification of a new message for every other member.
+        :param membership: ChatMembership of the chat
+        :param author_id: id of the author
+        :param author_username: username of the author
+        """
+        chat_name = membership.name if membership.is_group else None
+        for recipient_id, _ in membership.recipients(author_id):
+            key = (recipient_id, membership.chat_id)
+            count = self._pending[key][0] if key in self._pending else 0
+            self._pending[key] = (count + 1, author_username, chat_name)
+        if self._task is None and self._pending:
+            self._task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.window)
+        self._task = None
+        pending, self._pending = self._pending, {}
+
+        # Recipients of a burst usually share the same event
+        recipients = defaultdict(list)
+        for (recipient_id, chat_id), (count, sender, chat_name) in pending.items():
+            recipients[(chat_id, chat_name, sender, count)].append(notification_group(recipient_id))
+
+        channel_layer = get_channel_layer()
+        for (chat_id, chat_name, sender, count), groups in recipients.items():
+            await group_send_many(channel_layer, groups, notification_event(chat_id, chat_name, sender, count))
+
+
+class NotificationBatcher:
+    """
+    Collects notifications raised by requests of this process over a short
+    window and hands them to the send_notifications task as one batch.
+    The same notification raised twice within a window is sent once.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self._pending = {}  # (user id, sorted payload items) -> payload
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def add(self, user_id, payload):
+        """
+        Queue a notification.
+        :param user_id: id of the recipient
+        :param payload: JSON friendly dictionary holding at least a message and a sender
+        """
+        with self._lock:
+            self._pending[(user_id, tuple(sorted(payload.items())))] = (user_id, payload)
+            if self._timer is None:
+                self._timer = threading.Timer(self.window, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        """
+        Queue the task delivering everything collected so far.
+        """
+        # chat.tasks imports this module
+        from chat.tasks import send_notifications
+
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            pending, self._pending = self._pending, {}
+        if pending:
+            send_notifications.delay(list(pending.values()))
+
+
+_batcher = None
+
+
+def get_notification_batcher():
+    """
+    Get the notification batcher of this process.
+    """
+    global _batcher
+    if _batcher is None:
+        _batcher = NotificationBatcher(settings.CHAT_NOTIFICATION_WINDOW_MS / 1000)
+        atexit.register(_batcher.flush)
+    return _batcher
+
+
+def queue_notification(user_id, payload):
+    """
+    Send a notification from a request once its transaction commits,
+    batched with the other notifications of the window.
+    """
+    transaction.on_commit(lambda: get_notification_batcher().add(user_id, payload))
+
+
+_dispatcher = None
+
+
+def get_dispatcher():
+    """
+    Get the notification dispatcher of this process.
+    """
+    global _dispatcher
+    if _dispatcher is None:
+        _dispatcher = NotificationDispatcher(settings.CHAT_NOTIFICATION_WINDOW_MS / 1000)
+    return _dispatcher
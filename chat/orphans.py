@@ -0,0 +1,163 @@
+import os
+from dataclasses import dataclass
+from datetime import timedelta
+from functools import partial
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.utils import timezone
+from chat.models import Attachment, Message, StoredBlob, chat_storage
+from user.models import User
+
+
+@dataclass
+class CollectionReport:
+    """
+    What a garbage collection found, or removed when it was not a dry run.
+    """
+    scanned: int = 0
+    orphaned: int = 0
+    orphaned_bytes: int = 0
+    unsent_attachments: int = 0
+
+    def __str__(self):
+        return (f"{self.scanned} files scanned, {self.orphaned} orphaned ({self.orphaned_bytes} bytes), "
+                f"{self.unsent_attachments} unsent attachments")
+
+
+def scan(storage, directory, cutoff):
+    """
+    Walk a storage directory with scandir, yielding (name, size) of files
+    last modified before the cutoff. Only the directories on the current
+    path are held in memory. Directories starting with "__" hold renditions
+    managed by versatileimagefield and are skipped.
+    :param storage: file system storage
+    :param directory: directory relative to the storage root
+    :param cutoff: timestamp, newer files are skipped
+    """
+    root = storage.path("")
+    pending = [storage.path(directory)]
+    while pending:
+        try:
+            entries = os.scandir(pending.pop())
+        except FileNotFoundError:
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if not entry.name.startswith("__"):
+                        pending.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    stat = entry.stat(follow_symlinks=False)
+                    if stat.st_mtime < cutoff:
+                        yield os.path.relpath(entry.path, root).replace(os.sep, "/"), stat.st_size
+
+
+def batched(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def referenced_chat_files(names):
+    """
+    Get which of the names a row or a live blob still refers to, through
+    the indexed file columns.
+    """
+    referenced = set(Attachment.objects.filter(file__in=names).values_list("file", flat=True))
+    referenced |= set(Attachment.objects.filter(thumbnail__in=names).values_list("thumbnail", flat=True))
+    referenced |= set(Message.objects.filter(file__in=names).values_list("file", flat=True))
+    referenced |= set(StoredBlob.objects.filter(name__in=names, references__gt=0).values_list("name", flat=True))
+    return referenced
+
+
+def referenced_user_images(names):
+    return set(User.objects.filter(image__in=names).values_list("image", flat=True))
+
+
+def delete_chat_files(storage, names, idle_before):
+    """
+    Delete orphaned chat files. Blobs are deleted with their row, unless
+    the row was referenced again since idle_before.
+    """
+    blobs = set(StoredBlob.objects.filter(name__in=names).values_list("name", flat=True))
+    for name in names:
+        if name not in blobs:
+            storage.delete(name)
+            continue
+        with transaction.atomic():
+            removed, _ = StoredBlob.objects.filter(name=name, references=0, updated_at__lt=idle_before).delete()
+            if removed:
+                storage.delete(name)
+
+
+def delete_user_images(storage, names):
+    """
+    Delete orphaned avatars and the renditions versatileimagefield made of them.
+    """
+    field = User._meta.get_field("image")
+    for name in names:
+        field.attr_class(None, field, name).delete_all_created_images()
+        storage.delete(name)
+
+
+def delete_unsent_attachments(cutoff, batch_size, dry_run):
+    """
+    Delete attachments uploaded before the cutoff that no message carries,
+    with the files nothing else refers to.
+    :return: Number of attachments
+    """
+    unsent = Attachment.objects.filter(messages__isnull=True, created_at__lt=cutoff)
+    if dry_run:
+        return unsent.count()
+    deleted = 0
+    while True:
+        rows = list(unsent.order_by("id").values_list("id", "file", "thumbnail")[:batch_size])
+        if not rows:
+            return deleted
+        # Files are released by the post_delete signal
+        Attachment.objects.filter(id__in=[row[0] for row in rows]).delete()
+        chat_storage().delete_unreferenced([name for row in rows for name in row[1:]])
+        deleted += len(rows)
+
+
+def collect_orphaned_media(dry_run=False, grace=None):
+    """
+    Delete media files that nothing refers to anymore: chat files of deleted
+    messages and unsent attachments, and replaced or deleted avatars.
+    Files younger than the grace period are kept, so uploads that are not
+    committed yet survive. Storage is listed as a stream and checked against
+    the database in batches, so memory does not grow with the volume.
+    :param dry_run: only report what would be deleted
+    :param grace: grace period in seconds, MEDIA_GC_GRACE when None
+    :return: CollectionReport
+    """
+    grace = settings.MEDIA_GC_GRACE if grace is None else grace
+    batch_size = settings.MEDIA_GC_BATCH_SIZE
+    now = timezone.now()
+    idle_before = now - timedelta(seconds=grace)
+    report = CollectionReport()
+
+    report.unsent_attachments = delete_unsent_attachments(
+        now - timedelta(seconds=settings.CHAT_ATTACHMENT_UNSENT_TTL), batch_size, dry_run
+    )
+
+    sources = [
+        (chat_storage(), "chat_files", referenced_chat_files, partial(delete_chat_files, idle_before=idle_before)),
+        (default_storage, "user/images", referenced_user_images, delete_user_images),
+    ]
+    for storage, directory, referenced, delete in sources:
+        for batch in batched(scan(storage, directory, idle_before.timestamp()), batch_size):
+            report.scanned += len(batch)
+            live = referenced([name for name, _ in batch])
+            orphans = [(name, size) for name, size in batch if name not in live]
+            report.orphaned += len(orphans)
+            report.orphaned_bytes += sum(size for _, size in orphans)
+            if orphans and not dry_run:
+                delete(storage, [name for name, _ in orphans])
+    return report
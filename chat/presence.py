@@ -0,0 +1,340 @@
+import asyncio
+import time
+from collections import Counter, defaultdict
+from channels.layers import get_channel_layer
+from django.conf import settings
+from chat.events import presence_delta_event
+from chat.layers import is_redis_layer
+
+
+CHATS_KEY = "presence:chats"
+
+# Pseudo chat joined by every notification socket, it tells who is online anywhere on the site
+SITE = "site"
+
+
+def connections_key(chat_id):
+    return f"presence:{chat_id}:connections"
+
+
+def users_key(chat_id):
+    return f"presence:{chat_id}:users"
+
+
+def version_key(chat_id):
+    return f"presence:{chat_id}:version"
+
+
+def connection_member(username, channel_name):
+    """
+    Pack a connection into a single member string.
+    Channel names never contain "|", so the last one separates the parts.
+    """
+    return f"{username}|{channel_name}"
+
+
+class InMemoryPresence:
+    """
+    Process local presence for single-node setups.
+    Every connection holds a reference on its user, so several tabs
+    of the same user count once. Each time a user comes online or goes
+    offline the version of the chat's presence is bumped.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._connections = defaultdict(dict)  # chat -> {member: expires at}
+        self._users = defaultdict(Counter)  # chat -> {username: connections}
+        self._versions = Counter()  # chat -> version
+
+    async def join(self, chat_id, username, channel_name):
+        """
+        Register a connection.
+        :return: New version if the user just came online, otherwise None.
+        """
+        chat_id = str(chat_id)
+        member = connection_member(username, channel_name)
+        is_new = member not in self._connections[chat_id]
+        self._connections[chat_id][member] = time.time() + self.ttl
+        if is_new:
+            self._users[chat_id][username] += 1
+            if self._users[chat_id][username] == 1:
+                return self._bump(chat_id)
+        return None
+
+    async def heartbeat(self, chat_id, username, channel_name):
+        """
+        Extend the lifetime of a connection.
+        """
+        chat_id = str(chat_id)
+        member = connection_member(username, channel_name)
+        if member in self._connections[chat_id]:
+            self._connections[chat_id][member] = time.time() + self.ttl
+
+    async def leave(self, chat_id, username, channel_name):
+        """
+        Unregister a connection.
+        :return: New version if the user just went offline, otherwise None.
+        """
+        chat_id = str(chat_id)
+        member = connection_member(username, channel_name)
+        if self._connections[chat_id].pop(member, None) is None:
+            return None
+        if self._release(chat_id, username):
+            return self._bump(chat_id)
+        return None
+
+    async def snapshot(self, chat_id):
+        """
+        Get the online users of a chat, dropping expired connections first.
+        :return: Tuple of (usernames, version, changes made by the expiry)
+        """
+        chat_id = str(chat_id)
+        expired = self._expire(chat_id)
+        return list(self._users[chat_id]), self._versions[chat_id], expired
+
+    async def sweep(self):
+        """
+        Drop expired connections of every chat.
+        :return: Dictionary of chat id to the resulting presence changes.
+        """
+        gone = {}
+        for chat_id in list(self._connections):
+            expired = self._expire(chat_id)
+            if expired:
+                gone[chat_id] = expired
+        return gone
+
+    def _bump(self, chat_id):
+        self._versions[chat_id] += 1
+        return self._versions[chat_id]
+
+    def _release(self, chat_id, username):
+        self._users[chat_id][username] -= 1
+        if self._users[chat_id][username] <= 0:
+            del self._users[chat_id][username]
+            return True
+        return False
+
+    def _expire(self, chat_id):
+        now = time.time()
+        changes = []
+        for member, expires_at in list(self._connections[chat_id].items()):
+            if expires_at < now:
+                del self._connections[chat_id][member]
+                username = member.rsplit("|", 1)[0]
+                if self._release(chat_id, username):
+                    changes.append([self._bump(chat_id), "leave", username])
+        if not self._connections[chat_id]:
+            self._connections.pop(chat_id, None)
+            self._users.pop(chat_id, None)
+        return changes
+
+
+class RedisPresence:
+    """
+    Presence kept in the Redis of the channel layer, so it is shared by
+    every worker. Connections live in a sorted set scored by their expiry
+    time and user reference counts live in a hash. Connections of crashed
+    workers stop sending heartbeats and are swept once they expire.
+    Each time a user comes online or goes offline the version counter of
+    the chat is incremented. The counter never expires, so versions keep
+    growing even when a chat has no one online for a while.
+    """
+
+    JOIN = """
+        local added = redis.call('ZADD', KEYS[1], ARGV[2], ARGV[1])
+        redis.call('EXPIRE', KEYS[1], ARGV[4])
+        redis.call('SADD', KEYS[3], ARGV[5])
+        local count = 0
+        if added == 1 then
+            count = redis.call('HINCRBY', KEYS[2], ARGV[3], 1)
+        end
+        redis.call('EXPIRE', KEYS[2], ARGV[4])
+        if count == 1 then
+            return redis.call('INCR', KEYS[4])
+        end
+        return 0
+    """
+
+    HEARTBEAT = """
+        if redis.call('ZSCORE', KEYS[1], ARGV[1]) then
+            redis.call('ZADD', KEYS[1], ARGV[2], ARGV[1])
+            redis.call('EXPIRE', KEYS[1], ARGV[3])
+            redis.call('EXPIRE', KEYS[2], ARGV[3])
+        end
+        return 0
+    """
+
+    LEAVE = """
+        if redis.call('ZREM', KEYS[1], ARGV[1]) == 0 then
+            return 0
+        end
+        if redis.call('HINCRBY', KEYS[2], ARGV[2], -1) <= 0 then
+            redis.call('HDEL', KEYS[2], ARGV[2])
+            return redis.call('INCR', KEYS[3])
+        end
+        return 0
+    """
+
+    # Drops expired connections and returns the resulting changes as a flat
+    # list of version, username pairs, the users that are still online and
+    # the current version.
+    EXPIRE = """
+        local changes = {}
+        local expired = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+        for _, member in ipairs(expired) do
+            redis.call('ZREM', KEYS[1], member)
+            local username = string.match(member, '^(.*)|[^|]*$')
+            if redis.call('HINCRBY', KEYS[2], username, -1) <= 0 then
+                redis.call('HDEL', KEYS[2], username)
+                table.insert(changes, redis.call('INCR', KEYS[4]))
+                table.insert(changes, username)
+            end
+        end
+        local online = redis.call('HKEYS', KEYS[2])
+        if #online == 0 then
+            redis.call('SREM', KEYS[3], ARGV[2])
+        end
+        local version = tonumber(redis.call('GET', KEYS[4]) or '0')
+        return {changes, online, version}
+    """
+
+    def __init__(self, channel_layer, ttl):
+        self.channel_layer = channel_layer
+        self.ttl = ttl
+
+    def connection(self, chat_id):
+        """
+        Get a connection to the shard holding the chat.
+        """
+        layer = self.channel_layer
+        return layer.connection(layer.consistent_hash(str(chat_id)))
+
+    async def join(self, chat_id, username, channel_name):
+        """
+        Register a connection.
+        :return: New version if the user just came online, otherwise None.
+        """
+        version = await self.connection(chat_id).eval(
+            self.JOIN, 4, connections_key(chat_id), users_key(chat_id), CHATS_KEY,
+            version_key(chat_id), connection_member(username, channel_name),
+            time.time() + self.ttl, username, self.ttl * 2, chat_id,
+        )
+        return version or None
+
+    async def heartbeat(self, chat_id, username, channel_name):
+        """
+        Extend the lifetime of a connection.
+        """
+        await self.connection(chat_id).eval(
+            self.HEARTBEAT, 2, connections_key(chat_id), users_key(chat_id),
+            connection_member(username, channel_name), time.time() + self.ttl,
+            self.ttl * 2,
+        )
+
+    async def leave(self, chat_id, username, channel_name):
+        """
+        Unregister a connection.
+        :return: New version if the user just went offline, otherwise None.
+        """
+        version = await self.connection(chat_id).eval(
+            self.LEAVE, 3, connections_key(chat_id), users_key(chat_id),
+            version_key(chat_id), connection_member(username, channel_name), username,
+        )
+        return version or None
+
+    async def snapshot(self, chat_id):
+        """
+        Get the online users of a chat in a single round trip.
+        :return: Tuple of (usernames, version, changes made by the expiry)
+        """
+        return await self._expire(chat_id)
+
+    async def sweep(self):
+        """
+        Drop expired connections of every chat.
+        :return: Dictionary of chat id to the resulting presence changes.
+        """
+        gone = {}
+        for index in range(self.channel_layer.ring_size):
+            chat_ids = await self.channel_layer.connection(index).smembers(CHATS_KEY)
+            for chat_id in chat_ids:
+                chat_id = chat_id.decode("utf8")
+                if self.channel_layer.consistent_hash(chat_id) != index:
+                    continue
+                _, _, expired = await self._expire(chat_id)
+                if expired:
+                    gone[chat_id] = expired
+        return gone
+
+    async def _expire(self, chat_id):
+        changes, online, version = await self.connection(chat_id).eval(
+            self.EXPIRE, 4, connections_key(chat_id), users_key(chat_id), CHATS_KEY,
+            version_key(chat_id), time.time(), chat_id,
+        )
+        expired = [
+            [changes[i], "leave", changes[i + 1].decode("utf8")]
+            for i in range(0, len(changes), 2)
+        ]
+        return [username.decode("utf8") for username in online], version, expired
+
+
+class PresenceBroadcaster:
+    """
+    Coalesces the presence changes of each chat made in this process over
+    a short window and sends them to the chat as a single delta event.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self._pending = {}  # chat id -> list of changes
+        self._tasks = {}
+
+    def publish(self, chat_id, changes):
+        """
+        Queue [version, "join" | "leave", username] changes of a chat.
+        """
+        if not changes:
+            return
+        chat_id = str(chat_id)
+        self._pending.setdefault(chat_id, []).extend(changes)
+        if chat_id not in self._tasks:
+            self._tasks[chat_id] = asyncio.create_task(self._flush_later(chat_id))
+
+    async def _flush_later(self, chat_id):
+        await asyncio.sleep(self.window)
+        self._tasks.pop(chat_id, None)
+        changes = sorted(self._pending.pop(chat_id, []))
+        await get_channel_layer().group_send(f"chat_{chat_id}", presence_delta_event(changes))
+
+
+_presence = None
+
+
+def get_presence():
+    """
+    Get the presence backend matching the default channel layer.
+    """
+    global _presence
+    if _presence is None:
+        channel_layer = get_channel_layer()
+        ttl = settings.CHAT_PRESENCE_TTL
+        if is_redis_layer(channel_layer):
+            _presence = RedisPresence(channel_layer, ttl)
+        else:
+            _presence = InMemoryPresence(ttl)
+    return _presence
+
+
+_broadcaster = None
+
+
+def get_broadcaster():
+    """
+    Get the presence broadcaster of this process.
+    """
+    global _broadcaster
+    if _broadcaster is None:
+        _broadcaster = PresenceBroadcaster(settings.CHAT_PRESENCE_WINDOW_MS / 1000)
+    return _broadcaster
@@ -0,0 +1,92 @@
+import json
+from functools import lru_cache
+import msgpack
+
+MSGPACK_SUBPROTOCOL = "msgpack"
+
+
+def encode_frame(event_type, payload):
+    """
+    Build a group event carrying the payload encoded once as JSON, the
+    format browsers speak, so consumers forward it without serializing it
+    again. Connections speaking msgpack convert it when they send it.
+    :param event_type: name of the handler on the consumers
+    :param payload: JSON friendly dictionary
+    :return: Event dictionary
+    """
+    return {
+        'type': event_type,
+        'text': json.dumps(payload),
+    }
+
+
+@lru_cache(maxsize=256)
+def to_msgpack(text):
+    """
+    Convert a JSON frame to msgpack, once per process for every msgpack
+    connection receiving the same frame.
+    """
+    return msgpack.packb(json.loads(text))
+
+
+class WireProtocolMixin:
+    """
+    Mixin for AsyncWebsocketConsumer that switches a connection to msgpack
+    binary frames when the client offers the "msgpack" subprotocol at the
+    handshake. Connections that do not offer it keep talking JSON text.
+    Consumers implement receive_payload() and reply with send_payload().
+    """
+
+    use_msgpack = False
+
+    async def websocket_connect(self, message):
+        self.use_msgpack = MSGPACK_SUBPROTOCOL in self.scope.get("subprotocols", [])
+        await super().websocket_connect(message)
+
+    async def accept(self, subprotocol=None, headers=None):
+        """
+        Accepts an incoming socket, confirming the negotiated subprotocol.
+        """
+        if subprotocol is None and self.use_msgpack:
+            subprotocol = MSGPACK_SUBPROTOCOL
+        await super().accept(subprotocol, headers)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        """
+        Decode a frame in either format and pass it to receive_payload().
+        Frames that do not decode to a dictionary are dropped.
+        """
+        try:
+            if bytes_data is not None:
+                payload = msgpack.unpackb(bytes_data)
+            else:
+                payload = json.loads(text_data)
+        except (TypeError, ValueError, msgpack.UnpackException):
+            payload = None
+        if not isinstance(payload, dict):
+            return
+        await self.receive_payload(payload)
+
+    async def receive_payload(self, payload):
+        """
+        Called with a decoded frame.
+        """
+        pass
+
+    async def send_payload(self, payload):
+        """
+        Encode a dictionary in the format of this connection and send it.
+        """
+        if self.use_msgpack:
+            await self.send(bytes_data=msgpack.packb(payload))
+        else:
+            await self.send(text_data=json.dumps(payload))
+
+    async def send_frame(self, event):
+        """
+        Forward the pre-serialized frame of a group event built by encode_frame().
+        """
+        if self.use_msgpack:
+            await self.send(bytes_data=to_msgpack(event["text"]))
+        else:
+            await self.send(text_data=event["text"])
@@ -0,0 +1,134 @@
+import time
+from channels.layers import get_channel_layer
+from django.conf import settings
+from chat.layers import is_redis_layer
+
+
+class InMemoryRateLimiter:
+    """
+    Token buckets kept in process memory for single-node setups.
+    """
+
+    def __init__(self):
+        self._buckets = {}  # key -> (tokens, updated at)
+
+    async def hit(self, limits):
+        """
+        Take one token from every bucket, or from none if any is empty.
+        :param limits: list of (key, rate per second, burst) tuples
+        :return: 0 if allowed, otherwise seconds until a token is available.
+        """
+        now = time.monotonic()
+        refilled = []
+        retry_after = 0
+        for key, rate, burst in limits:
+            tokens, updated_at = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated_at) * rate)
+            if tokens < 1:
+                retry_after = max(retry_after, (1 - tokens) / rate)
+            refilled.append((key, tokens))
+
+        for key, tokens in refilled:
+            self._buckets[key] = (tokens if retry_after else tokens - 1, now)
+        return retry_after
+
+    async def reset(self, key):
+        """
+        Forget a bucket, e.g. when its connection closes.
+        """
+        self._buckets.pop(key, None)
+
+
+class RedisRateLimiter:
+    """
+    Token buckets kept in the Redis of the channel layer, so limits hold
+    across every worker process.
+    """
+
+    # KEYS are the buckets, ARGV holds the current time followed by
+    # a (rate, burst) pair per bucket. Returns the wait in milliseconds.
+    HIT = """
+        local now = tonumber(ARGV[1])
+        local tokens = {}
+        local retry_after = 0
+        for i, key in ipairs(KEYS) do
+            local rate = tonumber(ARGV[i * 2])
+            local burst = tonumber(ARGV[i * 2 + 1])
+            local state = redis.call('HMGET', key, 'tokens', 'updated_at')
+            local current = tonumber(state[1]) or burst
+            local updated_at = tonumber(state[2]) or now
+            current = math.min(burst, current + (now - updated_at) * rate)
+            if current < 1 then
+                retry_after = math.max(retry_after, (1 - current) / rate)
+            end
+            tokens[i] = current
+        end
+        for i, key in ipairs(KEYS) do
+            local rate = tonumber(ARGV[i * 2])
+            local burst = tonumber(ARGV[i * 2 + 1])
+            local current = tokens[i]
+            if retry_after == 0 then
+                current = current - 1
+            end
+            redis.call('HSET', key, 'tokens', tostring(current), 'updated_at', ARGV[1])
+            redis.call('EXPIRE', key, math.ceil(burst / rate) + 1)
+        end
+        return math.ceil(retry_after * 1000)
+    """
+
+    def __init__(self, channel_layer):
+        self.channel_layer = channel_layer
+
+    async def hit(self, limits):
+        """
+        Take one token from every bucket, or from none if any is empty.
+        All buckets of one call live on the shard of the last one.
+        :param limits: list of (key, rate per second, burst) tuples
+        :return: 0 if allowed, otherwise seconds until a token is available.
+        """
+        keys = [key for key, _, _ in limits]
+        args = [time.time()]
+        for _, rate, burst in limits:
+            args += [rate, burst]
+        layer = self.channel_layer
+        connection = layer.connection(layer.consistent_hash(keys[-1]))
+        retry_after = await connection.eval(self.HIT, len(keys), *keys, *args)
+        return retry_after / 1000
+
+    async def reset(self, key):
+        """
+        Buckets expire on their own once they are full again.
+        """
+
+
+_rate_limiter = None
+
+
+def get_rate_limiter():
+    """
+    Get the rate limiter matching the default channel layer.
+    """
+    global _rate_limiter
+    if _rate_limiter is None:
+        channel_layer = get_channel_layer()
+        if is_redis_layer(channel_layer):
+            _rate_limiter = RedisRateLimiter(channel_layer)
+        else:
+            _rate_limiter = InMemoryRateLimiter()
+    return _rate_limiter
+
+
+def connection_limit(channel_name):
+    return (
+        f"ratelimit:connection:{channel_name}",
+        settings.CHAT_RATE_LIMIT_CONNECTION_RATE,
+        settings.CHAT_RATE_LIMIT_CONNECTION_BURST,
+    )
+
+
+def user_limit(user_id):
+    return (
+        f"ratelimit:user:{user_id}",
+        settings.CHAT_RATE_LIMIT_USER_RATE,
+        settings.CHAT_RATE_LIMIT_USER_BURST,
+    )
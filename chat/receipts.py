@@ -0,0 +1,126 @@
+import asyncio
+import logging
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max
+from chat.events import read_receipts_event
+from chat.inbox import record_reads
+from chat.models import Message, ReadMarker
+
+logger = logging.getLogger(__name__)
+
+
+def store_read_markers(marks):
+    """
+    Move read markers forward in one batch, together with the unread
+    counts of the inbox summaries.
+    Markers are clamped to the newest message of their chat and never move
+    backwards, so stale or forged ids from clients are harmless.
+    :param marks: dictionary of (chat id, user id) to (username, message id),
+        a message id of None marks the whole chat as read
+    :return: Dictionary of chat id to {username: last read message id} of
+        the markers that moved.
+    """
+    chat_ids = {chat_id for chat_id, _ in marks}
+    user_ids = {user_id for _, user_id in marks}
+    with transaction.atomic():
+        latest = dict(
+            Message.objects.filter(chat_id__in=chat_ids)
+            .values("chat_id").annotate(latest=Max("id")).values_list("chat_id", "latest")
+        )
+        current = {
+            (chat_id, user_id): last_read
+            for chat_id, user_id, last_read in ReadMarker.objects.filter(
+                chat_id__in=chat_ids, user_id__in=user_ids
+            ).values_list("chat_id", "user_id", "last_read_message_id")
+        }
+
+        markers = []
+        moved = {}
+        for (chat_id, user_id), (username, message_id) in marks.items():
+            newest = latest.get(chat_id, 0)
+            last_read = newest if message_id is None else min(message_id, newest)
+            if last_read <= current.get((chat_id, user_id), 0):
+                continue
+            markers.append(ReadMarker(chat_id=chat_id, user_id=user_id, last_read_message_id=last_read))
+            moved.setdefault(chat_id, {})[username] = last_read
+
+        ReadMarker.objects.bulk_create(
+            markers,
+            update_conflicts=True,
+            unique_fields=["chat", "user"],
+            update_fields=["last_read_message_id", "updated_at"],
+        )
+        record_reads(markers, latest)
+    return moved
+
+
+def get_read_receipts(chat_id):
+    """
+    Get how far every member has read a chat.
+    :param chat_id: chat id
+    :return: Dictionary of username to the id of the last read message
+    """
+    return dict(
+        ReadMarker.objects.filter(chat_id=chat_id, last_read_message_id__gt=0)
+        .values_list("user__username", "last_read_message_id")
+    )
+
+
+class ReceiptBuffer:
+    """
+    Collects read marks of this process over a short window, keeping only
+    the furthest one per member and chat, then writes them in one batch
+    and sends one receipt event per chat.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._pending = {}  # (chat id, user id) -> (username, message id)
+        self._task = None
+
+    def mark_read(self, chat_id, user_id, username, message_id=None):
+        """
+        Queue a read mark.
+        :param message_id: id of the last read message, None for the newest one
+        """
+        try:
+            key = (int(chat_id), user_id)
+            message_id = None if message_id is None else int(message_id)
+        except (TypeError, ValueError):
+            return
+
+        queued = self._pending.get(key)
+        if queued is None or (queued[1] is not None and (message_id is None or message_id > queued[1])):
+            self._pending[key] = (username, message_id)
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.interval)
+        self._task = None
+        marks, self._pending = self._pending, {}
+        try:
+            moved = await database_sync_to_async(store_read_markers)(marks)
+        except Exception:
+            logger.exception("Failed to store %s read markers", len(marks))
+            return
+
+        channel_layer = get_channel_layer()
+        for chat_id, receipts in moved.items():
+            await channel_layer.group_send(f"chat_{chat_id}", read_receipts_event(receipts))
+
+
+_receipt_buffer = None
+
+
+def get_receipt_buffer():
+    """
+    Get the read receipt buffer of this process.
+    """
+    global _receipt_buffer
+    if _receipt_buffer is None:
+        _receipt_buffer = ReceiptBuffer(settings.CHAT_READ_RECEIPT_INTERVAL_MS / 1000)
+    return _receipt_buffer
@@ -0,0 +1,87 @@
+import base64
+import os
+from io import BytesIO
+from django.conf import settings
+from django.core.files.base import ContentFile
+from PIL import Image, ImageFilter, ImageOps, UnidentifiedImageError, features
+from chat.models import Attachment
+
+# Vector images are shown as they are, Pillow cannot rasterize them
+SKIPPED_CONTENT_TYPES = {'image/svg+xml'}
+
+# EXIF orientations that turn the image by 90 degrees
+ORIENTATION = 0x0112
+ROTATED = {5, 6, 7, 8}
+
+
+def needs_renditions(attachment):
+    return attachment.is_image and attachment.content_type not in SKIPPED_CONTENT_TYPES
+
+
+def thumbnail_format():
+    """
+    Get the configured thumbnail format, falling back to JPEG when Pillow
+    was built without WebP support.
+    """
+    image_format = settings.CHAT_THUMBNAIL_FORMAT.upper()
+    if image_format == 'WEBP' and not features.check('webp'):
+        return 'JPEG'
+    return image_format
+
+
+def encode(image, image_format, quality):
+    buffer = BytesIO()
+    if image_format == 'JPEG' and image.mode != 'RGB':
+        image = image.convert('RGB')
+    image.save(buffer, image_format, quality=quality)
+    return buffer.getvalue()
+
+
+def build_placeholder(image):
+    """
+    Build a tiny blurred copy of the image as a data URI, small enough to
+    be inlined in pages and events while the thumbnail loads.
+    """
+    tiny = image.copy()
+    tiny.thumbnail((settings.CHAT_PLACEHOLDER_SIZE, settings.CHAT_PLACEHOLDER_SIZE))
+    tiny = tiny.convert('RGB').filter(ImageFilter.GaussianBlur(1))
+    # A tiny WebP is a tenth of the size of a JPEG, which is mostly headers
+    image_format = 'WEBP' if features.check('webp') else 'PNG'
+    data = base64.b64encode(encode(tiny, image_format, 50)).decode()
+    return f"data:image/{image_format.lower()};base64,{data}"
+
+
+def create_renditions(attachment):
+    """
+    Record the dimensions and real type of an image attachment and store
+    its thumbnail and blur placeholder.
+    :param attachment: Attachment of a raster image
+    :return: True if the renditions were created
+    """
+    size = settings.CHAT_THUMBNAIL_SIZE
+    image_format = thumbnail_format()
+    try:
+        with attachment.file.open('rb') as file, Image.open(file) as image:
+            attachment.width, attachment.height = image.size
+            if image.getexif().get(ORIENTATION) in ROTATED:
+                attachment.width, attachment.height = attachment.height, attachment.width
+            attachment.content_type = image.get_format_mimetype() or attachment.content_type
+            # Lets JPEG decoding skip straight to a reduced scale
+            image.draft('RGB', (size, size))
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((size, size))
+            if image.mode not in ('RGB', 'RGBA'):
+                image = image.convert('RGBA' if image.has_transparency_data else 'RGB')
+            thumbnail = encode(image, image_format, settings.CHAT_THUMBNAIL_QUALITY)
+            placeholder = build_placeholder(image)
+    except (OSError, UnidentifiedImageError, Image.DecompressionBombError):
+        attachment.renditions = Attachment.Renditions.FAILED
+        attachment.save(update_fields=['renditions'])
+        return False
+
+    stem = os.path.splitext(os.path.basename(attachment.file.name))[0]
+    attachment.thumbnail.save(f"{stem}.{image_format.lower()}", ContentFile(thumbnail), save=False)
+    attachment.placeholder = placeholder
+    attachment.renditions = Attachment.Renditions.READY
+    attachment.save(update_fields=['width', 'height', 'content_type', 'thumbnail', 'placeholder', 'renditions'])
+    return True
@@ -0,0 +1,172 @@
+import logging
+import re
+from django.conf import settings
+from django.db import connection
+from django.utils.html import escape
+from chat.models import Chat, Message
+
+# Markers put around matches by the database, replaced with <mark> after escaping
+MATCH_START = "\x02"
+MATCH_END = "\x03"
+
+FTS_TABLE = "chat_message_fts"
+FTS_TRIGGERS = [f"{FTS_TABLE}_insert", f"{FTS_TABLE}_delete", f"{FTS_TABLE}_update"]
+
+logger = logging.getLogger(__name__)
+
+
+def highlight(snippet):
+    """
+    Escape a snippet and turn the match markers into <mark> tags.
+    """
+    return escape(snippet).replace(MATCH_START, "<mark>").replace(MATCH_END, "</mark>")
+
+
+def serialize_result(message, snippet):
+    return {
+        'id': message.id,
+        'chat_id': message.chat_id,
+        'chat': message.chat.name if message.chat.is_group else None,
+        'username': message.author.username,
+        'snippet': highlight(snippet),
+        'created_at': message.created_at.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+
+
+def load_results(ranked):
+    """
+    Load messages of (id, snippet) pairs, keeping their order.
+    """
+    messages = Message.objects.select_related("author", "chat").in_bulk([message_id for message_id, _ in ranked])
+    return [
+        serialize_result(messages[message_id], snippet)
+        for message_id, snippet in ranked if message_id in messages
+    ]
+
+
+class SQLiteSearchBackend:
+    """
+    Ranked search over an FTS5 index of message text.
+    The index is an external content table kept in sync with chat_message
+    by triggers, see the message_search migration.
+    """
+
+    SQL = f"""
+        SELECT {FTS_TABLE}.rowid, snippet({FTS_TABLE}, 0, %s, %s, '…', 12)
+        FROM {FTS_TABLE}
+        JOIN {Message._meta.db_table} message ON message.id = {FTS_TABLE}.rowid
+        JOIN {Chat.members.through._meta.db_table} member
+            ON member.chat_id = message.chat_id AND member.user_id = %s
+        JOIN {Chat._meta.db_table} chat ON chat.id = message.chat_id AND chat.deleted_at IS NULL
+        WHERE {FTS_TABLE} MATCH %s {{chat_filter}}
+        ORDER BY bm25({FTS_TABLE})
+        LIMIT %s OFFSET %s
+    """
+
+    @staticmethod
+    def build_query(text):
+        """
+        Turn user input into an FTS5 query matching every word, the last
+        one as a prefix, so no input is parsed as FTS5 syntax.
+        """
+        words = re.findall(r"\w+", text)
+        if not words:
+            return None
+        terms = ['"{}"'.format(word.replace('"', '""')) for word in words]
+        terms[-1] += "*"
+        return " ".join(terms)
+
+    def search(self, user, text, chat_id=None, offset=0, limit=20):
+        """
+        :return: list of (message id, snippet) pairs, best match first
+        """
+        query = self.build_query(text)
+        if query is None:
+            return []
+        params = [MATCH_START, MATCH_END, user.id, query]
+        chat_filter = ""
+        if chat_id is not None:
+            chat_filter = "AND message.chat_id = %s"
+            params.append(chat_id)
+        params += [limit, offset]
+        with connection.cursor() as cursor:
+            cursor.execute(self.SQL.format(chat_filter=chat_filter), params)
+            return cursor.fetchall()
+
+    def rebuild(self):
+        """
+        Rebuild the whole index from chat_message in one statement.
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+            cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('optimize')")
+
+
+class SimpleSearchBackend:
+    """
+    Fallback for databases without a full-text index. Scans message text,
+    newest first, so it is only fit for small installations.
+    """
+
+    def search(self, user, text, chat_id=None, offset=0, limit=20):
+        text = text.strip()
+        if not text:
+            return []
+        queryset = Message.objects.filter(chat__members=user, chat__deleted_at__isnull=True, text__icontains=text)
+        if chat_id is not None:
+            queryset = queryset.filter(chat_id=chat_id)
+        rows = queryset.order_by("-created_at", "-id").values_list("id", "text")[offset:offset + limit]
+        pattern = re.compile(re.escape(text), re.IGNORECASE)
+        return [
+            (message_id, pattern.sub(lambda match: MATCH_START + match.group(0) + MATCH_END, message_text))
+            for message_id, message_text in rows
+        ]
+
+    def rebuild(self):
+        """
+        Nothing is indexed.
+        """
+
+
+def missing_triggers(using=connection):
+    """
+    Get the triggers keeping the index in sync that are missing, SQLite
+    drops them when a migration rebuilds chat_message.
+    :return: List of trigger names, None when there is no index table.
+    """
+    with using.cursor() as cursor:
+        cursor.execute("SELECT type, name FROM sqlite_master WHERE name = %s OR tbl_name = %s", [FTS_TABLE, "chat_message"])
+        found = {name for _, name in cursor.fetchall()}
+    if FTS_TABLE not in found:
+        return None
+    return [trigger for trigger in FTS_TRIGGERS if trigger not in found]
+
+
+def get_search_backend():
+    """
+    Get the search backend matching the default database. An index that
+    is not kept in sync misses new messages, the simple backend is used
+    until its triggers are recreated.
+    """
+    if connection.vendor != "sqlite":
+        return SimpleSearchBackend()
+    missing = missing_triggers()
+    if missing is None or missing:
+        logger.warning("Message search index is not kept in sync (missing %s), scanning messages instead",
+                       ", ".join(missing or [FTS_TABLE]))
+        return SimpleSearchBackend()
+    return SQLiteSearchBackend()
+
+
+def search_messages(user, text, chat_id=None, page=1):
+    """
+    Search the messages of every chat the user is a member of.
+    :param user: User object
+    :param text: text to search for
+    :param chat_id: only search this chat
+    :param page: page number, starting at 1
+    :return: Tuple of (list of results, whether there is a next page)
+    """
+    limit = settings.CHAT_SEARCH_PAGE_SIZE
+    ranked = get_search_backend().search(user, text, chat_id, offset=(page - 1) * limit, limit=limit + 1)
+    return load_results(ranked[:limit]), len(ranked) > limit
@@ -1,14 +1,126 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, pre_delete, post_delete, m2m_changed
 from django.dispatch import receiver
-from chat.models import Message
+from chat.inbox import add_summaries, membership_changed
+from chat.membership import invalidate_membership, clear_memberships
+from chat.models import Chat, InboxSummary, Message, Attachment
+from chat.storage import release
 
 
-@receiver(post_save, sender=Message)
-def send_notification_signal(sender, instance, created, **kwargs):
+@receiver(m2m_changed, sender=Chat.members.through)
+def invalidate_membership_signal(sender, instance, action, reverse, pk_set, **kwargs):
     """
-    Send a notification to the recipient of the message.
+    Drop cached memberships when the members of a chat change.
     """
-    from chat.tasks import send_notification
-    if created:
-        user_id = instance.chat.members.exclude(id=instance.author.id).first().id
-        send_notification.delay(user_id, "You have a new message!")
+    if not action.startswith("post_"):
+        return
+    if not reverse:
+        invalidate_membership(instance.pk)
+    elif pk_set:
+        # Changed from the user side, pk_set holds chat ids
+        for chat_id in pk_set:
+            invalidate_membership(chat_id)
+    else:
+        # A user's chats were cleared, the chat ids are not known anymore
+        clear_memberships()
+
+
+@receiver(m2m_changed, sender=Chat.members.through)
+def member_fingerprint_signal(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Keep the member fingerprints of changed chats current.
+    """
+    if action == "pre_clear" and reverse:
+        # The chats of the user are not known anymore after the clear
+        instance._cleared_chat_ids = list(instance.chats.values_list("id", flat=True))
+    if action not in ("post_add", "post_remove", "post_clear"):
+        return
+    if not reverse:
+        instance.refresh_fingerprint()
+    else:
+        chat_ids = pk_set if action != "post_clear" else getattr(instance, "_cleared_chat_ids", [])
+        for chat in Chat.objects.filter(pk__in=chat_ids):
+            chat.refresh_fingerprint()
+
+
+@receiver(m2m_changed, sender=Chat.members.through)
+def inbox_summary_signal(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Create inbox summaries for new members and drop them for removed ones,
+    in the transaction that changes the members.
+    """
+    if action == "post_add":
+        if not reverse:
+            add_summaries(instance.pk, pk_set)
+        else:
+            for chat_id in pk_set:
+                add_summaries(chat_id, [instance.pk])
+    elif action == "post_remove":
+        if not reverse:
+            InboxSummary.objects.filter(chat_id=instance.pk, user_id__in=pk_set).delete()
+        else:
+            InboxSummary.objects.filter(chat_id__in=pk_set, user_id=instance.pk).delete()
+    elif action == "post_clear":
+        if not reverse:
+            InboxSummary.objects.filter(chat_id=instance.pk).delete()
+        else:
+            InboxSummary.objects.filter(user_id=instance.pk).delete()
+
+
+@receiver([post_save, post_delete], sender=Chat)
+def invalidate_chat_signal(sender, instance, **kwargs):
+    """
+    Drop the cached membership when a chat is renamed or deleted.
+    """
+    invalidate_membership(instance.pk)
+
+
+@receiver(m2m_changed, sender=Chat.members.through)
+def inbox_membership_signal(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Push membership changes to the live inboxes of the affected users.
+    """
+    if action == "post_add" or action == "post_remove":
+        change = "added" if action == "post_add" else "removed"
+        if not reverse:
+            membership_changed(instance.pk, **{change: pk_set})
+        else:
+            for chat_id in pk_set:
+                membership_changed(chat_id, **{change: [instance.pk]})
+    elif action == "pre_clear":
+        # Members are still known before the clear, events go out on commit anyway
+        if not reverse:
+            membership_changed(instance.pk, removed=instance.members.values_list("id", flat=True))
+        else:
+            for chat_id in instance.chats.values_list("id", flat=True):
+                membership_changed(chat_id, removed=[instance.pk])
+
+
+@receiver(post_save, sender=Chat)
+def inbox_chat_signal(sender, instance, created, **kwargs):
+    """
+    Push renamed chats to the live inboxes of their members.
+    New chats have no members yet, they are announced when members are added.
+    """
+    if not created:
+        membership_changed(instance.pk)
+
+
+@receiver(pre_delete, sender=Chat)
+def inbox_chat_deletion_signal(sender, instance, **kwargs):
+    """
+    Remove deleted chats from the live inboxes of their members.
+    """
+    membership_changed(instance.pk, removed=instance.members.values_list("id", flat=True))
+
+
+@receiver(post_delete, sender=Message)
+@receiver(post_delete, sender=Attachment)
+def release_files_signal(sender, instance, **kwargs):
+    """
+    Drop the references deleted messages and attachments held on stored files.
+    """
+    names = [instance.file.name]
+    if sender is Attachment:
+        names.append(instance.thumbnail.name)
+    if any(names):
+        release(names)
@@ -0,0 +1,143 @@
+import hashlib
+import os
+from collections import Counter, defaultdict
+from django.core.files.storage import FileSystemStorage
+from django.core.files.uploadhandler import MemoryFileUploadHandler, TemporaryFileUploadHandler
+from django.db import transaction
+from django.db.models import F, Value
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+
+class HashingUploadMixin:
+    """
+    Hash uploaded files while their chunks stream in and set the digest
+    as the sha256 attribute of the uploaded file, so storage does not have
+    to read the file again.
+    """
+
+    def new_file(self, *args, **kwargs):
+        # Set first, the memory handler stops the handlers after it from new_file
+        self.digest = hashlib.sha256()
+        super().new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        # The memory handler passes chunks on to the next handler when the file is too large
+        if getattr(self, "activated", True):
+            self.digest.update(raw_data)
+        return super().receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        file = super().file_complete(file_size)
+        if file is not None:
+            file.sha256 = self.digest.hexdigest()
+        return file
+
+
+class HashingMemoryFileUploadHandler(HashingUploadMixin, MemoryFileUploadHandler):
+    pass
+
+
+class HashingTemporaryFileUploadHandler(HashingUploadMixin, TemporaryFileUploadHandler):
+    pass
+
+
+def hash_file(content):
+    """
+    Get the sha256 of a file, from the upload handler when it computed it.
+    """
+    digest = getattr(content, "sha256", None)
+    if digest is None:
+        hasher = hashlib.sha256()
+        content.seek(0)
+        for chunk in content.chunks():
+            hasher.update(chunk)
+        content.seek(0)
+        digest = hasher.hexdigest()
+    return digest
+
+
+def blob_name(name, digest):
+    """
+    Content addressed name of a file: the directory of the upload and
+    the digest, fanned out over two levels of subdirectories.
+    """
+    directory = os.path.dirname(name)
+    extension = os.path.splitext(name)[1].lower()
+    return os.path.join(directory, digest[:2], digest[2:4], f"{digest}{extension}")
+
+
+def retain(names):
+    """
+    Count new references to stored files.
+    :param names: file names, a name appearing twice counts twice
+    """
+    _add_references(Counter(name for name in names if name), 1)
+
+
+def release(names):
+    """
+    Drop references to stored files. Files nothing refers to anymore are
+    kept until ContentAddressedStorage.delete_unreferenced removes them.
+    :param names: file names, a name appearing twice counts twice
+    """
+    _add_references(Counter(name for name in names if name), -1)
+
+
+def _add_references(counts, sign):
+    from chat.models import StoredBlob
+
+    by_count = defaultdict(list)
+    for name, count in counts.items():
+        by_count[count].append(name)
+    now = timezone.now()
+    for count, names in by_count.items():
+        StoredBlob.objects.filter(name__in=names).update(
+            references=Greatest(F("references") + sign * count, Value(0)), updated_at=now
+        )
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    File system storage keeping a single copy of each distinct content.
+    Saved files are named after the sha256 of their content, saving a
+    file that is already stored skips the write and only adds a reference.
+    """
+
+    def _save(self, name, content):
+        # chat.models builds this storage while it is being imported
+        from chat.models import StoredBlob
+
+        digest = hash_file(content)
+        blob = StoredBlob.objects.filter(digest=digest).first()
+        target = blob.name if blob else blob_name(name, digest)
+        # Referenced before the file is checked, so delete_unreferenced cannot remove it underneath
+        if blob is None:
+            StoredBlob.objects.get_or_create(digest=digest, defaults={"name": target, "size": content.size})
+        retain([target])
+        if not self.exists(target):
+            stored = super()._save(target, content)
+            if stored != target:
+                # The same content was written concurrently under the target name
+                self.delete(stored)
+        return target
+
+    def delete_unreferenced(self, names):
+        """
+        Delete the files among names that nothing refers to anymore.
+        A blob row is deleted together with its file in one transaction,
+        a concurrent save of the same content either references the row
+        first or stores the file again.
+        :param names: file names
+        :return: Number of files deleted
+        """
+        from chat.models import StoredBlob
+
+        deleted = 0
+        for name in set(filter(None, names)):
+            with transaction.atomic():
+                removed, _ = StoredBlob.objects.filter(name=name, references=0).delete()
+                if removed:
+                    self.delete(name)
+                    deleted += 1
+        return deleted
@@ -1,20 +1,115 @@
+import json
+from collections import defaultdict
 from asgiref.sync import async_to_sync
 from celery import shared_task
 from channels.layers import get_channel_layer
+from chat.deletion import purge_chat, stalled_jobs
+from chat.digests import send_digests
+from chat.events import presence_delta_event
+from chat.history import expire_message_pages
+from chat.layers import group_send_many
+from chat.models import Attachment, ChatDeletionJob
+from chat.notifications import notification_group
+from chat.orphans import collect_orphaned_media
+from chat.presence import get_presence, SITE
+from chat.renditions import create_renditions
 from user.models import User
 
 
 @shared_task
-def send_notification(user_id, message):
-    user = User.objects.get(pk=user_id)
+def send_notifications(notifications):
+    """
+    Deliver a batch of notifications from outside the consumer path.
+    Recipients are resolved in one query and users with the same payload
+    are sent to in one group_send_many call.
+    :param notifications: list of (user id, payload) pairs, payloads hold
+        at least a message and a sender
+    """
+    user_ids = {user_id for user_id, _ in notifications}
+    active = set(User.objects.filter(pk__in=user_ids, is_active=True).values_list("id", flat=True))
+
+    recipients = defaultdict(list)
+    for user_id, payload in notifications:
+        if user_id in active:
+            recipients[json.dumps(payload, sort_keys=True)].append(notification_group(user_id))
+
     channel_layer = get_channel_layer()
+    for payload, groups in recipients.items():
+        async_to_sync(group_send_many)(channel_layer, groups, {"type": "notify", **json.loads(payload)})
+
+
+@shared_task
+def send_notification(user_id, message):
+    """
+    Deliver a single notification queued before send_notifications replaced
+    this task. Kept for one release so those messages still run, remove it
+    afterwards.
+    """
+    send_notifications([(user_id, {"message": message, "sender": ""})])
+
+
+@shared_task
+def send_email_digests():
+    """
+    Email offline users a digest of their unread chats.
+    """
+    return send_digests()
+
+
+@shared_task
+def render_attachment(attachment_id):
+    """
+    Create the thumbnail and placeholder of an uploaded image.
+    Pages that already show its message are rendered again with them.
+    """
+    attachment = Attachment.objects.filter(id=attachment_id).first()
+    if attachment is None or not create_renditions(attachment):
+        return
+    for chat_id in set(attachment.messages.values_list("chat_id", flat=True)):
+        expire_message_pages(chat_id)
+
 
-    async_to_sync(channel_layer.group_send)(
-        f"user_{user_id}_notifications",
-        {
-            "type": "notify",
-            "message": message,
-            "recipient": user.username
-        }
-    )
-    return None
\ No newline at end of file
+@shared_task
+def purge_deleted_chat(job_id):
+    """
+    Purge the history of a deleted chat in batches.
+    """
+    job = ChatDeletionJob.objects.filter(id=job_id).exclude(status=ChatDeletionJob.Status.DONE).first()
+    if job is not None:
+        purge_chat(job)
+
+
+@shared_task
+def resume_chat_deletions():
+    """
+    Queue again the purges that stopped making progress, after a worker crash.
+    """
+    for job_id in stalled_jobs().values_list("id", flat=True):
+        purge_deleted_chat.delay(job_id)
+
+
+@shared_task
+def collect_media():
+    """
+    Delete media files nothing refers to anymore.
+    """
+    return str(collect_orphaned_media())
+
+
+@shared_task
+def sweep_presence():
+    """
+    Drop connections left behind by dead workers and tell the
+    affected chats who went offline.
+    """
+    async_to_sync(_sweep_presence)()
+
+
+async def _sweep_presence():
+    presence = get_presence()
+    channel_layer = get_channel_layer()
+    gone = await presence.sweep()
+    for chat_id, changes in gone.items():
+        if chat_id == SITE:
+            continue
+        await channel_layer.group_send(f"chat_{chat_id}", presence_delta_event(changes))
@@ -0,0 +1,1054 @@
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import time
+from datetime import timedelta
+from io import BytesIO, StringIO
+from unittest.mock import patch
+import msgpack
+from PIL import Image
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import IntegrityError, OperationalError, connection, transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from chat.checks import check_search_triggers
+from chat.deletion import _delete_batch, delete_chat, purge_chat, stalled_jobs
+from chat.events import chat_message_event
+from chat.history import encode_cursor, get_history_page, serialize_attachment
+from chat.layers import group_send_many
+from chat.media import source_names
+from chat.membership import ChatMembership, clear_memberships, get_membership, load_membership
+from chat.notifications import NotificationDispatcher, notification_event, notification_group
+from chat.orphans import collect_orphaned_media
+from chat.models import Attachment, Chat, ChatDeletionJob, Message, StoredBlob, chat_storage, member_fingerprint
+from chat.presence import InMemoryPresence, PresenceBroadcaster
+from chat.ratelimit import InMemoryRateLimiter
+from chat.receipts import ReceiptBuffer, get_read_receipts, store_read_markers
+from chat.routing import websocket_urlpatterns
+from chat.search import FTS_TABLE, SimpleSearchBackend, get_search_backend
+from chat.tasks import (
+    purge_deleted_chat, render_attachment, resume_chat_deletions, send_notification, send_notifications,
+)
+from chat.writer import MessageWriter, store_messages
+from user.models import User
+
+IN_MEMORY_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+
+
+def create_user(username):
+    return User.objects.create_user(
+        username=username, first_name=username, last_name=username, email=f"{username}@example.com", password="secret"
+    )
+
+
+def create_chat(*members, is_group=False):
+    chat = Chat.objects.create(is_group=is_group)
+    chat.members.add(*members)
+    return chat
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+class ChatTestCase(TestCase):
+
+    def setUp(self):
+        self.alice = create_user("alice")
+        self.bob = create_user("bob")
+        self.chat = create_chat(self.alice, self.bob)
+        self.client.force_login(self.alice)
+
+    def get(self, path, **extra):
+        return self.client.get(path, HTTP_HOST="localhost", **extra)
+
+
+class MessageSearchTests(ChatTestCase):
+
+    def test_new_message_is_found(self):
+        message = Message.objects.create(chat=self.chat, author=self.bob, text="Meet at the harbour tonight")
+        response = self.get("/chat/search/", data={"q": "harb"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([result["id"] for result in response.json()["results"]], [message.id])
+        self.assertIn("<mark>", response.json()["results"][0]["snippet"])
+
+    def test_edited_and_deleted_messages_follow_the_index(self):
+        message = Message.objects.create(chat=self.chat, author=self.bob, text="first draft")
+        Message.objects.filter(pk=message.pk).update(text="final version")
+        self.assertEqual(self.get("/chat/search/", data={"q": "draft"}).json()["results"], [])
+        self.assertEqual(len(self.get("/chat/search/", data={"q": "final"}).json()["results"]), 1)
+        message.delete()
+        self.assertEqual(self.get("/chat/search/", data={"q": "final"}).json()["results"], [])
+
+    def test_other_chats_are_not_searched(self):
+        carol = create_user("carol")
+        Message.objects.create(chat=create_chat(self.bob, carol), author=carol, text="secret harbour plans")
+        self.assertEqual(self.get("/chat/search/", data={"q": "harbour"}).json()["results"], [])
+
+    def test_index_without_triggers_falls_back_to_scanning(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DROP TRIGGER {FTS_TABLE}_insert")
+        self.assertEqual([error.id for error in check_search_triggers(None, databases=["default"])], ["chat.W001"])
+        with self.assertLogs("chat.search", "WARNING"):
+            self.assertIsInstance(get_search_backend(), SimpleSearchBackend)
+        message = Message.objects.create(chat=self.chat, author=self.bob, text="Meet at the harbour tonight")
+        with self.assertLogs("chat.search", "WARNING"):
+            results = self.get("/chat/search/", data={"q": "harbour"}).json()["results"]
+        self.assertEqual([result["id"] for result in results], [message.id])
+
+
+def image_file(name="image.png", size=(120, 80), color="red"):
+    content = BytesIO()
+    Image.new("RGB", size, color).save(content, "PNG")
+    return SimpleUploadedFile(name, content.getvalue(), content_type="image/png")
+
+
+class MediaTestCase(ChatTestCase):
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        media = override_settings(MEDIA_ROOT=media_root)
+        media.enable()
+        self.addCleanup(media.disable)
+        cache.clear()
+        super().setUp()
+
+    def upload(self, file, chat=None):
+        with patch("chat.views.render_attachment") as render, self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                f"/chat/{(chat or self.chat).id}/attachments/", {"file": file}, HTTP_HOST="localhost"
+            )
+        self.render = render
+        return response
+
+
+class MediaViewTests(MediaTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.message = Message.objects.create(
+            chat=self.chat, author=self.bob, file=SimpleUploadedFile("notes.txt", b"0123456789")
+        )
+        self.url = self.message.file.url
+
+    def test_members_download_chat_files(self):
+        response = self.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b"".join(response.streaming_content), b"0123456789")
+        self.assertIn("immutable", response["Cache-Control"])
+
+    def test_other_users_do_not(self):
+        self.client.force_login(create_user("carol"))
+        self.assertEqual(self.get(self.url).status_code, 404)
+
+    def test_deleted_chats_are_not_served(self):
+        delete_chat(self.chat)
+        self.assertEqual(self.get(self.url).status_code, 404)
+
+    def test_paths_leaving_public_directories_are_rejected(self):
+        self.client.force_login(create_user("carol"))
+        self.assertEqual(self.get(f"/media/user/images/../../{self.message.file.name}").status_code, 404)
+
+    def test_range(self):
+        response = self.get(self.url, HTTP_RANGE="bytes=2-5")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response["Content-Range"], "bytes 2-5/10")
+        self.assertEqual(b"".join(response.streaming_content), b"2345")
+        self.assertEqual(b"".join(self.get(self.url, HTTP_RANGE="bytes=-3").streaming_content), b"789")
+        self.assertEqual(self.get(self.url, HTTP_RANGE="bytes=20-").status_code, 416)
+
+    def test_range_of_a_changed_file_sends_everything(self):
+        response = self.get(self.url, HTTP_RANGE="bytes=2-5", HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+
+    def test_etag(self):
+        etag = self.get(self.url)["ETag"]
+        self.assertEqual(self.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+
+class AvatarAccessTests(MediaTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.bob.image = image_file("avatar.png")
+        self.bob.save()
+
+    def test_avatars_are_public(self):
+        self.assertEqual(self.get(self.bob.image.url).status_code, 200)
+
+    def test_sized_avatars_are_public(self):
+        url = self.bob.image.crop["70x70"].url
+        self.assertTrue(url.startswith("/media/__sized__/user/images/"))
+        response = self.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Image.open(BytesIO(b"".join(response.streaming_content))).size, (70, 70))
+
+    def test_source_names(self):
+        self.assertIn(
+            "user/images/my-avatar.png", source_names("__sized__/user/images/my-avatar-crop-c0-5__0-5-70x70.png")
+        )
+        self.assertEqual(source_names("chat_files/ab/cd/__filtered__/ab12__invert__.png"), {"chat_files/ab/cd/ab12.png"})
+        self.assertEqual(
+            source_names("__sized__/chat_files/ab/cd/__filtered__/ab12__invert__-thumbnail-100x100.png"),
+            {"chat_files/ab/cd/ab12.png"},
+        )
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+class ConsumerTestCase(TransactionTestCase):
+    """
+    Consumers query the database from other threads, so rows are committed.
+    """
+
+    def setUp(self):
+        clear_memberships()
+        # Chat ids are reused once tables are flushed, so is the presence of the previous test
+        patcher = patch("chat.presence._presence", None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.alice = create_user("alice")
+        self.bob = create_user("bob")
+        self.chat = create_chat(self.alice, self.bob)
+
+    async def connect(self, user, chat=None, subprotocols=None):
+        communicator = WebsocketCommunicator(
+            URLRouter(websocket_urlpatterns), f"/ws/chat/{(chat or self.chat).id}/", subprotocols=subprotocols
+        )
+        communicator.scope["user"] = user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def receive(self, communicator, frame_type):
+        """
+        Receive frames until one of the given type, chat messages carry no type.
+        """
+        while True:
+            frame = await communicator.receive_json_from(timeout=2)
+            if frame.get("type", "chat_message") == frame_type:
+                return frame
+
+    async def assertClosed(self, communicator):
+        while True:
+            output = await communicator.receive_output(timeout=2)
+            if output["type"] == "websocket.close":
+                return
+
+
+class ChatConsumerTests(ConsumerTestCase):
+
+    async def test_messages_are_stored_and_broadcast(self):
+        alice, bob = await self.connect(self.alice), await self.connect(self.bob)
+        await alice.send_json_to({"message": "hello"})
+        frame = await self.receive(bob, "chat_message")
+        self.assertEqual(frame["message"], "hello")
+        message = await Message.objects.aget()
+        self.assertEqual(frame["id"], message.id)
+        await alice.disconnect()
+        await bob.disconnect()
+
+    async def test_connect_sends_read_state_but_no_messages(self):
+        await database_sync_to_async(store_messages)([Message(chat=self.chat, author=self.bob, text="hello")])
+        alice = await self.connect(self.alice)
+        self.assertEqual((await alice.receive_json_from())["type"], "online_users")
+        self.assertEqual((await alice.receive_json_from())["type"], "read_receipts")
+        self.assertTrue(await alice.receive_nothing())
+        await alice.disconnect()
+
+    async def test_history_is_paged_over_the_socket(self):
+        messages = await database_sync_to_async(store_messages)([
+            Message(chat=self.chat, author=self.bob, text=f"message {number}") for number in range(3)
+        ])
+        alice = await self.connect(self.alice)
+        await alice.send_json_to({"type": "history", "before": encode_cursor(messages[-1])})
+        frame = await self.receive(alice, "history")
+        self.assertEqual([message["text"] for message in frame["messages"]], ["message 0", "message 1"])
+        self.assertIsNone(frame["next_cursor"])
+        await alice.disconnect()
+
+    @override_settings(CHAT_HISTORY_PAGE_SIZE=2)
+    async def test_history_walks_back_to_the_first_message(self):
+        messages = await database_sync_to_async(store_messages)([
+            Message(chat=self.chat, author=self.bob, text=f"message {number}") for number in range(5)
+        ])
+        alice = await self.connect(self.alice)
+        seen, cursor = [], "not a cursor"
+        # An invalid cursor starts from the newest page
+        while cursor is not None:
+            await alice.send_json_to({"type": "history", "before": cursor})
+            frame = await self.receive(alice, "history")
+            seen = [message["id"] for message in frame["messages"]] + seen
+            cursor = frame["next_cursor"]
+        self.assertEqual(seen, [message.id for message in messages])
+        await alice.disconnect()
+
+    async def test_others_learn_about_joins_and_leaves(self):
+        alice = await self.connect(self.alice)
+        self.assertEqual((await alice.receive_json_from())["online_users"], ["alice"])
+        bob = await self.connect(self.bob)
+        self.assertEqual(sorted((await bob.receive_json_from())["online_users"]), ["alice", "bob"])
+        self.assertIn([2, "join", "bob"], (await self.receive(alice, "presence_delta"))["changes"])
+        await bob.disconnect()
+        self.assertIn([3, "leave", "bob"], (await self.receive(alice, "presence_delta"))["changes"])
+        await alice.disconnect()
+
+    async def test_frames_that_are_not_objects_are_dropped(self):
+        alice = await self.connect(self.alice)
+        await alice.send_to(text_data="[1, 2]")
+        await alice.send_to(text_data="{not json")
+        await alice.send_to(bytes_data=msgpack.packb("text"))
+        await alice.send_json_to({"message": "still connected"})
+        frame = await self.receive(alice, "chat_message")
+        self.assertEqual(frame["message"], "still connected")
+        await alice.disconnect()
+
+    async def test_malformed_messages_are_dropped(self):
+        alice = await self.connect(self.alice)
+        await alice.send_json_to({"attachment": "x"})
+        await alice.send_json_to({"attachment": [1]})
+        await alice.send_json_to({"message": 5})
+        await alice.send_json_to({"message": ["hello"]})
+        await alice.send_json_to({"message": "still connected"})
+        frame = await self.receive(alice, "chat_message")
+        self.assertEqual(frame["message"], "still connected")
+        self.assertEqual(await Message.objects.acount(), 1)
+        await alice.disconnect()
+
+    async def test_msgpack_connections_get_binary_frames(self):
+        alice = await self.connect(self.alice)
+        bob = await self.connect(self.bob, subprotocols=["msgpack"])
+        await alice.send_json_to({"message": "hello"})
+        while True:
+            frame = msgpack.unpackb((await bob.receive_output(timeout=2))["bytes"])
+            if frame.get("message") == "hello":
+                break
+        self.assertEqual(frame["username"], "alice")
+        await alice.disconnect()
+        await bob.disconnect()
+
+    async def test_group_frames_are_serialized_once(self):
+        alice, bob = await self.connect(self.alice), await self.connect(self.bob)
+        binary = [await self.connect(user, subprotocols=["msgpack"]) for user in (self.alice, self.bob)]
+        event = chat_message_event(1, "serialized once", "alice", None)
+        payload = json.loads(event["text"])
+        frames = []
+        with patch("chat.protocol.json.dumps") as dumps, \
+                patch("chat.protocol.msgpack.packb", wraps=msgpack.packb) as packb:
+            await get_channel_layer().group_send(f"chat_{self.chat.id}", event)
+            for communicator in (alice, bob, *binary):
+                # Skip the frames sent on connect
+                while True:
+                    output = await communicator.receive_output(timeout=2)
+                    frame = output.get("text") or msgpack.unpackb(output["bytes"])
+                    if "serialized once" in str(frame):
+                        frames.append(frame)
+                        break
+        dumps.assert_not_called()
+        self.assertEqual([call.args[0] for call in packb.call_args_list].count(payload), 1)
+        self.assertEqual(frames, [event["text"], event["text"], payload, payload])
+        for communicator in (alice, bob, *binary):
+            await communicator.disconnect()
+
+    @override_settings(CHAT_RATE_LIMIT_CONNECTION_RATE=0.5, CHAT_RATE_LIMIT_CONNECTION_BURST=2)
+    async def test_frames_over_the_limit_are_throttled(self):
+        alice = await self.connect(self.alice)
+        for ref in range(1, 4):
+            await alice.send_json_to({"message": f"message {ref}", "ref": ref})
+        frame = await self.receive(alice, "throttled")
+        self.assertEqual(frame["ref"], 3)
+        self.assertAlmostEqual(frame["retry_after"], 2, delta=0.1)
+        self.assertEqual(await Message.objects.acount(), 2)
+        await alice.disconnect()
+
+    async def test_deleted_chat_closes_open_sockets(self):
+        alice = await self.connect(self.alice)
+        await database_sync_to_async(delete_chat)(self.chat)
+        await alice.send_json_to({"message": "still there?"})
+        await self.assertClosed(alice)
+        self.assertFalse(await Message.objects.filter(chat_id=self.chat.id).aexists())
+
+    async def test_removed_member_is_closed(self):
+        alice = await self.connect(self.alice)
+        await database_sync_to_async(self.chat.members.remove)(self.alice)
+        clear_memberships()
+        await alice.send_json_to({"message": "hello"})
+        await self.assertClosed(alice)
+        self.assertFalse(await Message.objects.aexists())
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+class MessageWriterTests(TransactionTestCase):
+
+    def setUp(self):
+        self.alice = create_user("alice")
+        self.chat = create_chat(self.alice)
+
+    def message(self, text):
+        return Message(chat_id=self.chat.id, author=self.alice, text=text)
+
+    async def write(self, writer, *messages):
+        stored = [await writer.put(message) for message in messages]
+        results = await asyncio.gather(*stored)
+        await writer.close()
+        return results
+
+    async def test_senders_get_their_stored_message(self):
+        writer = MessageWriter(batch_size=10, interval=0.01, max_pending=100)
+        results = await self.write(writer, self.message("one"), self.message("two"))
+        self.assertEqual([message.text for message in results], ["one", "two"])
+        self.assertEqual(
+            [message.id for message in results],
+            [message.id async for message in Message.objects.order_by("id")],
+        )
+
+    async def test_bad_row_only_drops_itself(self):
+        writer = MessageWriter(batch_size=10, interval=0.01, max_pending=100)
+
+        def reject_lost(messages):
+            if any(message.text == "lost" for message in messages):
+                raise IntegrityError("rejected")
+            return store_messages(messages)
+
+        with patch("chat.writer.store_messages", reject_lost), self.assertLogs("chat.writer", "WARNING"):
+            results = await self.write(writer, self.message("one"), self.message("lost"), self.message("two"))
+        self.assertIsNone(results[1])
+        self.assertEqual([message async for message in Message.objects.values_list("text", flat=True)], ["one", "two"])
+
+    async def test_transient_errors_are_retried(self):
+        writer = MessageWriter(batch_size=10, interval=0.01, max_pending=100, retries=2, retry_delay=0)
+        calls = []
+
+        def locked_once(messages):
+            calls.append(len(messages))
+            if len(calls) == 1:
+                raise OperationalError("database is locked")
+            return store_messages(messages)
+
+        with patch("chat.writer.store_messages", locked_once):
+            results = await self.write(writer, self.message("one"), self.message("two"))
+        self.assertEqual(calls, [2, 2])
+        self.assertTrue(all(message.id for message in results))
+        self.assertEqual(await Message.objects.acount(), 2)
+
+
+class HistoryTests(ChatTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.messages = store_messages([
+            Message(chat=self.chat, author=self.bob, text=f"message {number}") for number in range(7)
+        ])
+        # Ties on created_at are broken by id
+        Message.objects.filter(id__in=[message.id for message in self.messages[2:5]]).update(
+            created_at=self.messages[2].created_at
+        )
+
+    def test_pages_walk_back_without_gaps(self):
+        seen, cursor = [], None
+        while True:
+            page, cursor = get_history_page(self.chat.id, before=cursor, limit=3)
+            seen = [message.id for message in page] + seen
+            if cursor is None:
+                break
+        self.assertEqual(seen, [message.id for message in self.messages])
+
+    def test_invalid_cursor_gets_the_newest_page(self):
+        page, cursor = get_history_page(self.chat.id, before="not a cursor", limit=3)
+        self.assertEqual([message.id for message in page], [message.id for message in self.messages[-3:]])
+        self.assertIsNotNone(cursor)
+
+    def test_cached_page_shows_new_messages(self):
+        self.assertContains(self.get(f"/chat/{self.chat.id}/"), "message 6")
+        store_messages([Message(chat=self.chat, author=self.bob, text="message 7")])
+        self.assertContains(self.get(f"/chat/{self.chat.id}/"), "message 7")
+
+
+class RateLimiterTests(TestCase):
+
+    async def test_buckets_refill_at_their_rate(self):
+        limiter = InMemoryRateLimiter()
+        limits = [("connection", 10, 2), ("user", 100, 5)]
+        self.assertEqual(await limiter.hit(limits), 0)
+        self.assertEqual(await limiter.hit(limits), 0)
+        self.assertAlmostEqual(await limiter.hit(limits), 0.1, delta=0.01)
+        await asyncio.sleep(0.1)
+        self.assertEqual(await limiter.hit(limits), 0)
+
+    async def test_an_empty_bucket_takes_no_token_from_the_others(self):
+        limiter = InMemoryRateLimiter()
+        self.assertEqual(await limiter.hit([("connection", 1, 1)]), 0)
+        self.assertGreater(await limiter.hit([("connection", 1, 1), ("user", 1, 1)]), 0)
+        self.assertEqual(await limiter.hit([("user", 1, 1)]), 0)
+
+
+class SendNotificationsTests(ChatTestCase):
+
+    def test_active_recipients_get_the_batch(self):
+        layer = get_channel_layer()
+        channels = {}
+        for user in (self.alice, self.bob):
+            channels[user.id] = async_to_sync(layer.new_channel)()
+            async_to_sync(layer.group_add)(notification_group(user.id), channels[user.id])
+        User.objects.filter(pk=self.bob.pk).update(is_active=False)
+
+        payload = {"message": "New friend request!", "sender": "carol"}
+        send_notifications([(self.alice.id, payload), (self.bob.id, payload)])
+        self.assertEqual(async_to_sync(layer.receive)(channels[self.alice.id]), {"type": "notify", **payload})
+        with self.assertRaises(asyncio.TimeoutError):
+            async_to_sync(asyncio.wait_for)(layer.receive(channels[self.bob.id]), 0.1)
+
+    def test_tasks_queued_by_the_previous_release_are_delivered(self):
+        layer = get_channel_layer()
+        channel = async_to_sync(layer.new_channel)()
+        async_to_sync(layer.group_add)(notification_group(self.alice.id), channel)
+        send_notification(self.alice.id, "New Message!")
+        self.assertEqual(async_to_sync(layer.receive)(channel), {
+            "type": "notify", "message": "New Message!", "sender": "",
+        })
+
+
+class ContentAddressedStorageTests(MediaTestCase):
+
+    def send(self, content, name="notes.txt"):
+        return Message.objects.create(chat=self.chat, author=self.bob, file=SimpleUploadedFile(name, content))
+
+    def test_same_content_is_stored_once(self):
+        first, second = self.send(b"same bytes"), self.send(b"same bytes", name="copy.txt")
+        self.assertEqual(first.file.name, second.file.name)
+        self.assertRegex(first.file.name, r"^chat_files/[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{64}\.txt$")
+        blob = StoredBlob.objects.get()
+        self.assertEqual((blob.name, blob.size, blob.references), (first.file.name, 10, 2))
+
+    def test_files_are_deleted_with_their_last_reference(self):
+        first, second = self.send(b"same bytes"), self.send(b"same bytes")
+        storage = chat_storage()
+        name = first.file.name
+
+        first.delete()
+        self.assertEqual(StoredBlob.objects.get().references, 1)
+        self.assertEqual(storage.delete_unreferenced([name]), 0)
+        self.assertTrue(storage.exists(name))
+
+        second.delete()
+        self.assertEqual(storage.delete_unreferenced([name]), 1)
+        self.assertFalse(storage.exists(name))
+        self.assertFalse(StoredBlob.objects.exists())
+
+    def test_existing_files_are_deduplicated(self):
+        storage = FileSystemStorage(location=chat_storage().location)
+        names = [storage.save(f"chat_files/{name}", ContentFile(b"legacy bytes")) for name in ("a.txt", "b.txt")]
+        messages = [Message.objects.create(chat=self.chat, author=self.bob, text="legacy") for _ in names]
+        for message, name in zip(messages, names):
+            Message.objects.filter(pk=message.pk).update(file=name)
+
+        call_command("dedupe_chat_files", stdout=StringIO())
+        stored = set(Message.objects.values_list("file", flat=True))
+        self.assertEqual(len(stored), 1)
+        self.assertEqual(StoredBlob.objects.get().references, 2)
+        self.assertTrue(all(not storage.exists(name) for name in names))
+        self.assertTrue(storage.exists(stored.pop()))
+
+
+class ChatDeletionTests(MediaTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.attachment = Attachment.objects.create(
+            chat=self.chat, uploaded_by=self.bob, file=SimpleUploadedFile("shared.txt", b"shared bytes"),
+            name="shared.txt", content_type="text/plain", size=12,
+        )
+        store_messages([
+            Message(chat=self.chat, author=self.bob, text=f"message {number}") for number in range(5)
+        ] + [Message(chat=self.chat, author=self.bob, attachment=self.attachment, file=self.attachment.file.name)])
+
+    def test_view_hides_the_chat_and_queues_the_purge(self):
+        with patch("chat.views.purge_deleted_chat") as purge, self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(f"/chat/{self.chat.id}/delete/", HTTP_HOST="localhost")
+        self.assertRedirects(response, "/chat/chats/", fetch_redirect_response=False)
+        job = ChatDeletionJob.objects.get(chat_id=self.chat.id)
+        purge.delay.assert_called_once_with(job.id)
+        self.assertFalse(Chat.objects.filter(pk=self.chat.pk).exists())
+        self.assertEqual(self.get(f"/chat/{self.chat.id}/").status_code, 404)
+
+    @override_settings(CHAT_DELETION_BATCH_SIZE=2)
+    def test_purge_deletes_history_and_files_in_batches(self):
+        name = self.attachment.file.name
+        job = delete_chat(self.chat)
+        purge_chat(job)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, ChatDeletionJob.Status.DONE)
+        self.assertEqual((job.messages_deleted, job.attachments_deleted, job.files_deleted), (6, 1, 1))
+        self.assertFalse(Chat.all_objects.filter(pk=self.chat.pk).exists())
+        self.assertFalse(Message.objects.exists())
+        self.assertFalse(chat_storage().exists(name))
+
+    @override_settings(CHAT_DELETION_BATCH_SIZE=2)
+    def test_interrupted_purge_continues_where_it_stopped(self):
+        job = delete_chat(self.chat)
+        _delete_batch(job, Message.objects.filter(chat_id=self.chat.id), "messages_deleted")
+        ChatDeletionJob.objects.filter(pk=job.pk).update(updated_at=timezone.now() - timedelta(hours=1))
+        self.assertEqual(list(stalled_jobs()), [job])
+
+        with patch("chat.tasks.purge_deleted_chat.delay", lambda job_id: purge_deleted_chat(job_id)):
+            resume_chat_deletions()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.messages_deleted), (ChatDeletionJob.Status.DONE, 6))
+        self.assertFalse(stalled_jobs().exists())
+
+
+class OrphanedMediaTests(MediaTestCase):
+
+    def age(self, storage, name, seconds=3600):
+        past = time.time() - seconds
+        os.utime(storage.path(name), (past, past))
+
+    def orphan(self, storage, name, content=b"orphan"):
+        name = FileSystemStorage(location=storage.location).save(name, ContentFile(content))
+        self.age(storage, name)
+        return name
+
+    def test_orphans_older_than_the_grace_period_are_deleted(self):
+        storage = chat_storage()
+        kept = Message.objects.create(chat=self.chat, author=self.bob, file=SimpleUploadedFile("kept.txt", b"kept"))
+        self.age(storage, kept.file.name)
+        old = self.orphan(storage, "chat_files/old.txt")
+        young = FileSystemStorage(location=storage.location).save("chat_files/young.txt", ContentFile(b"young"))
+
+        report = collect_orphaned_media(dry_run=True, grace=60)
+        self.assertEqual((report.scanned, report.orphaned, report.orphaned_bytes), (2, 1, 6))
+        self.assertTrue(storage.exists(old))
+
+        collect_orphaned_media(grace=60)
+        self.assertFalse(storage.exists(old))
+        self.assertTrue(storage.exists(young))
+        self.assertTrue(storage.exists(kept.file.name))
+
+    def test_released_blobs_are_deleted_once_idle(self):
+        storage = chat_storage()
+        message = Message.objects.create(chat=self.chat, author=self.bob, file=SimpleUploadedFile("gone.txt", b"gone"))
+        name = message.file.name
+        Message.objects.filter(pk=message.pk).delete()
+        self.age(storage, name)
+
+        collect_orphaned_media(grace=60)
+        self.assertTrue(storage.exists(name), "released within the grace period")
+        StoredBlob.objects.update(updated_at=timezone.now() - timedelta(hours=1))
+        collect_orphaned_media(grace=60)
+        self.assertFalse(storage.exists(name))
+        self.assertFalse(StoredBlob.objects.exists())
+
+    def test_replaced_avatars_are_deleted_with_their_renditions(self):
+        self.bob.image = image_file("first.png")
+        self.bob.save()
+        first = self.bob.image.name
+        sized = self.bob.image.crop["70x70"].name
+        self.bob.image = image_file("second.png", color="blue")
+        self.bob.save()
+        self.age(default_storage, first)
+
+        collect_orphaned_media(grace=60)
+        self.assertFalse(default_storage.exists(first))
+        self.assertFalse(default_storage.exists(sized))
+        self.assertTrue(default_storage.exists(self.bob.image.name))
+
+    @override_settings(CHAT_ATTACHMENT_UNSENT_TTL=60)
+    def test_unsent_attachments_are_deleted(self):
+        unsent = Attachment.objects.create(
+            chat=self.chat, uploaded_by=self.bob, file=SimpleUploadedFile("unsent.txt", b"unsent"),
+            name="unsent.txt", content_type="text/plain", size=6,
+        )
+        Attachment.objects.filter(pk=unsent.pk).update(created_at=timezone.now() - timedelta(hours=1))
+
+        report = collect_orphaned_media(grace=60)
+        self.assertEqual(report.unsent_attachments, 1)
+        self.assertFalse(Attachment.objects.exists())
+        self.assertFalse(chat_storage().exists(unsent.file.name))
+
+
+class AttachmentUploadTests(MediaTestCase):
+
+    def test_upload_returns_the_attachment(self):
+        response = self.upload(SimpleUploadedFile("notes.txt", b"some notes", content_type="text/plain"))
+        self.assertEqual(response.status_code, 201)
+        attachment = Attachment.objects.get(pk=response.json()["id"])
+        self.assertEqual((attachment.name, attachment.size, attachment.uploaded_by), ("notes.txt", 10, self.alice))
+        self.assertEqual(response.json()["url"], attachment.file.url)
+        self.render.delay.assert_not_called()
+
+    def test_only_members_upload(self):
+        other = create_chat(self.bob, create_user("carol"))
+        self.assertEqual(self.upload(SimpleUploadedFile("notes.txt", b"x"), chat=other).status_code, 404)
+        self.assertFalse(Attachment.objects.exists())
+
+    def test_scripts_are_not_rendered_inline(self):
+        svg = b'<svg xmlns="http://www.w3.org/2000/svg"><script>alert(1)</script></svg>'
+        response = self.upload(SimpleUploadedFile("image.svg", svg, content_type="image/svg+xml"))
+        response = self.get(response.json()["url"])
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["Content-Disposition"].startswith("attachment;"))
+        self.assertEqual(response["Content-Security-Policy"], "sandbox")
+        self.assertEqual(response["X-Content-Type-Options"], "nosniff")
+
+    def test_raster_images_are_rendered_inline(self):
+        response = self.get(self.upload(image_file()).json()["url"])
+        self.assertEqual(response["Content-Type"], "image/png")
+        self.assertNotIn("Content-Disposition", response)
+
+    @override_settings(CHAT_ATTACHMENT_MAX_SIZE=4)
+    def test_large_files_are_rejected(self):
+        response = self.upload(SimpleUploadedFile("notes.txt", b"too large", content_type="text/plain"))
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("file", response.json()["errors"])
+
+
+class RenditionTests(MediaTestCase):
+
+    def test_images_get_a_thumbnail_and_placeholder(self):
+        response = self.upload(image_file(size=(1200, 600)))
+        attachment = Attachment.objects.get(pk=response.json()["id"])
+        self.assertEqual(attachment.renditions, Attachment.Renditions.PENDING)
+        self.render.delay.assert_called_once_with(attachment.id)
+
+        render_attachment(attachment.id)
+        attachment.refresh_from_db()
+        self.assertEqual(attachment.renditions, Attachment.Renditions.READY)
+        self.assertEqual((attachment.width, attachment.height), (1200, 600))
+        self.assertTrue(attachment.placeholder.startswith("data:image/"))
+        with chat_storage().open(attachment.thumbnail.name) as thumbnail:
+            self.assertLessEqual(max(Image.open(thumbnail).size), settings.CHAT_THUMBNAIL_SIZE)
+
+        serialized = serialize_attachment(attachment)
+        self.assertEqual(serialized["thumbnail"], attachment.thumbnail.url)
+        self.assertEqual(self.get(serialized["thumbnail"]).status_code, 200)
+        self.client.force_login(create_user("carol"))
+        self.assertEqual(self.get(serialized["thumbnail"]).status_code, 404)
+
+    def test_broken_images_are_marked_failed(self):
+        response = self.upload(SimpleUploadedFile("broken.png", b"not an image", content_type="image/png"))
+        render_attachment(response.json()["id"])
+        attachment = Attachment.objects.get(pk=response.json()["id"])
+        self.assertEqual(attachment.renditions, Attachment.Renditions.FAILED)
+        self.assertIsNone(serialize_attachment(attachment)["thumbnail"])
+
+
+class PresenceTests(SimpleTestCase):
+
+    async def test_tabs_of_a_user_count_once(self):
+        presence = InMemoryPresence(ttl=60)
+        self.assertEqual(await presence.join(1, "alice", "tab-1"), 1)
+        self.assertIsNone(await presence.join(1, "alice", "tab-2"))
+        self.assertEqual(await presence.join(1, "bob", "tab-3"), 2)
+        self.assertEqual(await presence.snapshot(1), (["alice", "bob"], 2, []))
+
+        self.assertIsNone(await presence.leave(1, "alice", "tab-1"))
+        self.assertEqual(await presence.leave(1, "alice", "tab-2"), 3)
+        self.assertIsNone(await presence.leave(1, "alice", "tab-2"))
+        self.assertEqual(await presence.snapshot(1), (["bob"], 3, []))
+
+    async def test_connections_without_heartbeat_expire(self):
+        presence = InMemoryPresence(ttl=60)
+        await presence.join(1, "alice", "tab-1")
+        await presence.join(2, "bob", "tab-2")
+        presence.ttl = -1
+        await presence.heartbeat(1, "alice", "tab-1")
+        self.assertEqual(await presence.sweep(), {"1": [[2, "leave", "alice"]]})
+        self.assertEqual(await presence.snapshot(1), ([], 2, []))
+        self.assertEqual((await presence.snapshot(2))[0], ["bob"])
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+class PresenceBroadcastTests(SimpleTestCase):
+
+    async def test_changes_of_a_window_are_sent_as_one_delta(self):
+        layer = get_channel_layer()
+        channel = await layer.new_channel()
+        await layer.group_add("chat_1", channel)
+        broadcaster = PresenceBroadcaster(window=0.01)
+        broadcaster.publish(1, [[2, "leave", "alice"]])
+        broadcaster.publish(1, [[1, "join", "bob"]])
+        broadcaster.publish(1, [])
+
+        event = await asyncio.wait_for(layer.receive(channel), 1)
+        self.assertEqual(json.loads(event["text"]), {
+            "type": "presence_delta", "changes": [[1, "join", "bob"], [2, "leave", "alice"]],
+        })
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(layer.receive(channel), 0.05)
+
+
+class MembershipCacheTests(ConsumerTestCase):
+
+    async def test_membership_is_loaded_once(self):
+        with patch("chat.membership.load_membership", wraps=load_membership) as load:
+            membership = await get_membership(self.chat.id)
+            self.assertIs(await get_membership(str(self.chat.id)), membership)
+        load.assert_called_once_with(self.chat.id)
+        self.assertEqual(membership.members, {self.alice.id: "alice", self.bob.id: "bob"})
+        self.assertEqual(membership.recipients(self.alice.id), [(self.bob.id, "bob")])
+
+    async def test_member_changes_invalidate_it(self):
+        await get_membership(self.chat.id)
+        carol = await database_sync_to_async(create_user)("carol")
+        await database_sync_to_async(self.chat.members.add)(carol)
+        self.assertIn(carol.id, await get_membership(self.chat.id))
+        await database_sync_to_async(carol.chats.remove)(self.chat)
+        self.assertNotIn(carol.id, await get_membership(self.chat.id))
+
+    async def test_deleted_and_unknown_chats_have_none(self):
+        await get_membership(self.chat.id)
+        await database_sync_to_async(delete_chat)(self.chat)
+        self.assertIsNone(await get_membership(self.chat.id))
+        self.assertIsNone(await get_membership("not an id"))
+
+
+class GroupSendManyTests(SimpleTestCase):
+
+    async def test_every_group_gets_the_message_once(self):
+        layer = InMemoryChannelLayer()
+        first, second = await layer.new_channel(), await layer.new_channel()
+        await layer.group_add("user_1", first)
+        await layer.group_add("user_2", second)
+        await layer.group_add("user_3", second)
+        await group_send_many(layer, (f"user_{i}" for i in range(1, 5)), {"type": "ping"})
+
+        self.assertEqual(await layer.receive(first), {"type": "ping"})
+        self.assertEqual(await layer.receive(second), {"type": "ping"})
+        self.assertEqual(await layer.receive(second), {"type": "ping"})
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(layer.receive(first), 0.05)
+
+    async def test_no_groups_sends_nothing(self):
+        layer = InMemoryChannelLayer()
+        with patch.object(layer, "group_send") as group_send:
+            await group_send_many(layer, [], {"type": "ping"})
+        group_send.assert_not_called()
+
+
+class ReadMarkerTests(ChatTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.messages = store_messages([
+            Message(chat=self.chat, author=self.bob, text=f"message {i}") for i in range(3)
+        ])
+
+    def mark(self, message_id, user=None):
+        user = user or self.alice
+        return store_read_markers({(self.chat.id, user.id): (user.username, message_id)})
+
+    def test_markers_are_clamped_and_never_move_backwards(self):
+        newest = self.messages[-1].id
+        self.assertEqual(self.mark(newest + 100), {self.chat.id: {"alice": newest}})
+        self.assertEqual(self.mark(self.messages[0].id), {})
+        self.assertEqual(self.mark(None), {})
+        self.assertEqual(get_read_receipts(self.chat.id), {"alice": newest})
+
+    def test_none_marks_the_whole_chat_as_read(self):
+        self.assertEqual(self.mark(None, self.bob), {self.chat.id: {"bob": self.messages[-1].id}})
+
+
+class ReceiptBufferTests(SimpleTestCase):
+
+    async def test_the_furthest_mark_is_kept(self):
+        buffer = ReceiptBuffer(interval=0)
+        with patch("chat.receipts.store_read_markers", return_value={}) as store:
+            buffer.mark_read(1, 2, "alice", 11)
+            buffer.mark_read("1", 2, "alice", 10)
+            buffer.mark_read(1, 3, "bob", None)
+            buffer.mark_read(1, 3, "bob", 12)
+            buffer.mark_read("not an id", 3, "bob")
+            await buffer._task
+        store.assert_called_once_with({
+            (1, 2): ("alice", 11),
+            (1, 3): ("bob", None),
+        })
+
+
+class InboxSummaryTests(ChatTestCase):
+
+    def inbox(self, user):
+        return {chat.id: chat for chat in Chat.objects.inbox_for(user)}
+
+    def test_new_messages_are_unread_for_other_members(self):
+        group = create_chat(self.alice, self.bob, is_group=True)
+        store_messages([
+            Message(chat=self.chat, author=self.bob, text="hello"),
+            Message(chat=self.chat, author=self.alice, text="hi"),
+            Message(chat=self.chat, author=self.bob, text="x" * 150),
+        ])
+        inbox = self.inbox(self.alice)
+        self.assertEqual(list(inbox), [self.chat.id, group.id])
+        self.assertEqual(inbox[self.chat.id].unread_count, 2)
+        self.assertEqual(inbox[self.chat.id].last_message_preview, "x" * 99 + "…")
+        self.assertEqual(inbox[group.id].unread_count, 0)
+        self.assertIsNone(inbox[group.id].last_message_id)
+        self.assertEqual(self.inbox(self.bob)[self.chat.id].unread_count, 1)
+
+    def test_reads_recount_unread_messages(self):
+        messages = store_messages([Message(chat=self.chat, author=self.bob, text=str(i)) for i in range(3)])
+        store_read_markers({(self.chat.id, self.alice.id): ("alice", messages[0].id)})
+        self.assertEqual(self.inbox(self.alice)[self.chat.id].unread_count, 2)
+        store_read_markers({(self.chat.id, self.alice.id): ("alice", None)})
+        self.assertEqual(self.inbox(self.alice)[self.chat.id].unread_count, 0)
+
+    def test_members_joining_get_the_current_snapshot(self):
+        message, = store_messages([Message(chat=self.chat, author=self.bob, text="hello")])
+        carol = create_user("carol")
+        self.chat.members.add(carol)
+        chat = self.inbox(carol)[self.chat.id]
+        self.assertEqual((chat.unread_count, chat.last_message_id), (1, message.id))
+        self.chat.members.remove(carol)
+        self.assertNotIn(self.chat.id, self.inbox(carol))
+
+    def test_listing_does_not_read_messages(self):
+        store_messages([Message(chat=self.chat, author=self.bob, text="hello")])
+        with CaptureQueriesContext(connection) as queries:
+            self.assertContains(self.get("/chat/chats/"), "hello")
+        self.assertFalse(any('"chat_message"' in query["sql"] for query in queries))
+
+
+class InboxConsumerTests(ConsumerTestCase):
+
+    async def connect_inbox(self, user):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), "/ws/inbox/")
+        communicator.scope["user"] = user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def test_new_messages_update_every_inbox(self):
+        inbox = await self.connect_inbox(self.bob)
+        alice = await self.connect(self.alice)
+        await alice.send_json_to({"message": "hello"})
+        frame = await self.receive(inbox, "inbox_message")
+        self.assertEqual(
+            (frame["chat_id"], frame["username"], frame["preview"]), (self.chat.id, "alice", "hello")
+        )
+        await alice.disconnect()
+        await inbox.disconnect()
+
+    async def test_member_changes_update_the_inboxes(self):
+        carol = await database_sync_to_async(create_user)("carol")
+        carol_inbox, bob_inbox = await self.connect_inbox(carol), await self.connect_inbox(self.bob)
+        await database_sync_to_async(self.chat.members.add)(carol)
+        self.assertEqual(await self.receive(carol_inbox, "inbox_chat"), {
+            "type": "inbox_chat", "chat_id": self.chat.id, "action": "added",
+        })
+        self.assertEqual((await self.receive(bob_inbox, "inbox_chat"))["action"], "changed")
+        await carol_inbox.disconnect()
+        await bob_inbox.disconnect()
+
+    async def test_anonymous_users_are_refused(self):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), "/ws/inbox/")
+        communicator.scope["user"] = AnonymousUser()
+        connected, _ = await communicator.connect()
+        self.assertFalse(connected)
+
+
+class ChatCardTests(ChatTestCase):
+
+    def test_members_get_the_card(self):
+        response = self.get(f"/chat/{self.chat.id}/card/")
+        self.assertContains(response, f'data-chat-id="{self.chat.id}"')
+        self.assertContains(response, "bob")
+
+    def test_other_users_get_404(self):
+        self.client.force_login(create_user("carol"))
+        self.assertEqual(self.get(f"/chat/{self.chat.id}/card/").status_code, 404)
+        delete_chat(self.chat)
+        self.client.force_login(self.alice)
+        self.assertEqual(self.get(f"/chat/{self.chat.id}/card/").status_code, 404)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+class NotificationDispatcherTests(SimpleTestCase):
+
+    async def test_bursts_are_coalesced_per_recipient(self):
+        layer = get_channel_layer()
+        alice, bob = await layer.new_channel(), await layer.new_channel()
+        await layer.group_add(notification_group(1), alice)
+        await layer.group_add(notification_group(2), bob)
+        group = ChatMembership(chat_id=7, name="Team", is_group=True, members={1: "alice", 2: "bob", 3: "carol"})
+
+        dispatcher = NotificationDispatcher(window=0.01)
+        dispatcher.notify(group, 3, "carol")
+        dispatcher.notify(group, 3, "carol")
+        dispatcher.notify(group, 1, "alice")
+        await dispatcher._task
+
+        self.assertEqual(await layer.receive(alice), notification_event(7, "Team", "carol", 2))
+        self.assertEqual(await layer.receive(bob), {
+            "type": "notify", "message": "3 new messages", "sender": "alice", "chat_id": 7, "chat": "Team", "count": 3,
+        })
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(layer.receive(bob), 0.05)
+
+    async def test_private_chats_have_no_name(self):
+        layer = get_channel_layer()
+        channel = await layer.new_channel()
+        await layer.group_add(notification_group(2), channel)
+        dispatcher = NotificationDispatcher(window=0)
+        private = ChatMembership(chat_id=7, name="", is_group=False, members={1: "alice", 2: "bob"})
+        dispatcher.notify(private, 1, "alice")
+        await dispatcher._task
+        self.assertEqual(await layer.receive(channel), {
+            "type": "notify", "message": "New Message!", "sender": "alice", "chat_id": 7, "chat": None, "count": 1,
+        })
+
+    def test_authors_alone_queue_nothing(self):
+        dispatcher = NotificationDispatcher(window=0)
+        dispatcher.notify(ChatMembership(chat_id=7, name="", is_group=False, members={1: "alice"}), 1, "alice")
+        self.assertIsNone(dispatcher._task)
+
+
+class ChatFingerprintTests(ChatTestCase):
+
+    def create(self, *friends):
+        data = {"name": "", "friends_checkboxes": [friend.id for friend in friends]}
+        return self.client.post("/chat/create/", data, HTTP_HOST="localhost")
+
+    def test_fingerprint_follows_the_members(self):
+        self.assertEqual(member_fingerprint([self.bob.id, self.alice.id, self.bob.id]),
+                         member_fingerprint([self.alice.id, self.bob.id]))
+        self.assertEqual(list(Chat.objects.with_members([self.bob.id, self.alice.id])), [self.chat])
+        carol = create_user("carol")
+        self.chat.members.add(carol)
+        self.assertEqual(list(Chat.objects.with_members([self.alice.id, self.bob.id, carol.id])), [self.chat])
+        self.chat.members.remove(self.alice, self.bob, carol)
+        self.chat.refresh_from_db()
+        self.assertEqual(self.chat.member_fingerprint, "")
+
+    def test_existing_chats_are_reused(self):
+        self.assertRedirects(self.create(self.bob), f"/chat/{self.chat.id}/", fetch_redirect_response=False)
+        carol = create_user("carol")
+        self.create(self.bob, carol)
+        group = Chat.objects.with_members([self.alice.id, self.bob.id, carol.id]).get()
+        self.assertTrue(group.is_group)
+        self.assertRedirects(self.create(carol, self.bob), f"/chat/{group.id}/", fetch_redirect_response=False)
+        self.assertEqual(Chat.objects.count(), 2)
+
+    def test_one_private_chat_per_pair(self):
+        fingerprint = member_fingerprint([self.alice.id, self.bob.id])
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Chat.objects.create(member_fingerprint=fingerprint)
+
+        delete_chat(self.chat)
+        self.create(self.bob)
+        chat = Chat.objects.with_members([self.alice.id, self.bob.id]).get()
+        self.assertFalse(chat.is_group)
+        self.assertNotEqual(chat.id, self.chat.id)
+        # Groups may have the same members
+        Chat.objects.create(is_group=True, member_fingerprint=fingerprint)
@@ -8,6 +8,9 @@ app_name = "chat"
 urlpatterns = [
     path("chats/", views.ChatListingView.as_view(), name="home"),
     path("create/", views.ChatCreationView.as_view(), name="create"),
+    path("search/", views.MessageSearchView.as_view(), name="search"),
     path("<str:conversation>/", views.ChatDetailView.as_view(), name="conversation"),
     path("<str:conversation>/delete/", views.ChatDeletionView.as_view(), name="delete"),
+    path("<str:conversation>/attachments/", views.AttachmentUploadView.as_view(), name="upload"),
+    path("<str:conversation>/card/", views.ChatCardView.as_view(), name="card"),
 ]
\ No newline at end of file
@@ -1,11 +1,24 @@
+import os
+from django.conf import settings
 from django.contrib.auth.decorators import login_required
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files.storage import default_storage
+from django.db import IntegrityError, transaction
 from django.db.models import Count
-from django.shortcuts import get_object_or_404, redirect
+from django.http import Http404, JsonResponse
+from django.shortcuts import get_object_or_404, redirect, render
 from django.urls import reverse_lazy
 from django.utils.decorators import method_decorator
-from django.views.generic import ListView, CreateView, DeleteView
-from chat.forms import ChatCreationForm, ChatDeletionForm
-from chat.models import Chat
+from django.views import View
+from django.views.generic import ListView, CreateView, DeleteView, DetailView
+from chat.deletion import delete_chat
+from chat.forms import ChatCreationForm, ChatDeletionForm, AttachmentForm
+from chat.history import HistoryPage, serialize_attachment
+from chat.media import can_access, serve_file
+from chat.models import Chat, Attachment, member_fingerprint
+from chat.renditions import needs_renditions
+from chat.search import search_messages
+from chat.tasks import render_attachment, purge_deleted_chat
 from user.models import User
 
 
@@ -19,9 +32,7 @@ class ChatListingView(ListView):
     context_object_name = "chats"
 
     def get_queryset(self):
-        return Chat.objects.filter(
-            members=self.request.user
-        ).prefetch_related("members").all()
+        return Chat.objects.inbox_for(self.request.user)
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -32,27 +43,48 @@ class ChatListingView(ListView):
 
 
 @method_decorator(login_required, name="dispatch")
-class ChatDetailView(ListView):
+class ChatDetailView(DetailView):
     """
-    List all messages in a chat.
+    Show the newest page of messages in a chat.
+    Older pages are loaded over the socket with the history cursor.
     """
     template_name = "chat/conversation.html"
     model = Chat
-    context_object_name = "messages"
+    context_object_name = "chat"
 
-    def get_queryset(self):
-        chat = get_object_or_404(Chat, id=self.kwargs.get("conversation"))
-        return chat.messages.select_related("author")
+    def get_object(self, queryset=None):
+        # The sidebar already holds the chat with its members and last message id,
+        # a chat missing from it is one the user is not a member of
+        self.chats = list(Chat.objects.inbox_for(self.request.user))
+        conversation = self.kwargs.get("conversation")
+        for chat in self.chats:
+            if str(chat.id) == conversation:
+                return chat
+        raise Http404("No chat found matching the query")
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context["image_formats"] = ["png", "jpg", "jpeg", "gif", "svg", "webp"]
-        context["chats"] = Chat.objects.filter(members=self.request.user).prefetch_related("members")
+        context["chats"] = self.chats
         context["conversation"] = self.kwargs.get("conversation")
-        context["chat"] = get_object_or_404(Chat, id=context["conversation"])
+        context["page"] = HistoryPage(self.object.id)
+        context["cache_timeout"] = settings.CHAT_MESSAGES_CACHE_TIMEOUT
         return context
 
 
+@method_decorator(login_required, name="dispatch")
+class ChatCardView(View):
+    """
+    Render the card of a single chat.
+    Live inboxes fetch it when a chat is added or its members change,
+    instead of reloading the whole chat list.
+    """
+
+    def get(self, request, conversation):
+        chat = get_object_or_404(Chat.objects.inbox_for(request.user), id=conversation)
+        return render(request, "chat/components/chat.html", {"chat": chat})
+
+
 @method_decorator(login_required, name="dispatch")
 class ChatCreationView(CreateView):
     """
@@ -69,26 +101,36 @@ class ChatCreationView(CreateView):
 
     def form_valid(self, form):
         friends = form.cleaned_data.get("friends_checkboxes")
-        chat_instance = form.save(commit=False)
-        if len(friends) == 1:
-            chat_instance.is_group = False
-        else:
-            chat_instance.is_group = True
-        chat_instance.save()
+        member_ids = [friend.id for friend in friends] + [self.request.user.id]
 
-        all_members = list(friends) + [self.request.user]
-        existing_chat = Chat.objects.filter(members__in=all_members)
-        for chat in existing_chat:
-            if set(chat.members.all()) == set(all_members):
-                return self.form_invalid(form)
-        chat_instance.members.add(*friends, self.request.user)
-        return super().form_valid(form)
+        # A chat with exactly these members is found through the fingerprint index before any write
+        existing_chat = Chat.objects.with_members(member_ids).first()
+        if existing_chat is not None:
+            return redirect("chat:conversation", existing_chat.id)
+
+        chat_instance = form.save(commit=False)
+        chat_instance.is_group = len(friends) != 1
+        chat_instance.member_fingerprint = member_fingerprint(member_ids)
+        try:
+            with transaction.atomic():
+                chat_instance.save()
+                chat_instance.members.add(*friends, self.request.user)
+        except IntegrityError:
+            # The same private chat was created concurrently
+            existing_chat = Chat.objects.with_members(member_ids).filter(is_group=False).first()
+            if existing_chat is None:
+                raise
+            return redirect("chat:conversation", existing_chat.id)
+
+        self.object = chat_instance
+        return redirect(self.get_success_url())
 
 
 @method_decorator(login_required, name="dispatch")
 class ChatDeletionView(DeleteView):
     """
-    Delete a chat
+    Delete a chat of the user.
+    The chat is hidden right away, its history is purged in the background.
     """
     form_class = ChatDeletionForm
     success_url = reverse_lazy("chat:home")
@@ -96,4 +138,75 @@ class ChatDeletionView(DeleteView):
 
     def get_object(self, queryset=None):
         conversation = self.kwargs.get('conversation')
-        return get_object_or_404(Chat, id=conversation)
\ No newline at end of file
+        return get_object_or_404(Chat, id=conversation, members=self.request.user)
+
+    def form_valid(self, form):
+        job = delete_chat(self.object)
+        transaction.on_commit(lambda: purge_deleted_chat.delay(job.id))
+        return redirect(self.get_success_url())
+
+
+@method_decorator(login_required, name="dispatch")
+class AttachmentUploadView(View):
+    """
+    Upload a file to a chat.
+    The file is streamed to storage and the chat message only
+    carries the id of the returned attachment. Thumbnails of images
+    are made by a Celery task once the upload is committed.
+    """
+
+    def post(self, request, conversation):
+        chat = get_object_or_404(Chat, id=conversation, members=request.user)
+        form = AttachmentForm(request.POST, request.FILES)
+        if not form.is_valid():
+            return JsonResponse({"errors": form.errors}, status=400)
+
+        attachment = form.save(commit=False)
+        attachment.chat = chat
+        attachment.uploaded_by = request.user
+        if needs_renditions(attachment):
+            attachment.renditions = Attachment.Renditions.PENDING
+        attachment.save()
+        if attachment.renditions == Attachment.Renditions.PENDING:
+            transaction.on_commit(lambda: render_attachment.delay(attachment.id))
+        return JsonResponse(serialize_attachment(attachment), status=201)
+
+
+@method_decorator(login_required, name="dispatch")
+class MessageSearchView(View):
+    """
+    Search messages in the chats of the user.
+    Results are ranked by relevance and paginated.
+    """
+
+    def get(self, request):
+        text = request.GET.get("q", "")
+        chat_id = request.GET.get("chat") or None
+        try:
+            page = max(int(request.GET.get("page", 1)), 1)
+        except ValueError:
+            page = 1
+
+        results, has_next = search_messages(request.user, text, chat_id=chat_id, page=page)
+        return JsonResponse({
+            "results": results,
+            "page": page,
+            "has_next": has_next,
+        })
+
+
+@method_decorator(login_required, name="dispatch")
+class MediaView(View):
+    """
+    Serve an uploaded file to a user allowed to see it, with validators,
+    long lived caching of content addressed files and byte ranges.
+    """
+
+    def get(self, request, name):
+        try:
+            path = default_storage.path(name)
+        except SuspiciousFileOperation:
+            raise Http404
+        if not os.path.isfile(path) or not can_access(request.user, name):
+            raise Http404
+        return serve_file(request, name, path)
@@ -0,0 +1,202 @@
+import asyncio
+import atexit
+import logging
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import OperationalError, transaction
+from chat.inbox import record_messages
+from chat.models import Message
+from chat.storage import retain
+
+logger = logging.getLogger(__name__)
+
+
+def store_messages(messages):
+    """
+    Insert messages and update the inbox summaries in one transaction.
+    Messages are inserted with bulk_create, so post_save is not sent.
+    :param messages: list of unsaved Message instances
+    :return: list of saved messages
+    """
+    with transaction.atomic():
+        messages = Message.objects.bulk_create(messages)
+        record_messages(messages)
+        retain([message.file.name for message in messages if message.file])
+    return messages
+
+
+class MessageWriter:
+    """
+    Write-behind buffer for chat messages.
+    Messages are queued and inserted in batches every few milliseconds or
+    as soon as a batch is full, each sender waits for the batch holding its
+    message, so it is broadcast with its id. The queue is bounded, producers
+    wait when it is full, so a slow database slows senders down instead of
+    growing memory without limit.
+    """
+
+    def __init__(self, batch_size, interval, max_pending, retries=3, retry_delay=0.05):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_pending = max_pending
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.queue = None
+        self.task = None
+
+    async def put(self, message):
+        """
+        Queue a message, waiting while the buffer is full.
+        :return: Future resolved with the stored message, or None if it was dropped
+        """
+        if self.task is None or self.task.done():
+            self.queue = self.queue or asyncio.Queue(self.max_pending)
+            self.task = asyncio.create_task(self.run())
+        stored = asyncio.get_running_loop().create_future()
+        await self.queue.put((message, stored))
+        return stored
+
+    async def run(self):
+        """
+        Collect batches from the queue and insert them until a None
+        sentinel asks the writer to stop.
+        """
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self.queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = loop.time() + self.interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self.write(batch)
+
+    async def write(self, batch):
+        """
+        Insert a batch at once, or one message at a time when that fails,
+        so a bad row only drops itself.
+        :param batch: list of (message, future) pairs
+        """
+        try:
+            await self.store([message for message, _ in batch])
+        except Exception:
+            logger.warning("Failed to write %s buffered messages at once, writing them one by one",
+                           len(batch), exc_info=True)
+        else:
+            for message, stored in batch:
+                resolve(stored, message)
+            return
+
+        for message, stored in batch:
+            try:
+                await self.store([message])
+            except Exception:
+                logger.exception("Dropped a buffered message of chat %s", message.chat_id)
+                resolve(stored, None)
+            else:
+                resolve(stored, message)
+
+    async def store(self, messages):
+        """
+        Insert messages, retrying transient errors such as a locked database
+        with an exponential backoff.
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                return await database_sync_to_async(store_messages)(messages)
+            except OperationalError:
+                # bulk_create set primary keys the rollback discarded
+                for message in messages:
+                    message.pk = None
+                    message._state.adding = True
+                if attempt == self.retries:
+                    raise
+                await asyncio.sleep(self.retry_delay * 2 ** attempt)
+
+    def drain(self):
+        """
+        Take every message still waiting in the queue.
+        """
+        batch = []
+        while self.queue is not None and not self.queue.empty():
+            item = self.queue.get_nowait()
+            if item is not None:
+                batch.append(item[0])
+        return batch
+
+    async def close(self):
+        """
+        Stop the writer after it has inserted everything queued so far.
+        """
+        if self.task is not None and not self.task.done():
+            await self.queue.put(None)
+            await self.task
+        self.task = None
+
+    def flush(self):
+        """
+        Synchronous flush used at interpreter exit, when the loop is gone.
+        """
+        batch = self.drain()
+        if batch:
+            store_messages(batch)
+
+
+def resolve(future, result):
+    # The sender may have disconnected and cancelled its wait
+    if not future.done():
+        future.set_result(result)
+
+
+_writer = None
+
+
+def get_writer():
+    """
+    Get the write-behind writer of this process, or None if it is disabled.
+    """
+    global _writer
+    if _writer is None and settings.CHAT_WRITE_BEHIND:
+        _writer = MessageWriter(
+            batch_size=settings.CHAT_WRITE_BEHIND_BATCH_SIZE,
+            interval=settings.CHAT_WRITE_BEHIND_INTERVAL_MS / 1000,
+            max_pending=settings.CHAT_WRITE_BEHIND_MAX_PENDING,
+            retries=settings.CHAT_WRITE_BEHIND_RETRIES,
+            retry_delay=settings.CHAT_WRITE_BEHIND_RETRY_DELAY_MS / 1000,
+        )
+        atexit.register(_writer.flush)
+    return _writer
+
+
+async def write_message(message):
+    """
+    Persist a message, through the write-behind writer when it is enabled.
+    Either way it returns once the message is stored.
+    :param message: unsaved Message instance
+    :return: The stored message, or None if the writer had to drop it.
+    """
+    writer = get_writer()
+    if writer is not None:
+        return await (await writer.put(message))
+    await database_sync_to_async(store_messages)([message])
+    return message
+
+
+async def close_writer():
+    """
+    Flush the writer of this process on shutdown.
+    """
+    if _writer is not None:
+        await _writer.close()
@@ -110,6 +110,24 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Cached message lists and media access are invalidated by whichever process
+# changes them, so every process has to share the cache. Without REDIS_URL
+# each process keeps its own, which is only fit for a single process.
+if os.getenv("REDIS_URL"):
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": os.getenv("REDIS_URL"),
+            "KEY_PREFIX": "chat",
+        },
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        },
+    }
+
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
@@ -166,6 +184,77 @@ STATIC_ROOT = BASE_DIR / 'staticfiles'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+STORAGES = {
+    'default': {
+        'BACKEND': 'django.core.files.storage.FileSystemStorage',
+    },
+    'staticfiles': {
+        'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage',
+    },
+    # Chat files are stored once per distinct content
+    'chat': {
+        'BACKEND': 'chat.storage.ContentAddressedStorage',
+    },
+}
+
+# Media is served by chat.views.MediaView, set MEDIA_SENDFILE to 'x-accel-redirect'
+# or 'x-sendfile' to let the front proxy send the bytes once access is checked
+MEDIA_SENDFILE = os.getenv('MEDIA_SENDFILE', '')
+MEDIA_SENDFILE_PREFIX = os.getenv('MEDIA_SENDFILE_PREFIX', '/protected-media/')
+MEDIA_ACCESS_CACHE_TTL = int(os.getenv('MEDIA_ACCESS_CACHE_TTL', 5 * 60))
+
+# Files nothing refers to are deleted once they are older than the grace period
+MEDIA_GC_INTERVAL = int(os.getenv('MEDIA_GC_INTERVAL', 24 * 60 * 60))
+MEDIA_GC_GRACE = int(os.getenv('MEDIA_GC_GRACE', 24 * 60 * 60))
+MEDIA_GC_BATCH_SIZE = int(os.getenv('MEDIA_GC_BATCH_SIZE', 500))
+
+# Uploads are hashed as they stream in for the chat storage
+FILE_UPLOAD_HANDLERS = [
+    'chat.storage.HashingMemoryFileUploadHandler',
+    'chat.storage.HashingTemporaryFileUploadHandler',
+]
+
+
+# Chat
+CHAT_HISTORY_PAGE_SIZE = int(os.getenv('CHAT_HISTORY_PAGE_SIZE', 50))
+CHAT_MESSAGES_CACHE_TIMEOUT = int(os.getenv('CHAT_MESSAGES_CACHE_TIMEOUT', 60 * 60))
+CHAT_SEARCH_PAGE_SIZE = int(os.getenv('CHAT_SEARCH_PAGE_SIZE', 20))
+CHAT_PRESENCE_TTL = int(os.getenv('CHAT_PRESENCE_TTL', 60))
+CHAT_PRESENCE_WINDOW_MS = int(os.getenv('CHAT_PRESENCE_WINDOW_MS', 250))
+CHAT_MEMBERSHIP_CACHE_TTL = int(os.getenv('CHAT_MEMBERSHIP_CACHE_TTL', 300))
+CHAT_MEMBERSHIP_CACHE_SIZE = int(os.getenv('CHAT_MEMBERSHIP_CACHE_SIZE', 10000))
+CHAT_ATTACHMENT_MAX_SIZE = int(os.getenv('CHAT_ATTACHMENT_MAX_SIZE', 25 * 1024 * 1024))
+CHAT_ATTACHMENT_UNSENT_TTL = int(os.getenv('CHAT_ATTACHMENT_UNSENT_TTL', 24 * 60 * 60))
+CHAT_THUMBNAIL_SIZE = int(os.getenv('CHAT_THUMBNAIL_SIZE', 500))
+CHAT_THUMBNAIL_FORMAT = os.getenv('CHAT_THUMBNAIL_FORMAT', 'WEBP')
+CHAT_THUMBNAIL_QUALITY = int(os.getenv('CHAT_THUMBNAIL_QUALITY', 80))
+CHAT_PLACEHOLDER_SIZE = int(os.getenv('CHAT_PLACEHOLDER_SIZE', 16))
+CHAT_WRITE_BEHIND = os.getenv('CHAT_WRITE_BEHIND') == 'True'
+CHAT_WRITE_BEHIND_BATCH_SIZE = int(os.getenv('CHAT_WRITE_BEHIND_BATCH_SIZE', 200))
+CHAT_WRITE_BEHIND_INTERVAL_MS = int(os.getenv('CHAT_WRITE_BEHIND_INTERVAL_MS', 5))
+CHAT_WRITE_BEHIND_MAX_PENDING = int(os.getenv('CHAT_WRITE_BEHIND_MAX_PENDING', 5000))
+# Batches failing with a transient error, such as a locked database, are retried with a backoff
+CHAT_WRITE_BEHIND_RETRIES = int(os.getenv('CHAT_WRITE_BEHIND_RETRIES', 3))
+CHAT_WRITE_BEHIND_RETRY_DELAY_MS = int(os.getenv('CHAT_WRITE_BEHIND_RETRY_DELAY_MS', 50))
+CHAT_RATE_LIMIT_CONNECTION_RATE = float(os.getenv('CHAT_RATE_LIMIT_CONNECTION_RATE', 5))
+CHAT_RATE_LIMIT_CONNECTION_BURST = int(os.getenv('CHAT_RATE_LIMIT_CONNECTION_BURST', 10))
+CHAT_RATE_LIMIT_USER_RATE = float(os.getenv('CHAT_RATE_LIMIT_USER_RATE', 10))
+CHAT_RATE_LIMIT_USER_BURST = int(os.getenv('CHAT_RATE_LIMIT_USER_BURST', 20))
+CHAT_READ_RECEIPT_INTERVAL_MS = int(os.getenv('CHAT_READ_RECEIPT_INTERVAL_MS', 500))
+CHAT_NOTIFICATION_WINDOW_MS = int(os.getenv('CHAT_NOTIFICATION_WINDOW_MS', 1000))
+CHAT_DIGEST_INTERVAL = int(os.getenv('CHAT_DIGEST_INTERVAL', 60 * 60))
+CHAT_DIGEST_DELAY = int(os.getenv('CHAT_DIGEST_DELAY', 15 * 60))
+CHAT_DIGEST_DOMAIN = os.getenv('CHAT_DIGEST_DOMAIN', os.getenv('ALLOWED_HOSTS'))
+CHAT_DELETION_BATCH_SIZE = int(os.getenv('CHAT_DELETION_BATCH_SIZE', 500))
+CHAT_DELETION_RESUME_AFTER = int(os.getenv('CHAT_DELETION_RESUME_AFTER', 10 * 60))
+
+
+# User
+USER_AUTOCOMPLETE_REFRESH = int(os.getenv('USER_AUTOCOMPLETE_REFRESH', 10 * 60))
+USER_AUTOCOMPLETE_CIRCLE_TTL = int(os.getenv('USER_AUTOCOMPLETE_CIRCLE_TTL', 5 * 60))
+USER_FRIEND_SUGGESTIONS_LIMIT = int(os.getenv('USER_FRIEND_SUGGESTIONS_LIMIT', 10))
+USER_FRIEND_SUGGESTIONS_INTERVAL = int(os.getenv('USER_FRIEND_SUGGESTIONS_INTERVAL', 24 * 60 * 60))
+
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
@@ -191,6 +280,28 @@ CELERY_TIMEZONE = os.getenv('TIME_ZONE')
 
 CELERY_RESULT_BACKEND = os.getenv('CELERY_RESULT_BACKEND')
 CELERY_BEAT_SCHEDULER = 'django_celery_beat.schedulers:DatabaseScheduler'
+CELERY_BEAT_SCHEDULE = {
+    'sweep-presence': {
+        'task': 'chat.tasks.sweep_presence',
+        'schedule': CHAT_PRESENCE_TTL,
+    },
+    'send-email-digests': {
+        'task': 'chat.tasks.send_email_digests',
+        'schedule': CHAT_DIGEST_INTERVAL,
+    },
+    'resume-chat-deletions': {
+        'task': 'chat.tasks.resume_chat_deletions',
+        'schedule': CHAT_DELETION_RESUME_AFTER,
+    },
+    'collect-orphaned-media': {
+        'task': 'chat.tasks.collect_media',
+        'schedule': MEDIA_GC_INTERVAL,
+    },
+    'compute-friend-suggestions': {
+        'task': 'user.tasks.compute_friend_suggestions',
+        'schedule': USER_FRIEND_SUGGESTIONS_INTERVAL,
+    },
+}
 
 handler404 = "user.views.PageNotFound"
 handler500 = "user.views.InternalServerError"
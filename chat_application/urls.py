@@ -19,14 +19,15 @@ from django.conf import settings
 from django.conf.urls.static import static
 from django.contrib import admin
 from django.urls import include, path
+from chat.views import MediaView
 
 urlpatterns = [
     path("admin/", admin.site.urls),
     path("accounts/", include("user.urls")),
     path("chat/", include("chat.urls")),
+    path(f"{settings.MEDIA_URL.strip('/')}/<path:name>", MediaView.as_view(), name="media"),
 ]
 
 if settings.DEBUG:
-    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
     urlpatterns += static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
     urlpatterns += debug_toolbar_urls()
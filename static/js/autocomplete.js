@@ -0,0 +1,39 @@
+const searchInput = document.querySelector('.search-container input[name="username"]');
+const suggestionList = document.querySelector('#user-suggestions');
+let suggestionTimer = null;
+let suggestionRequest = null;
+
+async function loadSuggestions() {
+    const query = searchInput.value.trim();
+    if (query === '') {
+        suggestionList.replaceChildren();
+        return;
+    }
+
+    if (suggestionRequest) {
+        suggestionRequest.abort();
+    } // Only the answer to the latest input matters
+    suggestionRequest = new AbortController();
+    try {
+        const url = searchInput.dataset.autocompleteUrl + '?q=' + encodeURIComponent(query);
+        const response = await fetch(url, {signal: suggestionRequest.signal});
+        const data = await response.json();
+        suggestionList.replaceChildren(...data.results.map(user => {
+            const option = document.createElement('option');
+            option.value = user.username;
+            option.label = user.name;
+            return option;
+        }));
+    } catch (error) {
+        if (error.name !== 'AbortError') {
+            console.error('Could not load user suggestions', error);
+        }
+    }
+} // Fill the datalist with suggested usernames
+
+if (searchInput) {
+    searchInput.addEventListener('input', () => {
+        clearTimeout(suggestionTimer);
+        suggestionTimer = setTimeout(loadSuggestions, 100);
+    }); // Wait for a short pause in typing before asking
+}
@@ -10,78 +10,210 @@ const chatSocket = new WebSocket(
 ); // WebSocket connection
 
 
-chatSocket.onmessage = function (e) {
-    const data = JSON.parse(e.data);
-    const chatLog = document.querySelector('#chat-log');
-    const newMessage = document.createElement('div');
-    const username = data.username;
-    const message = data.message;
+let onlineUsers = new Set();
+let presenceVersion = 0;
+
+function renderOnlineUsers() {
+    const circles = document.querySelectorAll('[id^="circle_"]');
+
+    circles.forEach(circle => {
+        if (circle.id.includes('QuerySet')) { // For group chats
+            const othersOnline = [...onlineUsers].some(
+                username => username !== window.chatConfig.currentUserUsername
+            );
+            if (othersOnline) {
+                circle.classList.remove('circle-inactive');
+                circle.classList.add('circle-active');
+            } else {
+                circle.classList.remove('circle-active');
+                circle.classList.add('circle-inactive');
+            }
+
+        } else {
+            const username = circle.id.replace('circle_', '');
+            if (onlineUsers.has(username)) {
+                circle.classList.remove('circle-inactive');
+                circle.classList.add('circle-active');
+            } else {
+                circle.classList.remove('circle-active');
+                circle.classList.add('circle-inactive');
+            }
+        }
+    });
+} // Show who is online
+
+
+let readReceipts = {};
 
-    console.log(data);
+function renderReadReceipts() {
+    const messages = document.querySelectorAll('#chat-log [data-message-id]');
+    const lastMessageId = messages.length > 0 ? Number(messages[messages.length - 1].dataset.messageId) : 0;
+    const seenBy = Object.entries(readReceipts)
+        .filter(([username, messageId]) =>
+            username !== window.chatConfig.currentUserUsername && messageId >= lastMessageId)
+        .map(([username]) => username);
+    document.querySelector('#read-receipts').textContent =
+        seenBy.length > 0 ? `Seen by ${seenBy.join(', ')}` : '';
+} // Show who has read the newest message
+
+const READ_INTERVAL_MS = 1000;
+let readUpTo; // Undefined when nothing is pending, null for the newest message
+let readTimer = null;
+
+function markRead(messageId) {
+    if (readUpTo !== null) {
+        readUpTo = messageId === null ? null : Math.max(readUpTo || 0, messageId);
+    }
+    if (readTimer === null) {
+        readTimer = setTimeout(sendRead, READ_INTERVAL_MS);
+    }
+} // Remember how far this user has read, every frame costs a rate limit token
+
+function sendRead() {
+    clearTimeout(readTimer);
+    readTimer = null;
+    if (readUpTo === undefined || document.hidden || chatSocket.readyState !== WebSocket.OPEN) {
+        return;
+    }
+    chatSocket.send(JSON.stringify({'type': 'read', 'message_id': readUpTo}));
+    readUpTo = undefined;
+} // Tell the server the furthest read message once per interval, it batches and broadcasts it
+
+function escapeHtml(text) {
+    const element = document.createElement('div');
+    element.textContent = text;
+    return element.innerHTML;
+} // Show message text as text, never as markup
+
+function renderMessage(message) {
+    const element = document.createElement('div');
 
     let fileContent = '';
-    const file = data.file;
+    const file = message.file;
     if (file) {
-        const mimeType = file.split(';')[0].split(':')[1];
-        if (mimeType.startsWith('image/')) {
+        const attachment = message.attachment;
+        const mimeType = attachment ? attachment.content_type : '';
+        if (attachment && attachment.thumbnail) {
+            fileContent = `<a href="${file}" target="_blank">
+                <img src="${attachment.thumbnail}" alt="file" class="message-file" loading="lazy"
+                     width="${attachment.width}" height="${attachment.height}"
+                     style="background-image: url('${attachment.placeholder}')">
+            </a>`;
+        } else if (mimeType.startsWith('image/')) {
             fileContent = `<img src="${file}" alt="file" class="message-file">`;
         } else {
             fileContent = `<a href="${file}" download class="message-file">🔗 Download</a>`;
         }
     } // Handle file content
 
-    if (username !== undefined && message !== undefined) {
-        newMessage.classList.add('chat-message');
-        const user = window.chatConfig.currentUserUsername
-        if (username === user) {
-            newMessage.classList.add('my-message');
-        }
-        newMessage.innerHTML = `
-        <strong class="username">${data.username}:</strong> 
+    element.classList.add('chat-message');
+    if (message.id) {
+        element.dataset.messageId = message.id;
+    }
+    if (message.username === window.chatConfig.currentUserUsername) {
+        element.classList.add('my-message');
+    }
+    // History timestamps are UTC, live messages were just sent
+    const createdAt = message.created_at ? new Date(message.created_at.replace(' ', 'T') + 'Z') : new Date();
+    element.innerHTML = `
+        <strong class="username">${escapeHtml(message.username)}:</strong> 
         <div class="message-container">
-            ${data.message}
+            ${escapeHtml(message.text || '')}
             ${fileContent}
             <span class="timestamp">
-                (${new Date().toLocaleString()})
+                (${createdAt.toLocaleString()})
             </span>
         </div>`;
-        chatLog.appendChild(newMessage);
+    return element;
+} // Build the element of a message
+
+const chatLog = document.querySelector('#chat-log');
+let nextCursor = chatLog.dataset.nextCursor || null;
+let loadingHistory = false;
+
+chatLog.addEventListener('scroll', () => {
+    if (chatLog.scrollTop < 50 && nextCursor && !loadingHistory) {
+        loadingHistory = true;
+        chatSocket.send(JSON.stringify({'type': 'history', 'before': nextCursor}));
+    }
+}); // Load the previous page when scrolled to the top
+
+chatSocket.onmessage = function (e) {
+    const data = JSON.parse(e.data);
+    const username = data.username;
+    const message = data.message;
+
+    if (username !== undefined && message !== undefined) {
+        if (username === window.chatConfig.currentUserUsername) {
+            messageAccepted(message);
+        }
+        chatLog.appendChild(renderMessage({...data, text: message}));
         chatLog.scrollTop = chatLog.scrollHeight;
+        markRead(data.id);
+        renderReadReceipts();
     } // Handle message content
 
+    if (data.type === 'throttled') {
+        messageThrottled(data.ref, data.retry_after);
+    } // The server dropped a frame sent too fast
+
+    if (data.type === 'history') {
+        const previousHeight = chatLog.scrollHeight;
+        const olderMessages = document.createDocumentFragment();
+        for (const olderMessage of data.messages) {
+            olderMessages.appendChild(renderMessage(olderMessage));
+        }
+        chatLog.prepend(olderMessages);
+        chatLog.scrollTop = chatLog.scrollHeight - previousHeight;
+        nextCursor = data.next_cursor;
+        loadingHistory = false;
+    } // Prepend an older page and keep the scroll position
+
+    if (data.type === 'read_receipts') {
+        Object.assign(readReceipts, data.receipts);
+        renderReadReceipts();
+    } // Apply read receipts of other members
+
     if (data.type === 'online_users') {
-        const onlineUsers = data.online_users;
-        const chatName = data.chat_name;
-        const circles = document.querySelectorAll('[id^="circle_"]');
-
-        circles.forEach(circle => {
-            if (circle.id.includes('QuerySet')) { // For group chats
-                const excludedCurrentUsername = onlineUsers.filter(
-                    username => username !== window.chatConfig.currentUserUsername
-                );
-                if (excludedCurrentUsername.length > 0) {
-                    circle.classList.remove('circle-inactive');
-                    circle.classList.add('circle-active');
-                } else {
-                    circle.classList.remove('circle-active');
-                    circle.classList.add('circle-inactive');
-                }
+        onlineUsers = new Set(data.online_users);
+        presenceVersion = data.version;
+        renderOnlineUsers();
+    } // Handle a full snapshot of online users
 
+    if (data.type === 'presence_delta') {
+        for (const [version, action, username] of data.changes) {
+            if (version <= presenceVersion) {
+                continue; // Already included in the snapshot
+            }
+            if (version !== presenceVersion + 1) {
+                chatSocket.send(JSON.stringify({'type': 'presence_sync'}));
+                return;
+            } // A change was missed, ask for a new snapshot
+            if (action === 'join') {
+                onlineUsers.add(username);
             } else {
-                const username = circle.id.replace('circle_', '');
-                if (onlineUsers.includes(username)) {
-                    circle.classList.remove('circle-inactive');
-                    circle.classList.add('circle-active');
-                } else {
-                    circle.classList.remove('circle-active');
-                    circle.classList.add('circle-inactive');
-                }
+                onlineUsers.delete(username);
             }
-        });
-    } // Handle online users
+            presenceVersion = version;
+        }
+        renderOnlineUsers();
+    } // Apply join and leave deltas in version order
 };
 
 
+document.addEventListener('visibilitychange', () => {
+    if (!document.hidden) {
+        markRead(null);
+        sendRead();
+    }
+}); // Messages that arrived in a hidden tab are read once it is shown again
+
+window.addEventListener('focus', sendRead); // Send what is pending right away when the user comes back
+
+chatSocket.onopen = function (e) {
+    markRead(null);
+}; // Everything loaded with the page counts as read
+
 chatSocket.onclose = function (e) {
     console.error('Chat socket closed unexpectedly');
 }; // WebSocket close event
@@ -104,33 +236,75 @@ fileInputDom.addEventListener('change', () => {
     }
 }); // Change file status color
 
+async function uploadAttachment(file) {
+    const formData = new FormData();
+    formData.append('file', file);
+    const response = await fetch('/chat/' + conversationId + '/attachments/', {
+        method: 'POST',
+        headers: {'X-CSRFToken': document.querySelector('[name=csrfmiddlewaretoken]').value},
+        body: formData,
+    });
+    if (!response.ok) {
+        console.error('File upload failed');
+        return null;
+    }
+    return response.json();
+} // Upload a file over HTTP and get its attachment id
+
+const messageInputDom = document.querySelector('#chat-message-input');
+const noticeDom = document.querySelector('#chat-notice');
+let pendingMessage = null;
+let lastRef = 0;
+let retryTimer = null;
+
+function messageAccepted(message) {
+    if (pendingMessage === null || pendingMessage.message !== message) {
+        return;
+    }
+    if (messageInputDom.value === message) {
+        messageInputDom.value = '';
+    }
+    pendingMessage = null;
+    clearTimeout(retryTimer);
+    noticeDom.textContent = '';
+} // The server stored the message, the text can go
+
+function messageThrottled(ref, retryAfter) {
+    if (pendingMessage === null || pendingMessage.ref !== ref) {
+        return;
+    }
+    const seconds = Math.max(Math.ceil(retryAfter), 1);
+    noticeDom.textContent = `Sending too fast, trying again in ${seconds}s`;
+    clearTimeout(retryTimer);
+    retryTimer = setTimeout(() => {
+        if (pendingMessage !== null && pendingMessage.ref === ref) {
+            noticeDom.textContent = '';
+            chatSocket.send(JSON.stringify(pendingMessage));
+        }
+    }, retryAfter * 1000);
+} // Keep the text and send it again once the rate limit allows
+
 document.querySelector('#chat-message-submit').onclick = async function (e) {
-    const messageInputDom = document.querySelector('#chat-message-input');
     const message = messageInputDom.value;
-    const fileInputDom = document.querySelector('#file-upload');
     const file = fileInputDom.files[0];
 
-    let fileData = null;
+    let attachment = null;
     if (file) {
-        const reader = new FileReader();
-        reader.readAsDataURL(file);
-        fileData = await new Promise(resolve => {
-            reader.onload = () => resolve(reader.result);
-        });
+        attachment = await uploadAttachment(file);
+        fileInputDom.value = '';
+        fileStatusDom.style.background = 'none';
     }
-    chatSocket.send(JSON.stringify({
+    pendingMessage = {
         'message': message,
-        'file': fileData ? fileData : null,
+        'attachment': attachment ? attachment.id : null,
         'username': window.chatConfig.currentUserUsername,
-    }));
-
-    messageInputDom.value = '';
-    fileInputDom.value = '';
-    fileStatusDom.style.background = 'none';
-}; // Send a message on submitting
+        'ref': ++lastRef,
+    };
+    clearTimeout(retryTimer);
+    chatSocket.send(JSON.stringify(pendingMessage));
+}; // Send a message on submitting, the input is cleared once the server stored it
 
 window.onload = function () {
-    const chatLog = document.querySelector('#chat-log');
     chatLog.scrollTop = chatLog.scrollHeight;
 }; // Scroll to the bottom of the chat log on a page load
 
@@ -0,0 +1,78 @@
+const inboxSocket = new WebSocket(
+    'ws://'
+    + window.location.host
+    + '/ws/inbox/'
+); // WebSocket connection
+
+const chatList = document.querySelector('#chat-list');
+const conversationElement = document.getElementById('conversation');
+const openConversation = conversationElement ? String(JSON.parse(conversationElement.textContent)) : null;
+
+function findCard(chatId) {
+    return chatList.querySelector(`[data-chat-id="${chatId}"]`);
+} // Find the card of a chat in the list
+
+async function loadCard(chatId) {
+    const response = await fetch('/chat/' + chatId + '/card/');
+    if (!response.ok) {
+        return;
+    }
+    const template = document.createElement('template');
+    template.innerHTML = (await response.text()).trim();
+    const card = template.content.querySelector('[data-chat-id]');
+
+    const existing = findCard(chatId);
+    if (existing) {
+        existing.replaceWith(card);
+    } else {
+        chatList.prepend(card);
+        document.querySelectorAll('.no-message').forEach(element => element.remove());
+    }
+} // Fetch the card of a single chat instead of reloading the whole list
+
+function updateLastMessage(data) {
+    const card = findCard(data.chat_id);
+    if (!card) {
+        loadCard(data.chat_id);
+        return;
+    }
+    card.querySelector('.friend-last-message').textContent = data.preview;
+
+    const isMine = data.username === window.chatConfig.currentUserUsername;
+    if (!isMine && String(data.chat_id) !== openConversation) {
+        const container = card.querySelector('.unread-container');
+        let badge = container.querySelector('.unread-count');
+        if (!badge) {
+            badge = document.createElement('div');
+            badge.classList.add('unread-count');
+            badge.textContent = '0';
+            container.appendChild(badge);
+        }
+        badge.textContent = String(Number(badge.textContent) + 1);
+    } // Messages in the open chat are read right away
+
+    chatList.prepend(card);
+} // Show the new last message and move the chat to the top
+
+inboxSocket.onmessage = function (e) {
+    const data = JSON.parse(e.data);
+
+    if (data.type === 'inbox_message') {
+        updateLastMessage(data);
+    } // Handle a new message in one of the chats
+
+    if (data.type === 'inbox_chat') {
+        if (data.action === 'removed') {
+            const card = findCard(data.chat_id);
+            if (card) {
+                card.remove();
+            }
+        } else {
+            loadCard(data.chat_id);
+        }
+    } // Handle chats that were added, removed or changed
+};
+
+inboxSocket.onclose = function (e) {
+    console.error('Inbox socket closed unexpectedly');
+}; // WebSocket close event
@@ -6,7 +6,7 @@ const notificationSocket = new WebSocket(
 
 notificationSocket.onmessage = function(event) {
     const data = JSON.parse(event.data);
-    const sender = data['sender'];
+    const sender = data['chat'] ? `${data['sender']} in ${data['chat']}` : data['sender'];
 
     const message = data['message'];
     const notificationContainer = document.getElementById('notification-container');
@@ -1,6 +1,6 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
-from user.models import User
+from user.models import User, FriendSuggestions
 
 
 @admin.register(User)
@@ -30,3 +30,9 @@ class UserAdmin(UserAdmin):
         "email",
         "is_active",
     )
+
+
+@admin.register(FriendSuggestions)
+class FriendSuggestionsAdmin(admin.ModelAdmin):
+    list_display = ("user", "updated_at")
+    search_fields = ("user__username",)
@@ -0,0 +1,276 @@
+import heapq
+import logging
+import threading
+import time
+from bisect import bisect_left
+from functools import partial
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+from django.db.models import Q
+from user.models import User
+
+logger = logging.getLogger(__name__)
+
+
+class PrefixIndex:
+    """
+    Sorted (term, user id) pairs over usernames and names, lowercased.
+    A prefix lookup is a binary search plus a scan of the matching range,
+    so it does not depend on the number of users.
+    An index is never changed once built, changes return a new index, so
+    readers need no lock. Changed users go to a small overlay merged in at
+    query time, the sorted pairs are shared and only rebuilt by a refresh.
+    """
+
+    def __init__(self, users=()):
+        self._terms = {}  # user id -> terms
+        self._users = {}  # user id -> (username, full name)
+        self._overlay = {}  # user id -> (terms, (username, full name)), None once removed
+        entries = []
+        for user_id, username, first_name, last_name in users:
+            terms = self._index_terms(username, first_name, last_name)
+            self._terms[user_id] = terms
+            self._users[user_id] = (username, f"{first_name} {last_name}".strip())
+            entries += [(term, user_id) for term in terms]
+        entries.sort()
+        self._entries = entries
+
+    @staticmethod
+    def _index_terms(username, first_name, last_name):
+        full_name = f"{first_name} {last_name}".strip()
+        return frozenset(term.lower() for term in (username, first_name, last_name, full_name) if term)
+
+    def __len__(self):
+        size = len(self._users)
+        for user_id, entry in self._overlay.items():
+            if entry is None and user_id in self._users:
+                size -= 1
+            elif entry is not None and user_id not in self._users:
+                size += 1
+        return size
+
+    def _lookup(self, user_id):
+        if user_id in self._overlay:
+            return self._overlay[user_id]
+        if user_id in self._users:
+            return self._terms[user_id], self._users[user_id]
+        return None
+
+    def _with_overlay(self, user_id, entry):
+        index = PrefixIndex.__new__(PrefixIndex)
+        index._terms, index._users, index._entries = self._terms, self._users, self._entries
+        index._overlay = {**self._overlay, user_id: entry}
+        return index
+
+    def with_user(self, user_id, username, first_name, last_name):
+        """
+        Get an index with the user indexed, replacing what was indexed for it before.
+        """
+        entry = (self._index_terms(username, first_name, last_name), (username, f"{first_name} {last_name}".strip()))
+        if self._lookup(user_id) == entry:
+            # Most saves, such as a login, change nothing indexed
+            return self
+        return self._with_overlay(user_id, entry)
+
+    def without_user(self, user_id):
+        """
+        Get an index without the user.
+        """
+        if self._lookup(user_id) is None:
+            return self
+        return self._with_overlay(user_id, None)
+
+    def matches(self, user_id, prefix):
+        entry = self._lookup(user_id)
+        return entry is not None and any(term.startswith(prefix) for term in entry[0])
+
+    def _range(self, prefix):
+        position = bisect_left(self._entries, (prefix,))
+        while position < len(self._entries) and self._entries[position][0].startswith(prefix):
+            yield self._entries[position]
+            position += 1
+
+    def scan(self, prefix, limit):
+        """
+        Get up to limit ids of users with a term starting with the prefix,
+        in term order.
+        """
+        indexed = (entry for entry in self._range(prefix) if entry[1] not in self._overlay)
+        changed = sorted(
+            (term, user_id) for user_id, entry in self._overlay.items() if entry is not None
+            for term in entry[0] if term.startswith(prefix)
+        )
+        found = []
+        for _, user_id in heapq.merge(indexed, changed):
+            if len(found) >= limit:
+                break
+            if user_id not in found:
+                found.append(user_id)
+        return found
+
+    def describe(self, user_id):
+        username, name = self._lookup(user_id)[1]
+        return {'username': username, 'name': name}
+
+
+_index = None
+# Serializes writers swapping _index, readers take the current index without it
+_write_lock = threading.Lock()
+# Changes made while a rebuild reads the database, replayed on the new index
+_changes = None
+_refresher = None
+_refresher_lock = threading.Lock()
+
+
+def build_index():
+    users = User.objects.filter(is_active=True).values_list("id", "username", "first_name", "last_name")
+    return PrefixIndex(users.iterator())
+
+
+def refresh_index():
+    """
+    Build the index from the database and swap it in, changes this process
+    made while it was built are applied on top.
+    """
+    global _index, _changes
+    with _write_lock:
+        _changes = []
+    try:
+        index = build_index()
+    except Exception:
+        with _write_lock:
+            _changes = None
+        raise
+    with _write_lock:
+        for change in _changes:
+            index = change(index)
+        _changes = None
+        _index = index
+
+
+def _refresh_forever():
+    while True:
+        try:
+            refresh_index()
+        except Exception:
+            logger.exception("Failed to build the autocomplete index")
+        finally:
+            # This thread is not a request, nothing else closes its connection
+            connections.close_all()
+        time.sleep(settings.USER_AUTOCOMPLETE_REFRESH)
+
+
+def start_refresher():
+    """
+    Build the index of this process in a background thread, and again every
+    USER_AUTOCOMPLETE_REFRESH seconds to pick up changes made by other
+    processes, so no request waits for a build.
+    """
+    global _refresher
+    with _refresher_lock:
+        if _refresher is None:
+            _refresher = threading.Thread(target=_refresh_forever, name="autocomplete-index", daemon=True)
+            _refresher.start()
+
+
+def get_index():
+    """
+    Get the index of this process, starting its refresher on first use.
+    :return: PrefixIndex, or None while the first build runs
+    """
+    start_refresher()
+    return _index
+
+
+def _apply(change):
+    global _index
+    with _write_lock:
+        if _changes is not None:
+            _changes.append(change)
+        if _index is not None:
+            _index = change(_index)
+
+
+def index_user(user):
+    """
+    Apply a saved user to the index of this process right away.
+    """
+    if user.is_active:
+        _apply(partial(PrefixIndex.with_user, user_id=user.id, username=user.username,
+                       first_name=user.first_name, last_name=user.last_name))
+    else:
+        unindex_user(user.id)
+
+
+def unindex_user(user_id):
+    _apply(partial(PrefixIndex.without_user, user_id=user_id))
+
+
+def circle_key(user_id):
+    return f"autocomplete:circle:{user_id}"
+
+
+def get_circle(user_id):
+    """
+    Get the ids of the user's friends and friends of friends, cached.
+    :return: Tuple of (friend ids, friend of friend ids)
+    """
+    circle = cache.get(circle_key(user_id))
+    if circle is None:
+        friendships = User.friends.through.objects
+        friends = set(friendships.filter(from_user_id=user_id).values_list("to_user_id", flat=True))
+        friends_of_friends = set(
+            friendships.filter(from_user_id__in=friends).values_list("to_user_id", flat=True)
+        ) - friends - {user_id}
+        circle = (friends, friends_of_friends)
+        cache.set(circle_key(user_id), circle, settings.USER_AUTOCOMPLETE_CIRCLE_TTL)
+    return circle
+
+
+def invalidate_circle(user_ids):
+    cache.delete_many([circle_key(user_id) for user_id in user_ids])
+
+
+def autocomplete(user, text, limit=10):
+    """
+    Suggest users whose username or name starts with the text.
+    Friends come first, then friends of friends, then everyone else.
+    :param user: User object of the person searching
+    :param text: typed prefix
+    :param limit: maximum number of suggestions
+    :return: list of {'username', 'name'} dictionaries
+    """
+    prefix = text.strip().lower()
+    if not prefix:
+        return []
+    index = get_index()
+    if index is None:
+        return search_users(user, prefix, limit)
+    friends, friends_of_friends = get_circle(user.id)
+
+    # The circle is small, it is matched directly so common prefixes cannot crowd it out
+    ranked = sorted(user_id for user_id in friends if index.matches(user_id, prefix))
+    ranked += sorted(user_id for user_id in friends_of_friends if index.matches(user_id, prefix))
+    for user_id in index.scan(prefix, limit + len(ranked) + 1):
+        if user_id not in ranked and user_id != user.id:
+            ranked.append(user_id)
+    return [index.describe(user_id) for user_id in ranked[:limit]]
+
+
+def search_users(user, prefix, limit):
+    """
+    Suggest users from the database while the index is being built,
+    friends and friends of friends first.
+    """
+    friends, friends_of_friends = get_circle(user.id)
+    users = list(
+        User.objects.filter(is_active=True)
+        .filter(Q(username__istartswith=prefix) | Q(first_name__istartswith=prefix) | Q(last_name__istartswith=prefix))
+        .exclude(pk=user.id).order_by("username").values_list("id", "username", "first_name", "last_name")[:limit * 4]
+    )
+    users.sort(key=lambda row: (row[0] not in friends, row[0] not in friends_of_friends))
+    return [
+        {'username': username, 'name': f"{first_name} {last_name}".strip()}
+        for _, username, first_name, last_name in users[:limit]
+    ]
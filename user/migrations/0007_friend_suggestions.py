@@ -0,0 +1,26 @@
+# Generated by Django 5.1.4 on 2026-10-18 18:24
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user', '0006_rename_received_friend_requests_user_friend_requests_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FriendSuggestions',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='friend_suggestions', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('suggestions', models.JSONField(default=list)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name_plural': 'friend suggestions',
+            },
+        ),
+    ]
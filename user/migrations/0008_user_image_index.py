@@ -0,0 +1,19 @@
+# Generated by Django 5.1.4 on 2026-10-18 18:32
+
+import versatileimagefield.fields
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user', '0007_friend_suggestions'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='user',
+            name='image',
+            field=versatileimagefield.fields.VersatileImageField(blank=True, db_index=True, upload_to='user/images/', verbose_name='Image'),
+        ),
+    ]
@@ -20,6 +20,7 @@ class User(AbstractBaseUser, PermissionsMixin):
         'Image',
         upload_to='user/images/',
         blank=True,
+        db_index=True,
     )
     is_active = models.BooleanField(default=True)
     is_admin = models.BooleanField(default=False)
@@ -42,3 +43,20 @@ class User(AbstractBaseUser, PermissionsMixin):
     REQUIRED_FIELDS = ["first_name", "last_name", "email"]
 
     objects = UserManager()
+
+
+class FriendSuggestions(models.Model):
+    """
+    Precomputed people a user may know, ranked by mutual friends.
+    Suggestions are stored ready to render, as a list of
+    {'id', 'username', 'image', 'mutual'} dictionaries.
+    """
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='friend_suggestions')
+    suggestions = models.JSONField(default=list)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name_plural = 'friend suggestions'
+
+    def __str__(self):
+        return f"Suggestions for {self.user_id}"
@@ -0,0 +1,27 @@
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+from user.autocomplete import index_user, unindex_user, invalidate_circle
+from user.models import User
+
+
+@receiver(post_save, sender=User)
+def index_user_signal(sender, instance, **kwargs):
+    """
+    Keep the autocomplete index of this process current.
+    """
+    index_user(instance)
+
+
+@receiver(post_delete, sender=User)
+def unindex_user_signal(sender, instance, **kwargs):
+    unindex_user(instance.pk)
+
+
+@receiver(m2m_changed, sender=User.friends.through)
+def invalidate_circle_signal(sender, instance, action, pk_set, **kwargs):
+    """
+    Friends of both sides rank differently once a friendship changes.
+    Friends of friends are not invalidated, they expire with the cache.
+    """
+    if action.startswith("post_"):
+        invalidate_circle({instance.pk, *(pk_set or ())})
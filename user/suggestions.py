@@ -0,0 +1,135 @@
+import heapq
+from array import array
+from collections import Counter, defaultdict
+from itertools import groupby, chain
+from operator import itemgetter
+from django.conf import settings
+from django.db.models import Q
+from user.models import User, FriendSuggestions
+
+
+def load_graph(user_ids=None):
+    """
+    Load friendships as sorted arrays of friend ids.
+    :param user_ids: only load the friends of these users, everyone's when None
+    :return: Dictionary of user id -> array of friend ids
+    """
+    rows = User.friends.through.objects.order_by('from_user_id', 'to_user_id')
+    if user_ids is not None:
+        rows = rows.filter(from_user_id__in=user_ids)
+    return {
+        user_id: array('l', (friend_id for _, friend_id in friends))
+        for user_id, friends in groupby(rows.values_list('from_user_id', 'to_user_id').iterator(), key=itemgetter(0))
+    }
+
+
+def load_pending(user_ids=None):
+    """
+    Load who each user has a pending friend request with, in either direction.
+    :return: Dictionary of user id -> set of user ids
+    """
+    rows = User.friend_requests.through.objects.all()
+    if user_ids is not None:
+        rows = rows.filter(Q(from_user_id__in=user_ids) | Q(to_user_id__in=user_ids))
+    pending = defaultdict(set)
+    for from_user_id, to_user_id in rows.values_list('from_user_id', 'to_user_id').iterator():
+        pending[from_user_id].add(to_user_id)
+        pending[to_user_id].add(from_user_id)
+    return pending
+
+
+def rank(graph, user_id, excluded=(), limit=10):
+    """
+    Rank friends of friends of a user by the number of mutual friends.
+    :param graph: Dictionary of user id -> friend ids, holding the user's
+    friends and their friends
+    :param user_id: user to rank candidates for
+    :param excluded: ids that must not be suggested
+    :param limit: maximum number of candidates
+    :return: list of (candidate id, mutual friends) pairs, best first
+    """
+    friends = graph.get(user_id, ())
+    mutual = Counter()
+    for friend_id in friends:
+        mutual.update(graph.get(friend_id, ()))
+    skipped = {user_id, *friends, *excluded}
+    best = heapq.nsmallest(
+        limit, ((-count, candidate_id) for candidate_id, count in mutual.items() if candidate_id not in skipped)
+    )
+    return [(candidate_id, -count) for count, candidate_id in best]
+
+
+def load_profiles(user_ids):
+    """
+    Load what a suggestion card shows of each user.
+    """
+    storage = User._meta.get_field('image').storage
+    return {
+        user_id: {'id': user_id, 'username': username, 'image': storage.url(image) if image else ''}
+        for user_id, username, image in User.objects.filter(id__in=user_ids).values_list('id', 'username', 'image')
+    }
+
+
+def store_suggestions(graph, user_ids, pending, batch_size=500):
+    """
+    Rank and store the suggestions of the given users in batches.
+    :return: Number of users whose suggestions were stored.
+    """
+    inactive = set(User.objects.filter(is_active=False).values_list('id', flat=True))
+    limit = settings.USER_FRIEND_SUGGESTIONS_LIMIT
+    user_ids = list(user_ids)
+    for start in range(0, len(user_ids), batch_size):
+        batch = user_ids[start:start + batch_size]
+        ranked = {user_id: rank(graph, user_id, inactive | pending.get(user_id, set()), limit) for user_id in batch}
+        profiles = load_profiles({candidate_id for pairs in ranked.values() for candidate_id, _ in pairs})
+        FriendSuggestions.objects.bulk_create(
+            [
+                FriendSuggestions(user_id=user_id, suggestions=[
+                    {**profiles[candidate_id], 'mutual': mutual}
+                    for candidate_id, mutual in pairs if candidate_id in profiles
+                ])
+                for user_id, pairs in ranked.items()
+            ],
+            update_conflicts=True,
+            unique_fields=['user'],
+            update_fields=['suggestions', 'updated_at'],
+        )
+    return len(user_ids)
+
+
+def compute_suggestions():
+    """
+    Recompute the suggestions of every active user with friends from one
+    pass over the friendship graph. Users without friends have nothing to
+    be suggested and their stored suggestions are dropped.
+    :return: Number of users whose suggestions were stored.
+    """
+    graph = load_graph()
+    active = set(User.objects.filter(is_active=True).values_list('id', flat=True))
+    stored = store_suggestions(graph, sorted(active & graph.keys()), load_pending())
+    FriendSuggestions.objects.filter(Q(user__is_active=False) | Q(user__friends__isnull=True)).delete()
+    return stored
+
+
+def refresh_suggestions(user_ids):
+    """
+    Recompute suggestions after friendships of the given users changed.
+    Their friends are refreshed too, as their mutual friend counts with
+    the other side of the change moved. Only the part of the graph these
+    users can reach within two steps is loaded.
+    :param user_ids: ids of the users on both ends of the changed friendships
+    :return: Number of users whose suggestions were stored.
+    """
+    friends = load_graph(user_ids)
+    affected = set(user_ids) | set(chain.from_iterable(friends.values()))
+    graph = load_graph(affected)
+    graph.update(load_graph(set(chain.from_iterable(graph.values())) - graph.keys()))
+    return store_suggestions(graph, affected, load_pending(affected))
+
+
+def get_suggestions(user_id):
+    """
+    Get the stored suggestions of a user in a single lookup.
+    :return: list of {'id', 'username', 'image', 'mutual'} dictionaries
+    """
+    return FriendSuggestions.objects.filter(user_id=user_id).values_list('suggestions', flat=True).first() or []
@@ -1,6 +1,7 @@
 from django.core.mail import EmailMessage
 from django.template.loader import render_to_string
 from user.models import User
+from user.suggestions import compute_suggestions, refresh_suggestions
 from user.utils.activation_token_generator import account_activation_token
 from celery import shared_task
 
@@ -22,4 +23,19 @@ def send_verification_email(user_id, current_site_domain, email_address):
     to_email = email_address
     email = EmailMessage(mail_subject, message, to=[to_email])
     email.content_subtype = 'html'
-    email.send()
\ No newline at end of file
+    email.send()
+
+@shared_task
+def compute_friend_suggestions():
+    """
+    Recompute the friend suggestions of every user.
+    """
+    return compute_suggestions()
+
+
+@shared_task
+def refresh_friend_suggestions(user_ids):
+    """
+    Recompute the friend suggestions around users whose friendship changed.
+    """
+    return refresh_suggestions(user_ids)
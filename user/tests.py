@@ -1,3 +1,181 @@
-from django.test import TestCase
+from unittest.mock import patch
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from chat.notifications import NotificationBatcher
+from user import autocomplete
+from user.models import FriendSuggestions, User
+from user.suggestions import compute_suggestions, get_suggestions, refresh_suggestions
 
-# Create your tests here.
+IN_MEMORY_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+
+
+def create_user(username, **fields):
+    return User.objects.create_user(
+        username=username, first_name=username, last_name=username, email=f"{username}@example.com",
+        password="secret", **fields
+    )
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+class FriendNotificationTests(TestCase):
+
+    def setUp(self):
+        self.alice = create_user("alice")
+        self.bob = create_user("bob")
+        self.carol = create_user("carol")
+        self.batcher = NotificationBatcher(window=60)
+        patcher = patch("chat.notifications.get_notification_batcher", return_value=self.batcher)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.batcher.flush)
+
+    def post(self, user, path):
+        self.client.force_login(user)
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(path, HTTP_HOST="localhost")
+
+    def test_requests_of_a_window_are_sent_in_one_batch(self):
+        self.post(self.bob, "/accounts/add-friend/alice/")
+        self.post(self.carol, "/accounts/add-friend/alice/")
+        self.post(self.carol, "/accounts/add-friend/alice/")
+        with patch("chat.tasks.send_notifications.delay") as delay:
+            self.batcher.flush()
+        delay.assert_called_once()
+        self.assertCountEqual(delay.call_args.args[0], [
+            (self.alice.id, {"message": "New friend request!", "sender": "bob"}),
+            (self.alice.id, {"message": "New friend request!", "sender": "carol"}),
+        ])
+
+    def test_nothing_is_sent_without_notifications(self):
+        with patch("chat.tasks.send_notifications.delay") as delay:
+            self.batcher.flush()
+        delay.assert_not_called()
+
+    @patch("user.views.refresh_friend_suggestions")
+    def test_accepting_notifies_the_sender(self, refresh):
+        self.alice.friend_requests.add(self.bob)
+        self.post(self.alice, "/accounts/accept-friend/bob/")
+        self.assertTrue(self.alice.friends.filter(pk=self.bob.pk).exists())
+        refresh.delay.assert_called_once_with([self.alice.id, self.bob.id])
+        with patch("chat.tasks.send_notifications.delay") as delay:
+            self.batcher.flush()
+        delay.assert_called_once_with([(self.bob.id, {"message": "Accepted your friend request!", "sender": "alice"})])
+
+
+class AutocompleteTests(TestCase):
+
+    def setUp(self):
+        patcher = patch("user.autocomplete.start_refresher")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(setattr, autocomplete, "_index", None)
+        autocomplete._index = None
+        cache.clear()
+
+        self.alice = create_user("alice")
+        self.friend = create_user("sam_friend")
+        self.friend_of_friend = create_user("sam_fof")
+        self.stranger = create_user("sam_stranger")
+        self.alice.friends.add(self.friend)
+        self.friend.friends.add(self.friend_of_friend)
+
+    def suggest(self, text):
+        return [result["username"] for result in autocomplete.autocomplete(self.alice, text)]
+
+    def test_friends_rank_first(self):
+        autocomplete.refresh_index()
+        self.assertEqual(self.suggest("sam"), ["sam_friend", "sam_fof", "sam_stranger"])
+        self.assertEqual(self.suggest("ali"), [])
+
+    def test_database_is_searched_until_the_index_is_built(self):
+        with self.assertNumQueries(3):
+            self.assertEqual(self.suggest("sam"), ["sam_friend", "sam_fof", "sam_stranger"])
+
+    def test_saved_users_replace_the_index(self):
+        autocomplete.refresh_index()
+        before = autocomplete.get_index()
+        create_user("samantha")
+        self.stranger.is_active = False
+        self.stranger.save()
+        self.assertEqual(self.suggest("sam"), ["sam_friend", "sam_fof", "samantha"])
+        self.assertEqual(len(before), 4)
+
+    def test_saves_changing_nothing_indexed_keep_the_index(self):
+        autocomplete.refresh_index()
+        before = autocomplete.get_index()
+        self.alice.last_login = timezone.now()
+        self.alice.save()
+        self.assertIs(autocomplete.get_index(), before)
+
+    def test_saves_do_not_copy_the_indexed_terms(self):
+        autocomplete.refresh_index()
+        before = autocomplete.get_index()
+        self.stranger.username = self.stranger.first_name = self.stranger.last_name = "renamed"
+        self.stranger.save()
+        create_user("samantha")
+        index = autocomplete.get_index()
+        self.assertIs(index._entries, before._entries)
+        self.assertEqual(self.suggest("sam"), ["sam_friend", "sam_fof", "samantha"])
+        self.assertEqual(self.suggest("ren"), ["renamed"])
+        self.assertEqual(len(index), 5)
+
+        autocomplete.refresh_index()
+        self.assertEqual(autocomplete.get_index()._overlay, {})
+        self.assertEqual(self.suggest("sam"), ["sam_friend", "sam_fof", "samantha"])
+
+    def test_changes_made_during_a_rebuild_are_kept(self):
+        build_index = autocomplete.build_index
+
+        def build_then_save():
+            index = build_index()
+            create_user("samantha")
+            return index
+
+        with patch("user.autocomplete.build_index", build_then_save):
+            autocomplete.refresh_index()
+        self.assertIn("samantha", self.suggest("sam"))
+
+
+class FriendSuggestionTests(TestCase):
+
+    def setUp(self):
+        self.alice, self.bob, self.carol, self.dave, self.erin, self.frank = (
+            create_user(username) for username in ("alice", "bob", "carol", "dave", "erin", "frank")
+        )
+        # Dave shares two friends with alice, erin one
+        self.alice.friends.add(self.bob, self.carol)
+        self.dave.friends.add(self.bob, self.carol)
+        self.erin.friends.add(self.bob)
+
+    def suggested(self, user):
+        return [(suggestion["username"], suggestion["mutual"]) for suggestion in get_suggestions(user.id)]
+
+    def test_friends_of_friends_are_ranked_by_mutual_friends(self):
+        self.assertEqual(compute_suggestions(), 5)
+        self.assertEqual(self.suggested(self.alice), [("dave", 2), ("erin", 1)])
+        self.assertEqual(self.suggested(self.erin), [("alice", 1), ("dave", 1)])
+        self.assertEqual(self.suggested(self.frank), [])
+
+    def test_pending_requests_and_inactive_users_are_not_suggested(self):
+        self.erin.friend_requests.add(self.alice)
+        self.dave.is_active = False
+        self.dave.save()
+        compute_suggestions()
+        self.assertEqual(self.suggested(self.alice), [])
+        self.assertFalse(FriendSuggestions.objects.filter(user=self.dave).exists())
+
+    def test_users_without_friends_lose_their_suggestions(self):
+        compute_suggestions()
+        self.erin.friends.clear()
+        compute_suggestions()
+        self.assertEqual(self.suggested(self.erin), [])
+
+    def test_refresh_updates_both_sides_and_their_friends(self):
+        compute_suggestions()
+        self.alice.friends.add(self.frank)
+        self.frank.friends.add(self.erin)
+        self.assertEqual(refresh_suggestions([self.alice.id, self.frank.id]), 5)
+        self.assertEqual(self.suggested(self.alice), [("dave", 2), ("erin", 2)])
+        self.assertEqual(self.suggested(self.bob), [("carol", 2), ("frank", 2)])
+        self.assertEqual(self.suggested(self.frank), [("bob", 2), ("carol", 1)])
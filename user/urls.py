@@ -41,6 +41,7 @@ urlpatterns = [
     path("accept-friend/<str:username>/", views.AcceptFriendRequestView.as_view(), name="accept_friend"),
     path("decline-friend/<str:username>/", views.DeclineFriendRequestView.as_view(), name="decline_friend"),
     path("remove-friend/<str:username>/", views.RemoveFriendView.as_view(), name="remove_friend"),
+    path("autocomplete/", views.UserAutocompleteView.as_view(), name="autocomplete"),
     # path('page-not-found/', views.PageNotFound.as_view(), name='page_not_found'),
     # path('server-error/', views.InternalServerError.as_view(), name='server_error'),
 ]
@@ -1,17 +1,19 @@
 from django.contrib.auth.decorators import login_required
 from django.contrib.sites.shortcuts import get_current_site
-from django.http import HttpResponse
+from django.http import HttpResponse, JsonResponse
 from django.shortcuts import redirect
 from django.template.response import TemplateResponse
 from django.urls import reverse_lazy
 from django.utils.decorators import method_decorator
 from django.views import View
 from django.views.generic import TemplateView, CreateView, DetailView, UpdateView, ListView
-from chat.tasks import send_notification
+from chat.notifications import queue_notification
 from mixins.search_mixin import SearchMixIn
+from user.autocomplete import autocomplete
 from user.forms import RegistrationForm, UpdatePasswordForm, ProfileUpdateForm
 from user.models import User
-from user.tasks import send_verification_email
+from user.suggestions import get_suggestions
+from user.tasks import send_verification_email, refresh_friend_suggestions
 from user.utils.activation_token_generator import account_activation_token
 
 
@@ -22,6 +24,11 @@ class MyProfileView(SearchMixIn, TemplateView):
     """
     template_name = 'profile/profile.html'
 
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['suggestions'] = get_suggestions(self.request.user.id)
+        return context
+
 
 class RegisterView(CreateView):
     """
@@ -57,6 +64,14 @@ class ProfileDetailView(SearchMixIn, DetailView):
     slug_field = 'username'
     slug_url_kwarg = 'username'
 
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['suggestions'] = [
+            suggestion for suggestion in get_suggestions(self.request.user.id)
+            if suggestion['id'] != self.object.id
+        ]
+        return context
+
 
 @method_decorator(login_required, name='dispatch')
 class ProfileUpdateView(SearchMixIn, UpdateView):
@@ -161,7 +176,7 @@ class AddFriendRequestView(View):
             friend = User.objects.get(username=username)
             friend.friend_requests.add(request.user)
             request.user.friend_requests.remove(friend)
-            send_notification.delay(friend.id, f"New friend request!")
+            queue_notification(friend.id, {"message": "New friend request!", "sender": request.user.username})
 
 
         except User.DoesNotExist:
@@ -183,7 +198,8 @@ class AcceptFriendRequestView(View):
             friend = User.objects.get(username=username)
             user.friends.add(friend)
             user.friend_requests.remove(friend)
-            send_notification.delay(friend.id, f"Accepted your friend request!")
+            refresh_friend_suggestions.delay([user.id, friend.id])
+            queue_notification(friend.id, {"message": "Accepted your friend request!", "sender": user.username})
         except User.DoesNotExist:
             return redirect(self.success_url)
         return redirect(self.success_url)
@@ -220,11 +236,24 @@ class RemoveFriendView(View):
         try:
             friend = User.objects.get(username=username)
             user.friends.remove(friend)
+            refresh_friend_suggestions.delay([user.id, friend.id])
         except User.DoesNotExist:
             return redirect(self.success_url)
         return redirect(self.success_url)
 
 
+@method_decorator(login_required, name="dispatch")
+class UserAutocompleteView(View):
+    """
+    Suggest users for the search field as the user types.
+    Submitting the search form still redirects to an exact username.
+    """
+
+    def get(self, request):
+        results = autocomplete(request.user, request.GET.get("q", ""))
+        return JsonResponse({"results": results})
+
+
 class PageNotFound(TemplateView):
     """
     This view is used to display the 404 page.